@@ -13,7 +13,7 @@ from gp.lightning.data_template import DataModule
 from gp.lightning.training import lightning_fit, lightning_test
 from gp.lightning.module_template import ExpConfig
 from lightning_model import GraphTextPredLightning
-from gofa_models.model import GOFA
+from gofa_models.model import GOFA, print_fixed_length
 from gofa_models.config import GOFALlamaConfig, GOFAMistralConfig
 
 import torch
@@ -45,11 +45,16 @@ def main(params):
     model_args.dec_lora = params.dec_lora
     model_args.llama_pretrain_checkpoint = params.llama_pretrain_checkpoint
     model_args.mistral_pretrain_checkpoint = params.mistral_pretrain_checkpoint
+    model_args.graph_cache_size = params.graph_cache_size
+    model_args.graph_cache_dir = params.graph_cache_dir
     training_args.model_max_length = params.llm_max_length
     if params.training_precision == "bf16-mixed":
         training_args.bf16 = True
         gofa_args.llama_dtype = torch.bfloat16
     gofa_args.gnn_mlp_type = params.mlp_type
+    gofa_args.gnn_attention = params.gnn_attention
+    gofa_args.gnn_checkpoint = params.gnn_checkpoint
+    gofa_args.gnn_checkpoint_interval = params.gnn_checkpoint_interval
 
     model = GOFA(transformer_args=[model_args, training_args, gofa_args], mode=params.mode, base_llm=params.base_llm, save_dir=params.exp_dir)
 
@@ -110,6 +115,7 @@ def main(params):
 
     model = model.to("cuda")
 
+    prev_data = None
     while input("Continue generation?") != "no":
 
         with open("test_graph.json", "r") as f:
@@ -150,7 +156,32 @@ def main(params):
 
         data = graph.to("cuda")
         with torch.no_grad():
-            model(data)
+            if prev_data is not None and params.mode.startswith("autoencoder"):
+                # only re-encode the nodes affected by the edits since the last turn
+                encoded = model.incremental_encode(data, prev_data)
+            else:
+                encoded = model.encode(data)
+            if params.mode == "autoencodergen":
+                # print the answer of the first question while it is generated, the deltas of all questions are
+                # interleaved, so the answers of the other questions are printed once generation is finished
+                answers = [""] * len(target_question)
+                print("\n" + "=" * 120)
+                print_fixed_length("question: " + str(target_question[0]))
+                print("-" * 120)
+                for i, delta in model.stream_generate(encoded):
+                    if i == 0:
+                        print(delta, end="", flush=True)
+                    else:
+                        answers[i] += delta
+                print()
+                for i in range(1, len(target_question)):
+                    print("=" * 120)
+                    print_fixed_length("question: " + str(target_question[i]))
+                    print("-" * 120)
+                    print(answers[i])
+            else:
+                model.decode(encoded)
+        prev_data = data
 
 
 
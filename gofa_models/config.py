@@ -5,7 +5,8 @@ from transformers import LlamaConfig, MistralConfig
 
 class GOFALlamaConfig(LlamaConfig):
     def __init__(self, dim=4096, num_layers=6, mem_token=128, head=8, add_self_loops=True, dropout=0.0,
-                 llama_dtype=torch.float16, gnn_hidden_act="relu", gnn_mlp_type="gp", pretraining_tp=0, **kwargs):
+                 llama_dtype=torch.float16, gnn_hidden_act="relu", gnn_mlp_type="gp", pretraining_tp=0,
+                 gnn_attention="propagate", gnn_checkpoint="none", gnn_checkpoint_interval=1, **kwargs):
         super().__init__(**kwargs)
         self.dim = dim
         self.mem_token = mem_token
@@ -17,13 +18,17 @@ class GOFALlamaConfig(LlamaConfig):
         self.gnn_hidden_act = gnn_hidden_act
         self.gnn_mlp_type = gnn_mlp_type
         self.pretraining_tp = pretraining_tp
+        self.gnn_attention = gnn_attention
+        self.gnn_checkpoint = gnn_checkpoint
+        self.gnn_checkpoint_interval = gnn_checkpoint_interval
 
 
 
 
 class GOFAMistralConfig(MistralConfig):
     def __init__(self, dim=4096, num_layer=6, mem_token=128, head=8, add_self_loops=True, dropout=0.0,
-                 llama_dtype=torch.float16, gnn_hidden_act="relu", gnn_mlp_type="gp",  pretraining_tp=0, **kwargs):
+                 llama_dtype=torch.float16, gnn_hidden_act="relu", gnn_mlp_type="gp",  pretraining_tp=0,
+                 gnn_attention="propagate", gnn_checkpoint="none", gnn_checkpoint_interval=1, **kwargs):
         super().__init__(**kwargs)
         self.dim = dim
         self.mem_token = mem_token
@@ -35,3 +40,6 @@ class GOFAMistralConfig(MistralConfig):
         self.gnn_hidden_act = gnn_hidden_act
         self.gnn_mlp_type = gnn_mlp_type
         self.pretraining_tp = pretraining_tp
+        self.gnn_attention = gnn_attention
+        self.gnn_checkpoint = gnn_checkpoint
+        self.gnn_checkpoint_interval = gnn_checkpoint_interval
@@ -4,8 +4,684 @@ import torch
 from modules.gofa_icae_llama_modeling import LlamaICAE
 from modules.gofa_icae_mistral_modeling import MistralICAE
 from modules.llama_modeling import LlamaLora
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager, nullcontext
 from safetensors.torch import load_file
+from modules.gofa_modeling import GOFAPrefixCache, GOFAStaticCache
+from .state_cache import FrozenStateCache, GraphMemoryCache, PrefixStateStore
+from .token_ids import RaggedArray, tokenize_texts, tokenize_graph_texts
+
+
+def frozen_namespace(model_args, model, checkpoint):
+    base_model = model.icae.get_base_model().model
+    dtype = base_model.embed_tokens.weight.dtype
+    return "_".join([model.model_name, str(checkpoint), str(base_model.num_frozen_layers), str(dtype),
+                     str(model_args.mem_size)])
+
+
+def build_state_cache(model_args, model, checkpoint):
+    cache_size = getattr(model_args, "frozen_cache_size", 0)
+    if not cache_size:
+        return None
+    dtype = model.icae.get_base_model().model.embed_tokens.weight.dtype
+    return FrozenStateCache(cache_size, getattr(model_args, "frozen_cache_dir", None),
+                            frozen_namespace(model_args, model, checkpoint), dtype)
+
+
+def build_graph_cache(model_args, model, checkpoint):
+    cache_size = getattr(model_args, "graph_cache_size", 0)
+    if not cache_size:
+        return None
+    dtype = model.icae.get_base_model().model.embed_tokens.weight.dtype
+    return GraphMemoryCache(cache_size, getattr(model_args, "graph_cache_dir", None),
+                            frozen_namespace(model_args, model, checkpoint), dtype)
+
+
+def build_prefix_store(model_args, model, checkpoint):
+    store_dir = getattr(model_args, "edge_prefix_store_dir", None)
+    if not store_dir:
+        return None
+    prefix_store = PrefixStateStore(store_dir)
+    namespace = frozen_namespace(model_args, model, checkpoint)
+    if prefix_store.namespace != namespace:
+        raise ValueError(f"Prefix store {store_dir} was computed for {prefix_store.namespace}, "
+                         f"but the current model is {namespace}.")
+    return prefix_store
+
+
+def pad_token_ids(token_ids, pad_token_id):
+    input_ids = torch.full((len(token_ids), max(len(t) for t in token_ids)), pad_token_id, dtype=torch.long)
+    for i, t in enumerate(token_ids):
+        input_ids[i, :len(t)] = torch.tensor(t, dtype=torch.long)
+    return input_ids
+
+
+@contextmanager
+def eval_mode(module):
+    r"""Put module and all its submodules in eval mode and restore the mode of every submodule afterwards."""
+    modes = [(m, m.training) for m in module.modules()]
+    module.eval()
+    try:
+        yield module
+    finally:
+        for m, training in modes:
+            m.training = training
+
+
+def pack_token_ids(token_ids):
+    r"""Concatenate token id lists or the rows of a RaggedArray into a single row without padding. Returns the packed
+    ids of shape (1, total_length) and the length of every sequence.
+    """
+    if isinstance(token_ids, RaggedArray):
+        return torch.from_numpy(token_ids.values).long().unsqueeze(0), torch.from_numpy(token_ids.lengths)
+    packed_ids = torch.tensor([i for t in token_ids for i in t], dtype=torch.long).unsqueeze(0)
+    return packed_ids, torch.tensor([len(t) for t in token_ids], dtype=torch.long)
+
+
+def padding_fraction(lengths):
+    r"""Fraction of positions that are padding when sequences of the given lengths are right padded to the longest
+    sequence.
+    """
+    lengths = torch.as_tensor(lengths)
+    return 1 - float(lengths.sum()) / (len(lengths) * int(lengths.max()))
+
+
+def pack_decode_inputs(model, mem_embs, inputs):
+    r"""Packed decoder input embeddings of the packed DecodeInputs inputs, with the rows of mem_embs at the positions
+    of inputs.mem_mask. Returned with the sequence lengths and the mask of the positions whose logits predict the
+    answer, all on the device of mem_embs.
+    """
+    cur_device = mem_embs.device
+    packed_ids = inputs.input_ids.to(cur_device)
+    decode_embed = model.tokens_to_embeddings(packed_ids)
+    decode_embed[inputs.mem_mask.to(cur_device).unsqueeze(0)] = mem_embs.view(-1, mem_embs.size()[-1]).to(
+        decode_embed)
+    return decode_embed, inputs.packed_lengths.to(cur_device), inputs.target_mask.to(cur_device)
+
+
+def target_length_mask(target_lengths, device=None):
+    r"""Mask of shape (num_sequences, max_target_length) marking the first target_lengths[i] positions of row i.
+    """
+    target_lengths = torch.tensor(target_lengths, device=device)
+    return torch.arange(int(target_lengths.max()), device=device).unsqueeze(0) < target_lengths.unsqueeze(1)
+
+
+def decoder_target_states(model, inputs_embeds, target_mask, packed_lengths=None):
+    r"""Final decoder states of the positions in target_mask only, of shape (num_targets, hidden_size). Unlike the
+    logits of the full decoder output, these are projected to the vocabulary by the caller for the targets only.
+    """
+    base_model = model.icae.get_base_model().model
+    hidden_states = base_model(inputs_embeds=inputs_embeds, packed_lengths=packed_lengths).last_hidden_state
+    return hidden_states[target_mask]
+
+
+def unpack_target_logits(logits, packed_target_mask, target_lengths):
+    r"""Gather the target logits of a packed decoder output into shape (num_sequences, max_target_length, vocab_size),
+    returned with the mask of valid targets. Indexing the result with the mask gives the same targets in the same
+    order as the padded decoder output.
+    """
+    target_mask = target_length_mask(target_lengths, logits.device)
+    target_logits = logits.new_zeros(target_mask.size() + (logits.size()[-1],))
+    target_logits[target_mask] = logits.view(-1, logits.size()[-1])[packed_target_mask]
+    return target_logits, target_mask
+
+
+def token_budget_batches(lengths, token_budget):
+    r"""Split sequence indices into batches of similar length whose padded size stays within token_budget. A
+    sequence longer than token_budget forms its own batch.
+    """
+    batches = []
+    batch = []
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        if len(batch) > 0 and (len(batch) + 1) * lengths[i] > token_budget:
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+@torch.no_grad()
+def compute_prefix_states(model, text_ids, mem_size, mode="full", token_budget=None):
+    r"""Run the frozen decoder layers on every token id list in text_ids, each ending with mem_size memory tokens.
+    In "full" mode, return the hidden states entering the first GNN layer. In "kv" mode, return these states for the
+    memory tokens only, together with the keys and values of the text tokens in every GNN-interleaved layer, stacked to
+    shape (num_layers, 2, num_kv_heads, text_length, head_dim). If token_budget is set, sequences are processed in
+    micro-batches of at most token_budget padded tokens.
+    """
+    if token_budget:
+        states = [None] * len(text_ids)
+        for batch in token_budget_batches([len(t) for t in text_ids], token_budget):
+            for i, s in zip(batch, compute_prefix_states(model, [text_ids[i] for i in batch], mem_size, mode)):
+                states[i] = s
+        return states
+    base_model = model.icae.get_base_model().model
+    cur_device = model.memory_token_embed.weight.device
+    input_ids = pad_token_ids(text_ids, model.tokenizer.pad_token_id).to(cur_device)
+    boundary_states = base_model.frozen_forward(model.tokens_to_embeddings(input_ids))
+    if mode == "full":
+        return [boundary_states[i, :len(t)] for i, t in enumerate(text_ids)]
+    text_lengths = [len(t) - mem_size for t in text_ids]
+    text_mask = torch.arange(max(text_lengths), device=cur_device).unsqueeze(0) < torch.tensor(
+        text_lengths, device=cur_device).unsqueeze(1)
+    prefix_cache = base_model.prefix_kv(boundary_states[:, :max(text_lengths)], text_mask)
+    layer_index = sorted(prefix_cache.key_cache.keys())
+    states = []
+    for i, length in enumerate(text_lengths):
+        text_kv = torch.stack([torch.stack([prefix_cache.key_cache[j][i, :, :length],
+                                            prefix_cache.value_cache[j][i, :, :length]]) for j in layer_index])
+        states.append((boundary_states[i, length:length + mem_size], text_kv))
+    return states
+
+
+def frozen_boundary_states(model, text_ids, state_cache=None, prefix_store=None, token_budget=None, store_start=0):
+    r"""Compute the hidden states entering the first GNN layer for every token id list in text_ids. The states are left
+    padded to the longest sequence and returned with the attention mask. Sequences from index store_start on that are
+    found in prefix_store, and sequences found in state_cache, skip the frozen decoder layers. The others are computed
+    in micro-batches of at most token_budget padded tokens and added to state_cache. With a state_cache, misses are
+    computed in eval mode, so that no dropout sample of the frozen layers is cached and replayed in later epochs or at
+    evaluation.
+    """
+    base_model = model.icae.get_base_model().model
+    cur_device = model.memory_token_embed.weight.device
+    states = [None] * len(text_ids)
+    if prefix_store is not None:
+        states = states[:store_start] + [prefix_store.get(prefix_store.key(t)) for t in text_ids[store_start:]]
+    if state_cache is not None:
+        keys = [state_cache.key(t) for t in text_ids]
+        states = [state_cache.get(k) if s is None else s for s, k in zip(states, keys)]
+
+    miss_index = [i for i, s in enumerate(states) if s is None]
+    if len(miss_index) > 0:
+        with eval_mode(base_model) if state_cache is not None else nullcontext():
+            miss_states = compute_prefix_states(model, [text_ids[i] for i in miss_index], base_model.mem_token,
+                                                token_budget=token_budget)
+        for j, i in enumerate(miss_index):
+            states[i] = miss_states[j]
+            if state_cache is not None:
+                state_cache.put(keys[i], states[i])
+
+    max_length = max(len(t) for t in text_ids)
+    boundary_states = torch.zeros((len(text_ids), max_length, base_model.config.hidden_size),
+                                  dtype=base_model.embed_tokens.weight.dtype, device=cur_device)
+    attention_mask = torch.zeros((len(text_ids), max_length), dtype=torch.long, device=cur_device)
+    for i, s in enumerate(states):
+        boundary_states[i, max_length - len(s):] = s.to(boundary_states)
+        attention_mask[i, max_length - len(s):] = 1
+    return boundary_states, attention_mask
+
+
+def prefix_memory_embedding(model, text_ids, prefix_store, graph=None, token_budget=None, store_start=0):
+    r"""Compute the memory embeddings of text_ids from a "kv" mode prefix_store, running only the memory tokens
+    through the GNN-interleaved layers. Only sequences from index store_start on are looked up in the store, the
+    others and those missing from the store are computed on the fly.
+    """
+    base_model = model.icae.get_base_model().model
+    cur_device = model.memory_token_embed.weight.device
+    dtype = base_model.embed_tokens.weight.dtype
+    mem_size = base_model.mem_token
+    states = [None] * store_start + [prefix_store.get(prefix_store.key(t)) for t in text_ids[store_start:]]
+    miss_index = [i for i, s in enumerate(states) if s is None]
+    if len(miss_index) > 0:
+        miss_states = compute_prefix_states(model, [text_ids[i] for i in miss_index], mem_size, mode="kv",
+                                            token_budget=token_budget)
+        for j, i in enumerate(miss_index):
+            states[i] = miss_states[j]
+
+    num_layers, _, num_kv_heads, _, head_dim = states[0][1].size()
+    text_lengths = torch.tensor([len(t) - mem_size for t in text_ids], device=cur_device)
+    prefix_length = int(text_lengths.max())
+    prefix_key = torch.zeros((num_layers, len(text_ids), num_kv_heads, prefix_length, head_dim), dtype=dtype,
+                             device=cur_device)
+    prefix_value = torch.zeros_like(prefix_key)
+    for i, (_, text_kv) in enumerate(states):
+        text_kv = text_kv.to(device=cur_device, dtype=dtype)
+        prefix_key[:, i, :, prefix_length - text_kv.size(-2):] = text_kv[:, 0]
+        prefix_value[:, i, :, prefix_length - text_kv.size(-2):] = text_kv[:, 1]
+    prefix_mask = torch.arange(prefix_length, device=cur_device).unsqueeze(0) >= (
+            prefix_length - text_lengths).unsqueeze(1)
+    layer_index = range(base_model.num_frozen_layers, base_model.num_frozen_layers + num_layers)
+    prefix_cache = GOFAPrefixCache({j: prefix_key[k] for k, j in enumerate(layer_index)},
+                                   {j: prefix_value[k] for k, j in enumerate(layer_index)})
+    mem_states = torch.stack([s[0] for s in states]).to(device=cur_device, dtype=dtype)
+    return base_model.memory_forward(mem_states, prefix_cache, prefix_mask.long(), graph=graph, map_node=True)
+
+
+class DecodePrefix:
+    r"""Keys and values of the decoder prefix of encoded nodes, computed once by decode_prefix of the helpers and
+    reused by every prompt about these nodes. The prefix holds all memory tokens but the last one, which is fed with
+    the prompt so that its output predicts the first answer token. Indexing selects the node of every prompt without
+    copying the cache, and the result is passed to decode and generate in place of the memory embeddings.
+    """
+    def __init__(self, cache, last_embs, index=None):
+        self.cache = cache
+        self.last_embs = last_embs
+        self.index = torch.arange(len(last_embs), device=last_embs.device) if index is None else index
+
+    def __getitem__(self, index):
+        return DecodePrefix(self.cache, self.last_embs, self.index[index])
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def length(self):
+        return self.cache.get_seq_length()
+
+    @property
+    def device(self):
+        return self.last_embs.device
+
+
+@torch.no_grad()
+def compute_decode_prefix(model, prefix_embeds, last_embs):
+    r"""Run the decoder over prefix_embeds of shape (num_nodes, prefix_length, hidden_size) and keep the keys and
+    values of every layer as a DecodePrefix.
+    """
+    base_model = model.icae.get_base_model().model
+    cache = base_model(inputs_embeds=prefix_embeds, past_key_values=GOFAPrefixCache(), use_cache=True).past_key_values
+    return DecodePrefix(cache, last_embs)
+
+
+def prefix_decoder_target_states(model, prefix, token_ids, target_mask):
+    r"""Final decoder states of the positions in target_mask of token_ids continuing the prefix of their node, of
+    shape (num_targets, hidden_size) in row order. The first token id of every row is replaced by the last memory
+    token of its node. The rows of a node are packed into one sequence that attends to the shared prefix, so the
+    prefix is neither recomputed nor copied per row.
+    """
+    base_model = model.icae.get_base_model().model
+    device = prefix.device
+    index = torch.as_tensor(prefix.index, device=device)
+    row_states = [None] * len(token_ids)
+    for node in torch.unique(index).tolist():
+        rows = (index == node).nonzero().view(-1).tolist()
+        packed_ids, packed_lengths = pack_token_ids([token_ids[i] for i in rows])
+        packed_lengths = packed_lengths.to(device)
+        decode_embed = model.tokens_to_embeddings(packed_ids.to(device))
+        decode_embed[0, torch.cumsum(packed_lengths, dim=0) - packed_lengths] = prefix.last_embs[node].to(
+            decode_embed)
+        hidden_states = base_model(inputs_embeds=decode_embed, packed_lengths=packed_lengths, use_cache=True,
+                                   past_key_values=prefix.cache.index_select(slice(node, node + 1))).last_hidden_state
+        packed_target_mask = torch.tensor([m for i in rows for m in target_mask[i]], dtype=torch.bool, device=device)
+        states = torch.split(hidden_states[0, packed_target_mask], [sum(target_mask[i]) for i in rows])
+        for i, s in zip(rows, states):
+            row_states[i] = s
+    return torch.cat(row_states, dim=0)
+
+
+def prefix_generate_inputs(model, prefix, token_ids, pad_token_id):
+    r"""Inputs of greedy_generate continuing the prefix of the node of every row: the left-padded input embeddings of
+    token_ids, whose first token id is replaced by the last memory token, the attention mask over prefix and inputs,
+    and the prefix cache of every row. Padding sits between the prefix and the inputs, so the prefix keys of every row
+    are moved right by its padding to keep its positions contiguous.
+    """
+    device = prefix.device
+    index = torch.as_tensor(prefix.index, device=device)
+    lengths = torch.tensor([len(t) for t in token_ids], device=device)
+    input_length = int(lengths.max())
+    shift = input_length - lengths
+    input_ids = torch.tensor([[pad_token_id] * (input_length - len(t)) + t for t in token_ids], device=device)
+    inputs_embeds = model.tokens_to_embeddings(input_ids)
+    inputs_embeds[torch.arange(len(token_ids), device=device), shift] = prefix.last_embs[index].to(inputs_embeds)
+    attention_mask = (torch.arange(input_length, device=device).unsqueeze(0) >= shift.unsqueeze(1)).long()
+    attention_mask = torch.cat([attention_mask.new_ones((len(token_ids), prefix.length)), attention_mask], dim=-1)
+    rotary_emb = model.icae.get_base_model().model.layers[0].self_attn.rotary_emb
+    prefix_cache = prefix.cache.index_select(index).shift_positions(shift, rotary_emb)
+    return inputs_embeds, attention_mask, prefix_cache
+
+
+def init_static_cache(max_length, prefix_cache=None):
+    r"""GOFAStaticCache of max_length positions, holding the keys and values of prefix_cache if given."""
+    cache = GOFAStaticCache(max_length)
+    if prefix_cache is not None:
+        for layer_idx in prefix_cache.key_cache:
+            cache.update(prefix_cache.key_cache[layer_idx], prefix_cache.value_cache[layer_idx], layer_idx)
+    return cache
+
+
+@torch.no_grad()
+def greedy_steps(model, inputs_embeds, attention_mask, stop_token_ids, max_new_tokens=128, max_token_id=None,
+                 num_logits=None, compact_interval=8, prefix_cache=None):
+    r"""Greedy decoding from left-padded input embeddings with a key/value cache and attention mask preallocated for
+    the input and max_new_tokens generated tokens. A row is finished once it generates a token in stop_token_ids or,
+    if max_token_id is given, a token id of at least max_token_id, and is filled with stop_token_ids[0] afterwards.
+    Every compact_interval steps, finished rows are dropped from the active batch and the cache, so that later steps
+    only run the unfinished rows. Only the first num_logits logits are considered if given. If prefix_cache is given,
+    inputs_embeds continue its keys and values and attention_mask also covers the cached positions. Yields the token
+    ids of shape (batch_size,) generated by every step in the original row order, until all rows are finished.
+    """
+    batch_size, input_length = attention_mask.size()
+    device = inputs_embeds.device
+    cache = init_static_cache(input_length + max_new_tokens, prefix_cache)
+    mask = attention_mask.new_ones((batch_size, input_length + max_new_tokens))
+    mask[:, :input_length] = attention_mask
+    fill_token_id = stop_token_ids[0]
+    stop_token_ids = torch.tensor(stop_token_ids, device=device)
+    embed_tokens = model.icae.get_base_model().model.embed_tokens
+    # original index and finished flag of every active row
+    rows = torch.arange(batch_size, device=device)
+    finished = torch.zeros(batch_size, dtype=torch.bool, device=device)
+    output = inputs_embeds
+    for i in range(max_new_tokens):
+        logits = model.icae(inputs_embeds=output, attention_mask=mask[:, :input_length + i], past_key_values=cache,
+                            use_cache=True).logits[:, -1]
+        if num_logits is not None:
+            logits = logits[:, :num_logits]
+        next_token_id = torch.argmax(logits, dim=-1)
+        next_token_id[finished] = fill_token_id
+        step_token_id = torch.full((batch_size,), fill_token_id, dtype=torch.long, device=device)
+        step_token_id[rows] = next_token_id
+        yield step_token_id
+        finished |= torch.isin(next_token_id, stop_token_ids)
+        if max_token_id is not None:
+            finished |= next_token_id >= max_token_id
+        if torch.all(finished):
+            return
+        output = embed_tokens(next_token_id.unsqueeze(-1)).to(device)
+        if compact_interval > 0 and (i + 1) % compact_interval == 0 and torch.any(finished):
+            active = torch.logical_not(finished).nonzero().view(-1)
+            rows, finished, output, mask = rows[active], finished[active], output[active], mask[active]
+            cache = cache.index_select(active)
+
+
+def greedy_generate(model, inputs_embeds, attention_mask, stop_token_ids, max_new_tokens=128, max_token_id=None,
+                    num_logits=None, compact_interval=8, prefix_cache=None):
+    r"""Run greedy_steps to the end. Returns the generated token ids of shape (batch_size, num_steps) in the original
+    row order.
+    """
+    return torch.stack(list(greedy_steps(model, inputs_embeds, attention_mask, stop_token_ids, max_new_tokens,
+                                         max_token_id, num_logits, compact_interval, prefix_cache)), dim=1)
+
+
+class IncrementalDetokenizer:
+    r"""Decodes a stream of token ids into text deltas. Every token only decodes a window from the last complete
+    word on instead of the whole sequence, and no text is emitted while the window ends in an incomplete character.
+    """
+    def __init__(self, tokenizer, skip_special_tokens=True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.token_ids = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def add(self, token_id):
+        self.token_ids.append(token_id)
+        prefix_text = self.tokenizer.decode(self.token_ids[self.prefix_offset:self.read_offset],
+                                            skip_special_tokens=self.skip_special_tokens)
+        text = self.tokenizer.decode(self.token_ids[self.prefix_offset:],
+                                     skip_special_tokens=self.skip_special_tokens)
+        if len(text) <= len(prefix_text) or text.endswith("\ufffd"):
+            return ""
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.token_ids)
+        return text[len(prefix_text):]
+
+
+def batch_decode_ragged(tokenizer, token_ids, lengths, stop_token_ids=None, **kwargs):
+    r"""Decode the rows of token_ids packed into one tensor of shape (total_length,) with the given row lengths in a
+    single batch_decode call. If stop_token_ids is given, every row is truncated before its first stop token on the
+    token ids, so no text after it is decoded.
+    """
+    device = token_ids.device
+    lengths = torch.as_tensor(lengths, dtype=torch.long, device=device)
+    offsets = torch.cumsum(lengths, dim=0) - lengths
+    if stop_token_ids is not None:
+        rows = torch.arange(len(lengths), device=device).repeat_interleave(lengths)
+        position = torch.arange(len(token_ids), device=device) - offsets[rows]
+        is_stop = torch.isin(token_ids, torch.tensor(stop_token_ids, device=device))
+        lengths = lengths.scatter_reduce(0, rows, torch.where(is_stop, position, lengths[rows]), reduce="amin")
+    token_ids = token_ids.tolist()
+    return tokenizer.batch_decode([token_ids[o:o + n] for o, n in zip(offsets.tolist(), lengths.tolist())],
+                                  **kwargs)
+
+
+class NgramDrafter:
+    r"""Proposes draft tokens for speculative decoding by looking up the last generated tokens in a set of token id
+    sequences, such as the node and edge texts of the graph. The longest suffix of at most ngram_size tokens that
+    occurs in a sequence is matched, and up to num_draft_tokens tokens that follow its first occurrence are proposed.
+    """
+    def __init__(self, token_ids, ngram_size=3, num_draft_tokens=4):
+        self.ngram_size = ngram_size
+        self.num_draft_tokens = num_draft_tokens
+        # sequences are separated by None, so that drafts do not run into the next sequence
+        self.tokens = []
+        self.index = {}
+        for seq in token_ids:
+            start = len(self.tokens)
+            self.tokens.extend(seq)
+            self.tokens.append(None)
+            for n in range(1, ngram_size + 1):
+                for i in range(start, start + len(seq) - n):
+                    self.index.setdefault(tuple(self.tokens[i:i + n]), i + n)
+
+    def draft(self, history):
+        for n in range(min(self.ngram_size, len(history)), 0, -1):
+            pos = self.index.get(tuple(history[-n:]))
+            if pos is not None:
+                draft = self.tokens[pos:pos + self.num_draft_tokens]
+                return draft[:draft.index(None)] if None in draft else draft
+        return []
+
+
+def graph_drafter(tokenizer, graph, num_draft_tokens, ngram_size=3):
+    r"""Build an NgramDrafter over the node and edge texts of graph, or return None if speculative decoding is
+    disabled or the texts of the graph are not available.
+    """
+    texts = getattr(graph, "graph_texts", None)
+    if num_draft_tokens <= 0 or texts is None:
+        return None
+    token_ids = tokenizer(list(texts), add_special_tokens=False, padding=False)["input_ids"]
+    return NgramDrafter(token_ids, ngram_size, num_draft_tokens)
+
+
+@torch.no_grad()
+def speculative_generate(model, inputs_embeds, attention_mask, stop_token_ids, drafter, max_new_tokens=128,
+                         max_token_id=None, num_logits=None, prefix_cache=None):
+    r"""Greedy decoding with drafts proposed by drafter, producing the same tokens as greedy_generate. Every step feeds
+    the last generated token and the draft of each row, and accepts the draft tokens that match the greedy
+    predictions plus the prediction after them. Rows advance by different numbers of tokens, so positions are passed
+    explicitly and the cache slots of rejected draft tokens are masked out. Finished rows are dropped from the active
+    batch, and masked slots are compacted away when the preallocated cache runs full.
+    prefix_cache is used as in greedy_generate. Returns the generated token ids in the format of greedy_generate.
+    """
+    batch_size, input_length = attention_mask.size()
+    device = inputs_embeds.device
+    # slack of max_new_tokens slots for rejected draft tokens between compactions
+    capacity = input_length + 2 * max_new_tokens + drafter.num_draft_tokens + 1
+    cache = init_static_cache(capacity, prefix_cache)
+    mask = attention_mask.new_zeros((batch_size, capacity))
+    mask[:, :input_length] = attention_mask
+    used = input_length
+    fill_token_id = stop_token_ids[0]
+    stop_token_ids = set(stop_token_ids)
+    embed_tokens = model.icae.get_base_model().model.embed_tokens
+    generated = [[] for _ in range(batch_size)]
+    rows = list(range(batch_size))
+    drafts = [[] for _ in range(batch_size)]
+    logits = model.icae(inputs_embeds=inputs_embeds, attention_mask=mask[:, :used], past_key_values=cache,
+                        use_cache=True).logits[:, -1:]
+    while True:
+        if num_logits is not None:
+            logits = logits[..., :num_logits]
+        predictions = logits.argmax(dim=-1).tolist()
+        step_length = logits.size(1)
+        active = []
+        for j, row in enumerate(rows):
+            draft, prediction = drafts[j], predictions[j]
+            num_accepted = 0
+            while num_accepted < len(draft) and draft[num_accepted] == prediction[num_accepted]:
+                num_accepted += 1
+            # the input token and accepted draft tokens stay in the cache
+            mask[j, used - step_length + num_accepted + 1:used] = 0
+            finished = False
+            for token in draft[:num_accepted] + [prediction[num_accepted]]:
+                generated[row].append(token)
+                if token in stop_token_ids or (max_token_id is not None and token >= max_token_id) or \
+                        len(generated[row]) == max_new_tokens:
+                    finished = True
+                    break
+            if not finished:
+                active.append(j)
+        if len(active) == 0:
+            break
+        if len(active) < len(rows):
+            active_index = torch.tensor(active, device=device)
+            rows = [rows[j] for j in active]
+            mask = mask[active_index]
+            cache = cache.index_select(active_index)
+
+        drafts = [drafter.draft(generated[row]) for row in rows]
+        step_length = 1 + max(len(d) for d in drafts)
+        if used + step_length > capacity:
+            # rotary embeddings are only computed up to the cache length, which must stay beyond all positions
+            valid = mask[:, :used].bool()
+            used = max(int(valid.sum(dim=-1).max()), input_length + max(len(generated[row]) for row in rows))
+            index = torch.argsort(valid.int(), dim=-1, stable=True)[:, -used:]
+            cache.compact(index)
+            mask[:, :used] = mask.gather(1, index)
+            mask[:, used:] = 0
+        input_ids = torch.tensor([[generated[row][-1]] + d + [generated[row][-1]] * (step_length - 1 - len(d))
+                                  for row, d in zip(rows, drafts)], device=device)
+        position_ids = torch.tensor([input_length + len(generated[row]) - 1 for row in rows], device=device)
+        position_ids = position_ids.unsqueeze(-1) + torch.arange(step_length, device=device)
+        mask[:, used:used + step_length] = 1
+        used += step_length
+        logits = model.icae(inputs_embeds=embed_tokens(input_ids).to(device), attention_mask=mask[:, :used],
+                            position_ids=position_ids, past_key_values=cache, use_cache=True).logits
+
+    output = torch.full((batch_size, max(len(g) for g in generated)), fill_token_id, dtype=torch.long, device=device)
+    for row, tokens in enumerate(generated):
+        output[row, :len(tokens)] = torch.tensor(tokens, dtype=torch.long, device=device)
+    return output
+
+
+# Encoder inputs: text_ids are the token ids of every text followed by the memory tokens, as a RaggedArray. Padded
+# inputs have left padded input_ids and attention_mask of shape (num_texts, length), packed inputs the input_ids of
+# shape (1, total_length) and packed_lengths.
+EncodeInputs = namedtuple("EncodeInputs", ["text_ids", "input_ids", "attention_mask", "packed_lengths"])
+# Decoder inputs: answer_ids are the concatenated answer ids, each followed by eos, and target_lengths their lengths.
+# prefix_ids and prefix_mask are the ids and target mask that follow a DecodePrefix. input_ids, mem_mask and
+# target_mask are padded to shape (batch_size, length), or packed into one row with packed_lengths.
+DecodeInputs = namedtuple("DecodeInputs", ["answer_ids", "target_lengths", "has_prompt", "prefix_ids", "prefix_mask",
+                                           "input_ids", "mem_mask", "target_mask", "packed_lengths"])
+
+
+class GOFAInputs:
+    r"""Assembles the token id tensors of the encoder and decoder of a GOFA helper from texts or token ids on the
+    CPU. It holds no model weights, so the task wrappers can run it in the DataLoader workers, and the helpers take
+    its EncodeInputs and DecodeInputs in place of texts.
+    Args:
+        tokenizer: tokenizer of the helper.
+        left_tokenizer: left padding tokenizer of the helper, its pad token pads the encoder inputs.
+        max_length (int): maximum number of tokens of node, edge and answer texts.
+        mem_tokens (list): ids of the memory tokens.
+        ft_token_id (int): id of the token around the prompts.
+        packed (bool): if True, pack the sequences into one row instead of padding them.
+    """
+    def __init__(self, tokenizer, left_tokenizer, max_length, mem_tokens, ft_token_id, packed=False):
+        self.tokenizer = tokenizer
+        self.left_tokenizer = left_tokenizer
+        self.max_length = max_length
+        self.mem_tokens = mem_tokens
+        self.mem_size = len(mem_tokens)
+        self.ft_token_id = ft_token_id
+        self.packed = packed
+
+    def tokenize_graph(self, g):
+        return tokenize_graph_texts(g, self.tokenizer, self.max_length)
+
+    def encode(self, data):
+        text_ids = tokenize_texts(self.tokenizer, data, self.max_length)
+        text_ids = RaggedArray.cat_rows(text_ids, RaggedArray.constant(self.mem_tokens, len(text_ids)))
+        if self.packed:
+            input_ids, packed_lengths = pack_token_ids(text_ids)
+            return EncodeInputs(text_ids, input_ids, None, packed_lengths)
+        # left padding puts the memory tokens of all sequences at the same, right-aligned positions
+        input_ids = torch.from_numpy(text_ids.pad(self.left_tokenizer.pad_token_id, left=True)).long()
+        attention_mask = torch.from_numpy(text_ids.mask(left=True)).long()
+        return EncodeInputs(text_ids, input_ids, attention_mask, None)
+
+    def answer_prompt_ids(self, data, prompt=None):
+        r"""Answer ids followed by eos, prompt ids and the rows with a non-empty prompt."""
+        batch_size = len(data)
+        answer_ids = tokenize_texts(self.tokenizer, data, self.max_length, add_special_tokens=False)
+        answer_ids = RaggedArray.cat_rows(answer_ids, RaggedArray.constant([self.tokenizer.eos_token_id], batch_size))
+        if prompt is None:
+            prompt = [""] * batch_size
+        prompt_ids = tokenize_texts(self.left_tokenizer, prompt, 512, add_special_tokens=False)
+        return answer_ids, prompt_ids, prompt_ids.lengths > 0
+
+
+class GOFALlamaInputs(GOFAInputs):
+    def decode(self, data, prompt=None):
+        prompt_output, prompt_input, has_prompt = self.answer_prompt_ids(data, prompt)
+        batch_size = len(prompt_output)
+        pad_token_id = self.tokenizer.pad_token_id
+        ft_ids = RaggedArray.constant([self.ft_token_id], batch_size, has_prompt)
+        prompt_input = RaggedArray.cat_rows(ft_ids, prompt_input, ft_ids)
+        prompt_ids = RaggedArray.cat_rows(prompt_input, prompt_output)
+        prompt_mask = RaggedArray.cat_rows(RaggedArray.full(prompt_input.lengths, False, dtype=bool),
+                                           RaggedArray.full(prompt_output.lengths, True, dtype=bool),
+                                           RaggedArray.constant([False], batch_size, dtype=bool))
+        answer_ids = torch.from_numpy(prompt_output.values).long()
+        prefix_ids = RaggedArray.cat_rows(RaggedArray.constant([pad_token_id], batch_size), prompt_ids)
+        if self.packed:
+            input_ids, packed_lengths = pack_token_ids(
+                RaggedArray.cat_rows(RaggedArray.constant([pad_token_id] * self.mem_size, batch_size), prompt_ids))
+            mem_mask = RaggedArray.cat_rows(RaggedArray.constant([True] * self.mem_size, batch_size, dtype=bool),
+                                            RaggedArray.full(prompt_ids.lengths, False, dtype=bool))
+            target_mask = RaggedArray.cat_rows(
+                RaggedArray.constant([False] * (self.mem_size - 1), batch_size, dtype=bool), prompt_mask)
+            return DecodeInputs(answer_ids, prompt_output.lengths, has_prompt, prefix_ids, prompt_mask, input_ids,
+                                torch.from_numpy(mem_mask.values), torch.from_numpy(target_mask.values),
+                                packed_lengths)
+        # the memory embeddings are put in front of the ids, and the target mask is one position longer than the ids,
+        # as the logits of a position predict the next token
+        input_ids = torch.from_numpy(prompt_ids.pad(pad_token_id)).long()
+        target_mask = torch.cat([torch.zeros((batch_size, self.mem_size - 1), dtype=torch.bool),
+                                 torch.from_numpy(prompt_mask.pad(False, input_ids.size(1) + 1))], dim=-1)
+        return DecodeInputs(answer_ids, prompt_output.lengths, has_prompt, prefix_ids, prompt_mask, input_ids, None,
+                            target_mask, None)
+
+
+class GOFAMistralInputs(GOFAInputs):
+    def decode(self, data, prompt=None):
+        prompt_output, prompt_input, has_prompt = self.answer_prompt_ids(data, prompt)
+        batch_size = len(prompt_output)
+        pad_token_id = self.tokenizer.pad_token_id
+        # For Mistral, decode contains: prefix, memory slots and suffix
+        prompt_left_ids = RaggedArray.constant([1, 733, 16289, 28793], batch_size, has_prompt)
+        prompt_right_ids = RaggedArray.cat_rows(RaggedArray.constant([self.ft_token_id], batch_size, has_prompt),
+                                                prompt_input,
+                                                RaggedArray.constant([733, 28748, 16289, 28793], batch_size,
+                                                                     has_prompt))
+        mem_ids = RaggedArray.constant([pad_token_id] * self.mem_size, batch_size)
+        prompt_ids = RaggedArray.cat_rows(prompt_left_ids, mem_ids, prompt_right_ids, prompt_output)
+        prompt_mask = RaggedArray.cat_rows(
+            RaggedArray.full(prompt_left_ids.lengths + self.mem_size - 1 + prompt_right_ids.lengths, False,
+                             dtype=bool),
+            RaggedArray.full(prompt_output.lengths, True, dtype=bool),
+            RaggedArray.constant([False], batch_size, dtype=bool))
+        mem_mask = RaggedArray.cat_rows(RaggedArray.full(prompt_left_ids.lengths, False, dtype=bool),
+                                        RaggedArray.constant([True] * self.mem_size, batch_size, dtype=bool),
+                                        RaggedArray.full(prompt_right_ids.lengths + prompt_output.lengths, False,
+                                                         dtype=bool))
+        answer_ids = torch.from_numpy(prompt_output.values).long()
+        prefix_ids = RaggedArray.cat_rows(RaggedArray.constant([pad_token_id], batch_size), prompt_right_ids,
+                                          prompt_output)
+        prefix_mask = RaggedArray.cat_rows(RaggedArray.full(prompt_right_ids.lengths, False, dtype=bool),
+                                           RaggedArray.full(prompt_output.lengths, True, dtype=bool),
+                                           RaggedArray.constant([False], batch_size, dtype=bool))
+        if self.packed:
+            input_ids, packed_lengths = pack_token_ids(prompt_ids)
+            return DecodeInputs(answer_ids, prompt_output.lengths, has_prompt, prefix_ids, prefix_mask, input_ids,
+                                torch.from_numpy(mem_mask.values), torch.from_numpy(prompt_mask.values),
+                                packed_lengths)
+        input_ids = torch.from_numpy(prompt_ids.pad(pad_token_id)).long()
+        return DecodeInputs(answer_ids, prompt_output.lengths, has_prompt, prefix_ids, prefix_mask, input_ids,
+                            torch.from_numpy(mem_mask.pad(False)),
+                            torch.from_numpy(prompt_mask.pad(False, input_ids.size(1))), None)
 
 
 class GOFALlamaHelper(torch.nn.Module):
@@ -25,8 +701,20 @@ class GOFALlamaHelper(torch.nn.Module):
         self.mem_tokens = list(range(model.vocab_size, model.vocab_size + model_args.mem_size))
         self.mem_size = model_args.mem_size
         self.model = model
+        self.state_cache = build_state_cache(model_args, model, model_args.llama_pretrain_checkpoint)
+        self.prefix_store = build_prefix_store(model_args, model, model_args.llama_pretrain_checkpoint)
+        self.graph_cache = build_graph_cache(model_args, model, model_args.llama_pretrain_checkpoint)
+        self.frozen_token_budget = getattr(model_args, "frozen_token_budget", 0)
+        self.packed = getattr(model_args, "packed_sequences", False)
+        self.loss_chunk_size = getattr(model_args, "loss_chunk_size", 0)
+        self.speculative_draft_tokens = getattr(model_args, "speculative_draft_tokens", 0)
+        self.speculative_ngram_size = getattr(model_args, "speculative_ngram_size", 3)
+        self.padding_fraction = {}
         self.model.tokenizer.pad_token = self.model.tokenizer.eos_token
         self.model.left_tokenizer.pad_token = self.model.left_tokenizer.bos_token
+        self.inputs = GOFALlamaInputs(self.model.tokenizer, self.model.left_tokenizer,
+                                      self.model.training_args.model_max_length, self.mem_tokens,
+                                      self.model.ft_token_id, self.packed)
         for param in self.model.icae.parameters():
             param.requires_grad = False
         for param in self.model.icae.get_base_model().model.g_layers.parameters():
@@ -52,19 +740,14 @@ class GOFALlamaHelper(torch.nn.Module):
         if prompt is None:
             prompt = [""] * len(data)
 
-        text_input = self.model.tokenizer(data, truncation=True, max_length=self.model.training_args.model_max_length,
-                                          padding=False, return_attention_mask=False)["input_ids"]
-        text_target = \
-            self.model.tokenizer(answer, truncation=True, max_length=self.model.training_args.model_max_length,
-                                 padding=False, return_attention_mask=False)["input_ids"]
-        edge_input = \
-            self.model.tokenizer(edge_data, truncation=True, max_length=self.model.training_args.model_max_length,
-                                 padding=False, return_attention_mask=False)["input_ids"] if len(edge_data) > 0 else []
+        text_input = tokenize_texts(self.model.tokenizer, data, self.model.training_args.model_max_length).tolist()
+        text_target = tokenize_texts(self.model.tokenizer, answer, self.model.training_args.model_max_length).tolist()
+        edge_input = tokenize_texts(self.model.tokenizer, edge_data, self.model.training_args.model_max_length).tolist()
 
         text_target = [p + [self.model.tokenizer.eos_token_id] for p in text_target]
         target_ids = torch.cat([torch.tensor(p, dtype=torch.long) for p in text_target], dim=-1).to(cur_device)
 
-        prompt_input = self.model.tokenizer(prompt, add_special_tokens=False, padding=False)["input_ids"]
+        prompt_input = tokenize_texts(self.model.tokenizer, prompt, add_special_tokens=False).tolist()
         prompt_input = [[self.model.ft_token_id] + a + [self.model.ft_token_id] if len(a) > 0 else a for a in
                         prompt_input]
 
@@ -100,36 +783,50 @@ class GOFALlamaHelper(torch.nn.Module):
         return compress_outputs, target_ids, target_mask
 
     def encode(self, data, graph=None, partial_grad=None):
-        batch_size = len(data)
-        text_output = \
-        self.model.tokenizer(data, truncation=True, max_length=self.model.training_args.model_max_length, padding=False,
-                             return_attention_mask=False)["input_ids"]
-        text_output = [t + self.mem_tokens for t in text_output]
-        text_output = {"input_ids": text_output}
-        text_output = self.model.tokenizer.pad(text_output, padding=True, return_tensors="pt")["input_ids"].to(
-            self.model.memory_token_embed.weight.device)
-        mem_mask = text_output >= self.model.vocab_size
-
-        mem_mask = mem_mask.to(self.model.memory_token_embed.weight.device)
-
-        autoencoder_input_embedding = self.model.icae.get_base_model().model.embed_tokens(text_output)
-        autoencoder_input_embedding[mem_mask] = self.model.memory_token_embed(
-            text_output[mem_mask] - self.model.vocab_size).to(autoencoder_input_embedding)
+        cur_device = self.model.memory_token_embed.weight.device
+        inputs = data if isinstance(data, EncodeInputs) else self.inputs.encode(data)
+        text_ids = inputs.text_ids
+
         self.model.icae.set_adapter("encadapt")
         self.model.icae.enable_adapter_layers()
         for name, param in self.model.icae.named_parameters():
             if "encadapt" in name:
                 param.requires_grad = False
-        compress_outputs = self.model.icae(inputs_embeds=autoencoder_input_embedding, output_hidden_states=True,
-                                           graph=graph, mem_mask=mem_mask, partial_grad=partial_grad, map_node=True)
+        # the prefix store holds edge texts only, node texts start with a node id drawn for every sample
+        edge_start = len(text_ids) if graph is None else graph.num_node_feat
+        if self.prefix_store is not None and self.prefix_store.mode == "kv" and partial_grad:
+            memory_embedding = prefix_memory_embedding(self.model, text_ids.tolist(), self.prefix_store, graph=graph,
+                                                       token_budget=self.frozen_token_budget, store_start=edge_start)
+        elif (self.state_cache is not None or self.prefix_store is not None or self.frozen_token_budget) \
+                and partial_grad:
+            boundary_states, attention_mask = frozen_boundary_states(self.model, text_ids.tolist(), self.state_cache,
+                                                                     self.prefix_store, self.frozen_token_budget,
+                                                                     edge_start)
+            mem_mask = torch.zeros(attention_mask.size(), dtype=torch.bool, device=cur_device)
+            mem_mask[:, -self.mem_size:] = True
+            memory_embedding = self.model.icae.get_base_model().encode_memory(
+                inputs_embeds=boundary_states, attention_mask=attention_mask,
+                position_ids=(attention_mask.cumsum(dim=-1) - 1).clamp(min=0), graph=graph, mem_mask=mem_mask,
+                partial_grad=partial_grad, map_node=True, from_boundary=True, mem_aligned=True)
+        elif self.packed:
+            packed_ids = inputs.input_ids.to(cur_device)
+            self.padding_fraction["encode"] = padding_fraction(inputs.packed_lengths)
+            memory_embedding = self.model.icae.get_base_model().encode_memory(
+                inputs_embeds=self.model.tokens_to_embeddings(packed_ids), graph=graph,
+                mem_mask=packed_ids >= self.model.vocab_size, partial_grad=partial_grad, map_node=True,
+                packed_lengths=inputs.packed_lengths.to(cur_device))
+        else:
+            input_ids = inputs.input_ids.to(cur_device)
+            attention_mask = inputs.attention_mask.to(cur_device)
+            autoencoder_input_embedding = self.model.tokens_to_embeddings(input_ids)
+            memory_embedding = self.model.icae.get_base_model().encode_memory(
+                inputs_embeds=autoencoder_input_embedding, attention_mask=attention_mask,
+                position_ids=(attention_mask.cumsum(dim=-1) - 1).clamp(min=0), graph=graph,
+                mem_mask=input_ids >= self.model.vocab_size, partial_grad=partial_grad, map_node=True,
+                mem_aligned=True)
         self.model.icae.disable_adapter_layers()
-        compress_outputs = compress_outputs.hidden_states[-1]
         if graph is not None:
-            node_emb = compress_outputs[:len(graph.node_map)]
-            map_mem_mask = mem_mask[:graph.num_node_feat][graph.node_map]
-            memory_embedding = node_emb[map_mem_mask].view(len(node_emb), self.mem_size, -1)
-        else:
-            memory_embedding = compress_outputs[mem_mask].view(batch_size, self.mem_size, -1)
+            memory_embedding = memory_embedding[:len(graph.node_map)]
         return memory_embedding
 
     def llm_output(self, data, input, prompt=None):
@@ -163,26 +860,54 @@ class GOFALlamaHelper(torch.nn.Module):
 
         return output_emb, answer_prompt, target_mask
 
-    def decode(self, data, mem_embs, graph=None, prompt=None):
-        prompt_output = self.model.tokenizer(data, add_special_tokens=False, padding=False, truncation=True,
-                                             max_length=self.model.training_args.model_max_length)["input_ids"]
-        prompt_output = [p + [self.model.tokenizer.eos_token_id] for p in prompt_output]
-        if prompt is None:
-            prompt = [""] * len(data)
-        prompt_input = self.model.left_tokenizer(prompt, add_special_tokens=False, padding=False, truncation=True, max_length=512)["input_ids"]
-        # print(self.model.left_tokenizer.batch_decode(prompt_input))
-        prompt_input = [[self.model.ft_token_id] + a + [self.model.ft_token_id] if len(a) > 0 else a for a in
-                        prompt_input]
-        prompt_ids = [a + b for a, b in zip(prompt_input, prompt_output)]
-        prompt_mask = [[False] * len(a) + [True] * (len(b)) + [False] for a, b in zip(prompt_input, prompt_output)]
-        mem_mask = torch.tensor([[False] * (self.mem_size - 1) for _ in prompt_output], dtype=torch.long).to(mem_embs.device)
-        answer_prompt = torch.cat([torch.tensor(p, dtype=torch.long) for p in prompt_output], dim=-1).to(
-            mem_embs.device)
-        prompt_output = {"input_ids": prompt_ids, "attention_mask": prompt_mask}
-        prompt_output = self.model.tokenizer.pad(prompt_output, padding=True, return_tensors="pt")
-        prompt_answer_ids = prompt_output["input_ids"].to(mem_embs.device)
+    @torch.no_grad()
+    def decode_prefix(self, mem_embs):
+        r"""Compute the decoder prefix of the memory embeddings of every node once. Index the result with the node of
+        every prompt and pass it to decode or generate in place of the memory embeddings.
+        """
+        if self.dec_lora:
+            self.model.icae.set_adapter("default")
+            self.model.icae.enable_adapter_layers()
+        else:
+            self.model.icae.disable_adapter_layers()
+        return compute_decode_prefix(self.model, mem_embs[:, :-1], mem_embs[:, -1])
+
+    def decode(self, data, mem_embs, graph=None, prompt=None, target_only=False):
+        inputs = data if isinstance(data, DecodeInputs) else self.inputs.decode(data, prompt)
+        answer_prompt = inputs.answer_ids.to(mem_embs.device)
+        if isinstance(mem_embs, DecodePrefix):
+            if self.dec_lora:
+                self.model.icae.set_adapter("default")
+                self.model.icae.enable_adapter_layers()
+            else:
+                self.model.icae.disable_adapter_layers()
+            target_states = prefix_decoder_target_states(self.model, mem_embs, inputs.prefix_ids.tolist(),
+                                                         inputs.prefix_mask.tolist())
+            target_mask = target_length_mask(inputs.target_lengths, mem_embs.device)
+            if target_only:
+                return target_states, answer_prompt, target_mask
+            output_emb = self.model.icae.get_base_model().lm_head(target_states).float()
+            output_emb, target_mask = unpack_target_logits(output_emb, target_mask.new_ones(len(output_emb)),
+                                                           inputs.target_lengths)
+            return output_emb, answer_prompt, target_mask
+        if self.packed:
+            self.padding_fraction["decode"] = padding_fraction(inputs.packed_lengths)
+            decode_embed, packed_lengths, packed_target_mask = pack_decode_inputs(self.model, mem_embs, inputs)
+            if self.dec_lora:
+                self.model.icae.set_adapter("default")
+                self.model.icae.enable_adapter_layers()
+            else:
+                self.model.icae.disable_adapter_layers()
+            if target_only:
+                target_states = decoder_target_states(self.model, decode_embed, packed_target_mask.unsqueeze(0),
+                                                      packed_lengths)
+                return target_states, answer_prompt, target_length_mask(inputs.target_lengths, mem_embs.device)
+            output_emb = self.model.icae(inputs_embeds=decode_embed, packed_lengths=packed_lengths).logits
+            output_emb, target_mask = unpack_target_logits(output_emb, packed_target_mask, inputs.target_lengths)
+            return output_emb, answer_prompt, target_mask
+        prompt_answer_ids = inputs.input_ids.to(mem_embs.device)
         special_prompt = prompt_answer_ids >= self.model.vocab_size
-        target_mask = torch.cat([mem_mask, prompt_output["attention_mask"].to(mem_mask)], dim=-1).to(torch.bool)
+        target_mask = inputs.target_mask.to(mem_embs.device)
         prompt_answer_embs = self.model.icae.get_base_model().model.embed_tokens(prompt_answer_ids)
         prompt_answer_embs[special_prompt] = self.model.memory_token_embed(
             prompt_answer_ids[special_prompt] - self.model.vocab_size).to(prompt_answer_embs)
@@ -192,81 +917,88 @@ class GOFALlamaHelper(torch.nn.Module):
             self.model.icae.enable_adapter_layers()
         else:
             self.model.icae.disable_adapter_layers()
+        if target_only:
+            return decoder_target_states(self.model, decode_embed, target_mask), answer_prompt, target_mask
         output_emb = self.model.icae(inputs_embeds=decode_embed).logits
 
         return output_emb, answer_prompt, target_mask
 
-    def generate(self, mem_embs, graph=None, prompt=None):
+    def generate_inputs(self, mem_embs, prompt=None):
+        r"""Left-padded decoder inputs of generate, returned as input embeddings, attention mask and the prefix cache
+        if mem_embs is a DecodePrefix, and activate the decoder adapter.
+        """
         if prompt is None:
             prompt = [""] * len(mem_embs)
-        prompt_input = self.model.tokenizer(prompt, add_special_tokens=False, padding=False)["input_ids"]
+        prompt_input = tokenize_texts(self.model.tokenizer, prompt, add_special_tokens=False).tolist()
         prompt_ids = [[self.model.ft_token_id] + a + [self.model.ft_token_id] if len(a) > 0 else a for a in
                       prompt_input]
 
-        mem_mask = [[True] * self.mem_size + [False] * len(a) for a in prompt_ids]
-        att_mask = [[True] * (self.mem_size + len(a)) for a in prompt_ids]
-        prompt_ids = [[self.model.tokenizer.pad_token_id] * self.mem_size + a for a in prompt_ids]
-        input_prompt_ids = self.model.left_tokenizer.pad({"input_ids": prompt_ids, "attention_mask": mem_mask},
-                                                         padding=True, return_tensors="pt")
-        mem_mask = input_prompt_ids["attention_mask"].to(device=mem_embs.device, dtype=torch.bool)
-
-        input_prompt_ids = self.model.left_tokenizer.pad({"input_ids": prompt_ids, "attention_mask": att_mask},
-                                                         padding=True, return_tensors="pt")
+        prefix_cache = None
+        if isinstance(mem_embs, DecodePrefix):
+            decode_embed, att_mask, prefix_cache = prefix_generate_inputs(
+                self.model, mem_embs, [[self.model.tokenizer.pad_token_id] + a for a in prompt_ids],
+                self.model.tokenizer.pad_token_id)
+        else:
+            mem_mask = [[True] * self.mem_size + [False] * len(a) for a in prompt_ids]
+            att_mask = [[True] * (self.mem_size + len(a)) for a in prompt_ids]
+            prompt_ids = [[self.model.tokenizer.pad_token_id] * self.mem_size + a for a in prompt_ids]
+            input_prompt_ids = self.model.left_tokenizer.pad({"input_ids": prompt_ids, "attention_mask": mem_mask},
+                                                             padding=True, return_tensors="pt")
+            mem_mask = input_prompt_ids["attention_mask"].to(device=mem_embs.device, dtype=torch.bool)
 
-        prompt_ids = input_prompt_ids["input_ids"]
-        att_mask = input_prompt_ids["attention_mask"].to(device=mem_embs.device)
+            input_prompt_ids = self.model.left_tokenizer.pad({"input_ids": prompt_ids, "attention_mask": att_mask},
+                                                             padding=True, return_tensors="pt")
 
-        prompt_answer_ids = prompt_ids.to(device=mem_embs.device, dtype=torch.long)
-        special_prompt = prompt_answer_ids >= self.model.vocab_size
-        prompt_answer_embs = self.model.icae.get_base_model().model.embed_tokens(prompt_answer_ids)
-        prompt_answer_embs[special_prompt] = self.model.memory_token_embed(
-            prompt_answer_ids[special_prompt] - self.model.vocab_size).to(prompt_answer_embs)
+            prompt_ids = input_prompt_ids["input_ids"]
+            att_mask = input_prompt_ids["attention_mask"].to(device=mem_embs.device)
 
-        prompt_answer_embs[mem_mask] = mem_embs.view(-1, mem_embs.size()[-1])
+            prompt_answer_ids = prompt_ids.to(device=mem_embs.device, dtype=torch.long)
+            special_prompt = prompt_answer_ids >= self.model.vocab_size
+            prompt_answer_embs = self.model.icae.get_base_model().model.embed_tokens(prompt_answer_ids)
+            prompt_answer_embs[special_prompt] = self.model.memory_token_embed(
+                prompt_answer_ids[special_prompt] - self.model.vocab_size).to(prompt_answer_embs)
 
-        # decode_embed = torch.cat([mem_embs.to(prompt_answer_embs), prompt_answer_embs], dim=1)
-        decode_embed = prompt_answer_embs
-        output = decode_embed.clone()
+            prompt_answer_embs[mem_mask] = mem_embs.view(-1, mem_embs.size()[-1])
 
-        generate_text = []
-        eos_reached = torch.zeros(len(output), dtype=torch.bool).to(output.device)
+            # decode_embed = torch.cat([mem_embs.to(prompt_answer_embs), prompt_answer_embs], dim=1)
+            decode_embed = prompt_answer_embs
 
-        past_key_values = None
         if self.dec_lora:
             self.model.icae.set_adapter("default")
             self.model.icae.enable_adapter_layers()
         else:
             self.model.icae.disable_adapter_layers()
-        for i in range(128):
-            out = self.model.icae(inputs_embeds=output, attention_mask=att_mask, past_key_values=past_key_values,
-                                 use_cache=True)
-
-            logits = out.logits[:, -1]
+        return decode_embed, att_mask, prefix_cache
 
-            past_key_values = out.past_key_values
-
-            next_token_id = torch.argmax(logits, dim=-1, keepdim=True)
-
-            eos_reached = torch.logical_or(eos_reached, (next_token_id == self.model.tokenizer.eos_token_id).view(-1))
-
-            eos_reached = torch.logical_or(eos_reached, (next_token_id == self.model.tokenizer.bos_token_id).view(-1))
-
-            eos_reached = torch.logical_or(eos_reached, (next_token_id >= 32000).view(-1))
-            generate_text.append(next_token_id.view(-1, 1))
-            if torch.all(eos_reached):
-                break
-
-            output = self.model.icae.get_base_model().model.embed_tokens(next_token_id).to(mem_embs.device)
-
-            att_mask = torch.cat(
-                [att_mask, torch.ones((len(att_mask), 1), dtype=att_mask.dtype, device=att_mask.device)], dim=-1)
-        generate_text = torch.cat(generate_text, dim=-1)
+    def generate(self, mem_embs, graph=None, prompt=None):
+        decode_embed, att_mask, prefix_cache = self.generate_inputs(mem_embs, prompt)
+        stop_token_ids = [self.model.tokenizer.eos_token_id, self.model.tokenizer.bos_token_id]
+        drafter = graph_drafter(self.model.tokenizer, graph, self.speculative_draft_tokens,
+                                self.speculative_ngram_size)
+        if drafter is not None:
+            generate_text = speculative_generate(self.model, decode_embed, att_mask, stop_token_ids, drafter,
+                                                 max_token_id=32000, prefix_cache=prefix_cache)
+        else:
+            generate_text = greedy_generate(self.model, decode_embed, att_mask, stop_token_ids, max_token_id=32000,
+                                            prefix_cache=prefix_cache)
         generate_text[generate_text >= 32000] = 1
 
-        generated_text = self.model.tokenizer.batch_decode(generate_text)
+        generated_text = batch_decode_ragged(self.model.tokenizer, generate_text.view(-1),
+                                             [generate_text.size(1)] * len(generate_text), stop_token_ids)
 
         return generated_text
 
+    def stream_generate(self, mem_embs, prompt=None):
+        r"""Greedy generation like generate, yielding the token ids of shape (batch_size,) of every step as soon as
+        they are generated.
+        """
+        decode_embed, att_mask, prefix_cache = self.generate_inputs(mem_embs, prompt)
+        stop_token_ids = [self.model.tokenizer.eos_token_id, self.model.tokenizer.bos_token_id]
+        for token_ids in greedy_steps(self.model, decode_embed, att_mask, stop_token_ids, max_token_id=32000,
+                                      prefix_cache=prefix_cache):
+            token_ids[token_ids >= 32000] = 1
+            yield token_ids
+
 
 class GOFAMistralHelper(torch.nn.Module):
     def __init__(self, transformer_args):
@@ -283,8 +1015,20 @@ class GOFAMistralHelper(torch.nn.Module):
         self.mem_tokens = list(range(model.vocab_size, model.vocab_size + model_args.mem_size))
         self.mem_size = model_args.mem_size
         self.model = model
+        self.state_cache = build_state_cache(model_args, model, model_args.mistral_pretrain_checkpoint)
+        self.prefix_store = build_prefix_store(model_args, model, model_args.mistral_pretrain_checkpoint)
+        self.graph_cache = build_graph_cache(model_args, model, model_args.mistral_pretrain_checkpoint)
+        self.frozen_token_budget = getattr(model_args, "frozen_token_budget", 0)
+        self.packed = getattr(model_args, "packed_sequences", False)
+        self.loss_chunk_size = getattr(model_args, "loss_chunk_size", 0)
+        self.speculative_draft_tokens = getattr(model_args, "speculative_draft_tokens", 0)
+        self.speculative_ngram_size = getattr(model_args, "speculative_ngram_size", 3)
+        self.padding_fraction = {}
         self.model.tokenizer.pad_token = self.model.tokenizer.eos_token
         self.model.left_tokenizer.pad_token = self.model.left_tokenizer.bos_token
+        self.inputs = GOFAMistralInputs(self.model.tokenizer, self.model.left_tokenizer,
+                                        self.model.training_args.model_max_length, self.mem_tokens,
+                                        self.model.ft_token_id, self.packed)
         for param in self.model.icae.parameters():
             param.requires_grad = False
         for param in self.model.icae.get_base_model().model.g_layers.parameters():
@@ -308,20 +1052,14 @@ class GOFAMistralHelper(torch.nn.Module):
         if prompt is None:
             prompt = [""] * len(data)
 
-        text_input = \
-            self.model.tokenizer(data, truncation=True, max_length=5120, padding=False, return_attention_mask=False)[
-                "input_ids"]
-        text_target = \
-            self.model.tokenizer(answer, truncation=True, max_length=self.model.training_args.model_max_length,
-                                 padding=False, return_attention_mask=False)["input_ids"]
-        edge_input = \
-            self.model.tokenizer(edge_data, truncation=True, max_length=self.model.training_args.model_max_length,
-                                 padding=False, return_attention_mask=False)["input_ids"] if len(edge_data) > 0 else []
+        text_input = tokenize_texts(self.model.tokenizer, data, 5120).tolist()
+        text_target = tokenize_texts(self.model.tokenizer, answer, self.model.training_args.model_max_length).tolist()
+        edge_input = tokenize_texts(self.model.tokenizer, edge_data, self.model.training_args.model_max_length).tolist()
 
         text_target = [p + [self.model.tokenizer.eos_token_id] for p in text_target]
         target_ids = torch.cat([torch.tensor(p, dtype=torch.long) for p in text_target], dim=-1).to(cur_device)
 
-        prompt_input = self.model.tokenizer(prompt, add_special_tokens=False, padding=False)["input_ids"]
+        prompt_input = tokenize_texts(self.model.tokenizer, prompt, add_special_tokens=False).tolist()
         prompt_left_ids = [[1, 733, 16289, 28793]]
         prompt_right_ids = [[self.model.ft_token_id] + a + [733, 28748, 16289, 28793] if len(a) > 0 else a for a in
                             prompt_input]
@@ -366,94 +1104,131 @@ class GOFAMistralHelper(torch.nn.Module):
 
     def encode(self, data, graph=None, partial_grad=None):
         cur_device = self.model.memory_token_embed.weight.device
-        batch_size = len(data)
-        text_output = \
-        self.model.tokenizer(data, truncation=True, max_length=self.model.training_args.model_max_length, padding=False,
-                             return_attention_mask=False)["input_ids"]
-
-        text_output = [t + self.mem_tokens for t in text_output]
-        text_output = {"input_ids": text_output}
-        text_output = self.model.tokenizer.pad(text_output, padding=True, return_tensors="pt")["input_ids"].to(
-            cur_device)
-        mem_mask = text_output >= self.model.vocab_size
-
-        mem_mask = mem_mask.to(cur_device)
-        autoencoder_input_embedding = self.model.tokens_to_embeddings(text_output)
+        inputs = data if isinstance(data, EncodeInputs) else self.inputs.encode(data)
+        text_ids = inputs.text_ids
 
         self.model.icae.set_adapter("encadapt")
         self.model.icae.enable_adapter_layers()
         for name, param in self.model.icae.named_parameters():
             if "encadapt" in name:
                 param.requires_grad = False
-        compress_outputs = self.model.icae(inputs_embeds=autoencoder_input_embedding, output_hidden_states=True,
-                                           graph=graph, mem_mask=mem_mask, partial_grad=partial_grad, map_node=True)
+        # the prefix store holds edge texts only, node texts start with a node id drawn for every sample
+        edge_start = len(text_ids) if graph is None else graph.num_node_feat
+        if self.prefix_store is not None and self.prefix_store.mode == "kv" and partial_grad:
+            memory_embedding = prefix_memory_embedding(self.model, text_ids.tolist(), self.prefix_store, graph=graph,
+                                                       token_budget=self.frozen_token_budget, store_start=edge_start)
+        elif (self.state_cache is not None or self.prefix_store is not None or self.frozen_token_budget) \
+                and partial_grad:
+            boundary_states, attention_mask = frozen_boundary_states(self.model, text_ids.tolist(), self.state_cache,
+                                                                     self.prefix_store, self.frozen_token_budget,
+                                                                     edge_start)
+            mem_mask = torch.zeros(attention_mask.size(), dtype=torch.bool, device=cur_device)
+            mem_mask[:, -self.mem_size:] = True
+            memory_embedding = self.model.icae.get_base_model().encode_memory(
+                inputs_embeds=boundary_states, attention_mask=attention_mask,
+                position_ids=(attention_mask.cumsum(dim=-1) - 1).clamp(min=0), graph=graph, mem_mask=mem_mask,
+                partial_grad=partial_grad, map_node=True, from_boundary=True, mem_aligned=True)
+        elif self.packed:
+            packed_ids = inputs.input_ids.to(cur_device)
+            self.padding_fraction["encode"] = padding_fraction(inputs.packed_lengths)
+            memory_embedding = self.model.icae.get_base_model().encode_memory(
+                inputs_embeds=self.model.tokens_to_embeddings(packed_ids), graph=graph,
+                mem_mask=packed_ids >= self.model.vocab_size, partial_grad=partial_grad, map_node=True,
+                packed_lengths=inputs.packed_lengths.to(cur_device))
+        else:
+            input_ids = inputs.input_ids.to(cur_device)
+            attention_mask = inputs.attention_mask.to(cur_device)
+            autoencoder_input_embedding = self.model.tokens_to_embeddings(input_ids)
+            memory_embedding = self.model.icae.get_base_model().encode_memory(
+                inputs_embeds=autoencoder_input_embedding, attention_mask=attention_mask,
+                position_ids=(attention_mask.cumsum(dim=-1) - 1).clamp(min=0), graph=graph,
+                mem_mask=input_ids >= self.model.vocab_size, partial_grad=partial_grad, map_node=True,
+                mem_aligned=True)
         self.model.icae.disable_adapter_layers()
-        compress_outputs = compress_outputs.hidden_states[-1]
-
         if graph is not None:
-            node_emb = compress_outputs[:len(graph.node_map)]
-            map_mem_mask = mem_mask[:graph.num_node_feat][graph.node_map]
-            memory_embedding = node_emb[map_mem_mask].view(len(node_emb), self.mem_size, -1)
-        else:
-            memory_embedding = compress_outputs[mem_mask].view(batch_size, self.mem_size, -1)
+            memory_embedding = memory_embedding[:len(graph.node_map)]
         return memory_embedding
 
-    def decode(self, data, mem_embs, graph=None, prompt=None):
-        prompt_output = self.model.tokenizer(data, add_special_tokens=False, padding=False, truncation=True,
-                                             max_length=self.model.training_args.model_max_length)["input_ids"]
-        prompt_output = [p + [self.model.tokenizer.eos_token_id] for p in prompt_output]
-        original_prompt_output = prompt_output
-
-        if prompt is None:
-            prompt = [""] * len(data)
-        prompt_input = self.model.left_tokenizer(prompt, add_special_tokens=False, padding=False, truncation=True, max_length=512)["input_ids"]
-        batch_size = len(prompt_input)
-
-        # For Mistral, decode contains: prefix, memory slots and suffix
-        prompt_left_ids = [[1, 733, 16289, 28793] if len(a) > 0 else [] for a in prompt_input]
-        prompt_right_ids = [[self.model.ft_token_id] + a + [733, 28748, 16289, 28793] if len(a) > 0 else a for a in
-                            prompt_input]
-        prompt_ids = [a + [self.model.tokenizer.pad_token_id] * self.mem_size + b + c for a, b, c in
-                      zip(prompt_left_ids, prompt_right_ids, prompt_output)]
-        prompt_mask = [
-            [False] * (len(prompt_left_ids[i]) + self.mem_size - 1 + len(prompt_right_ids[i])) + [True] * len(
-                prompt_output[i]) + [False] for i in range(batch_size)]
-
-        answer_prompt = torch.cat([torch.tensor(p, dtype=torch.long) for p in prompt_output], dim=-1).to(
-            mem_embs.device)
-
-        prompt_output = {"input_ids": prompt_ids, "attention_mask": prompt_mask}
-        prompt_output = self.model.tokenizer.pad(prompt_output, padding=True, return_tensors="pt")
-        prompt_answer_ids = prompt_output["input_ids"].to(mem_embs.device)
+    @torch.no_grad()
+    def decode_prefix(self, mem_embs):
+        r"""Compute the decoder prefix of the memory embeddings of every node once. Index the result with the node of
+        every prompt and pass it to decode or generate in place of the memory embeddings. The prefix starts with the
+        instruction tokens, so it can only be used with non-empty prompts.
+        """
+        if self.dec_lora:
+            self.model.icae.set_adapter("default")
+            self.model.icae.enable_adapter_layers()
+        else:
+            self.model.icae.disable_adapter_layers()
+        prefix_left_ids = torch.tensor([[1, 733, 16289, 28793]], dtype=torch.long, device=mem_embs.device)
+        prefix_embeds = self.model.tokens_to_embeddings(prefix_left_ids).expand(len(mem_embs), -1, -1)
+        prefix_embeds = torch.cat([prefix_embeds, mem_embs[:, :-1].to(prefix_embeds)], dim=1)
+        return compute_decode_prefix(self.model, prefix_embeds, mem_embs[:, -1])
+
+    def decode(self, data, mem_embs, graph=None, prompt=None, target_only=False):
+        inputs = data if isinstance(data, DecodeInputs) else self.inputs.decode(data, prompt)
+        answer_prompt = inputs.answer_ids.to(mem_embs.device)
+
+        if isinstance(mem_embs, DecodePrefix):
+            if not inputs.has_prompt.all():
+                raise ValueError("Decode prefixes of Mistral start with the instruction tokens and need a prompt.")
+            if self.dec_lora:
+                self.model.icae.set_adapter("default")
+                self.model.icae.enable_adapter_layers()
+            else:
+                self.model.icae.disable_adapter_layers()
+            target_states = prefix_decoder_target_states(self.model, mem_embs, inputs.prefix_ids.tolist(),
+                                                         inputs.prefix_mask.tolist())
+            target_mask = target_length_mask(inputs.target_lengths, mem_embs.device)
+            if target_only:
+                return target_states, answer_prompt, target_mask
+            output_emb = self.model.icae.get_base_model().lm_head(target_states).float()
+            output_emb, target_mask = unpack_target_logits(output_emb, target_mask.new_ones(len(output_emb)),
+                                                           inputs.target_lengths)
+            return output_emb, answer_prompt, target_mask
+
+        if self.packed:
+            self.padding_fraction["decode"] = padding_fraction(inputs.packed_lengths)
+            decode_embed, packed_lengths, packed_target_mask = pack_decode_inputs(self.model, mem_embs, inputs)
+            if self.dec_lora:
+                self.model.icae.set_adapter("default")
+                self.model.icae.enable_adapter_layers()
+            else:
+                self.model.icae.disable_adapter_layers()
+            if target_only:
+                target_states = decoder_target_states(self.model, decode_embed, packed_target_mask.unsqueeze(0),
+                                                      packed_lengths)
+                return target_states, answer_prompt, target_length_mask(inputs.target_lengths, mem_embs.device)
+            output_emb = self.model.icae(inputs_embeds=decode_embed, packed_lengths=packed_lengths).logits
+            output_emb, target_mask = unpack_target_logits(output_emb, packed_target_mask, inputs.target_lengths)
+            return output_emb, answer_prompt, target_mask
+
+        prompt_answer_ids = inputs.input_ids.to(mem_embs.device)
         prompt_answer_embs = self.model.tokens_to_embeddings(prompt_answer_ids)
+        prompt_answer_embs[inputs.mem_mask.to(mem_embs.device)] = mem_embs.view(-1, mem_embs.size()[-1])
 
-        mem_mask = [[False] * len(prompt_left_ids[i]) + [True] * self.mem_size + [False] * (
-                len(prompt_output["input_ids"][i]) - len(prompt_left_ids[i]) - self.mem_size) for i in
-                    range(batch_size)]
-        prompt_mask = [
-            [False] * (len(prompt_left_ids[i]) + self.mem_size - 1 + len(prompt_right_ids[i])) + [True] * len(
-                original_prompt_output[i]) + [False] * (1 + len(prompt_output["input_ids"][i]) - len(prompt_ids[i])) for
-            i in range(batch_size)]
-
-        prompt_answer_embs[torch.tensor(mem_mask)] = mem_embs.view(-1, mem_embs.size()[-1])
-
-        target_mask = torch.tensor(prompt_mask, dtype=torch.long, device=mem_embs.device).to(torch.bool)
+        target_mask = inputs.target_mask.to(mem_embs.device)
 
         if self.dec_lora:
             self.model.icae.set_adapter("default")
             self.model.icae.enable_adapter_layers()
         else:
             self.model.icae.disable_adapter_layers()
+        if target_only:
+            return decoder_target_states(self.model, prompt_answer_embs, target_mask), answer_prompt, target_mask
         output_emb = self.model.icae(inputs_embeds=prompt_answer_embs).logits
 
         return output_emb, answer_prompt, target_mask
 
-    def generate(self, mem_embs, graph=None, prompt=None):
+    def generate_inputs(self, mem_embs, prompt=None):
+        r"""Left-padded decoder inputs of generate, returned as input embeddings, attention mask and the prefix cache
+        if mem_embs is a DecodePrefix, and activate the decoder adapter.
+        """
         cur_device = self.model.memory_token_embed.weight.device
 
         if prompt is None:
             prompt = [""] * len(mem_embs)
-        prompt_input = self.model.tokenizer(prompt, add_special_tokens=False, padding=False)["input_ids"]
+        prompt_input = tokenize_texts(self.model.tokenizer, prompt, add_special_tokens=False).tolist()
         batch_size = len(prompt_input)
 
         prompt_left_ids = [[1, 733, 16289, 28793] if len(a) > 0 else [] for a in prompt_input]
@@ -461,70 +1236,72 @@ class GOFAMistralHelper(torch.nn.Module):
         prompt_right_ids = [[self.model.ft_token_id] + a + [733, 28748, 16289, 28793] if len(a) > 0 else a for a in
                             prompt_input]
 
-        mem_mask = [[False] * len(prompt_left_ids[i]) + [True] * self.mem_size + [False] * len(prompt_right_ids[i]) for
-                    i in range(batch_size)]
-        att_mask = [[True] * (len(prompt_left_ids[i]) + self.mem_size + len(prompt_right_ids[i])) for i in
-                    range(batch_size)]
-        prompt_ids = [prompt_left_ids[i] + [self.model.tokenizer.pad_token_id] * self.mem_size + prompt_right_ids[i] for
-                      i in range(batch_size)]
-
-        input_prompt_ids = self.model.left_tokenizer.pad({"input_ids": prompt_ids, "attention_mask": mem_mask},
-                                                         padding=True, return_tensors="pt")
-        mem_mask = input_prompt_ids["attention_mask"].to(device=mem_embs.device, dtype=torch.bool)
+        prefix_cache = None
+        if isinstance(mem_embs, DecodePrefix):
+            if min(len(a) for a in prompt_input) == 0:
+                raise ValueError("Decode prefixes of Mistral start with the instruction tokens and need a prompt.")
+            decode_embed, att_mask, prefix_cache = prefix_generate_inputs(
+                self.model, mem_embs, [[self.model.tokenizer.pad_token_id] + b for b in prompt_right_ids],
+                self.model.tokenizer.pad_token_id)
+        else:
+            mem_mask = [[False] * len(prompt_left_ids[i]) + [True] * self.mem_size + [False] * len(prompt_right_ids[i])
+                        for i in range(batch_size)]
+            att_mask = [[True] * (len(prompt_left_ids[i]) + self.mem_size + len(prompt_right_ids[i])) for i in
+                        range(batch_size)]
+            prompt_ids = [prompt_left_ids[i] + [self.model.tokenizer.pad_token_id] * self.mem_size +
+                          prompt_right_ids[i] for i in range(batch_size)]
 
-        input_prompt_ids = self.model.left_tokenizer.pad({"input_ids": prompt_ids, "attention_mask": att_mask},
-                                                         padding=True, return_tensors="pt")
-        prompt_ids = input_prompt_ids["input_ids"]
-        att_mask = input_prompt_ids["attention_mask"].to(device=mem_embs.device)
+            input_prompt_ids = self.model.left_tokenizer.pad({"input_ids": prompt_ids, "attention_mask": mem_mask},
+                                                             padding=True, return_tensors="pt")
+            mem_mask = input_prompt_ids["attention_mask"].to(device=mem_embs.device, dtype=torch.bool)
 
-        prompt_answer_ids = prompt_ids.to(device=mem_embs.device, dtype=torch.long)
-        prompt_answer_embs = self.model.tokens_to_embeddings(prompt_answer_ids)
-        prompt_answer_embs[mem_mask] = mem_embs.view(-1, mem_embs.size()[-1])
+            input_prompt_ids = self.model.left_tokenizer.pad({"input_ids": prompt_ids, "attention_mask": att_mask},
+                                                             padding=True, return_tensors="pt")
+            prompt_ids = input_prompt_ids["input_ids"]
+            att_mask = input_prompt_ids["attention_mask"].to(device=mem_embs.device)
 
-        decode_embed = prompt_answer_embs
-        output = decode_embed.clone()
+            prompt_answer_ids = prompt_ids.to(device=mem_embs.device, dtype=torch.long)
+            prompt_answer_embs = self.model.tokens_to_embeddings(prompt_answer_ids)
+            prompt_answer_embs[mem_mask] = mem_embs.view(-1, mem_embs.size()[-1])
 
-        generate_text = []
-        eos_reached = torch.zeros(len(output), dtype=torch.bool).to(output.device)
+            decode_embed = prompt_answer_embs
 
-        past_key_values = None
         if self.dec_lora:
             self.model.icae.set_adapter("default")
             self.model.icae.enable_adapter_layers()
         else:
             self.model.icae.disable_adapter_layers()
-        for i in range(128):
-            out = self.model.icae(inputs_embeds=output, attention_mask=att_mask, past_key_values=past_key_values,
-                                 use_cache=True)
+        return decode_embed, att_mask, prefix_cache
 
-            logits = out.logits[:, -1, :self.model.vocab_size - 1]
-
-            past_key_values = out.past_key_values
-
-            next_token_id = torch.argmax(logits, dim=-1, keepdim=True)
-
-            eos_reached = torch.logical_or(eos_reached, (next_token_id == self.model.tokenizer.eos_token_id).view(-1))
-
-            # eos_reached = torch.logical_or(eos_reached, (next_token_id==self.model.tokenizer.bos_token_id).view(-1))
-
-            # eos_reached = torch.logical_or(eos_reached, (next_token_id>=32000).view(-1))
-
-            output = self.model.icae.get_base_model().model.embed_tokens(next_token_id).to(mem_embs.device)
-
-            generate_text.append(next_token_id.view(-1, 1))
-            att_mask = torch.cat(
-                [att_mask, torch.ones((len(att_mask), 1), dtype=att_mask.dtype, device=att_mask.device)], dim=-1)
-
-            if torch.all(eos_reached):
-                break
-
-        generate_text = torch.cat(generate_text, dim=-1)
+    def generate(self, mem_embs, graph=None, prompt=None):
+        decode_embed, att_mask, prefix_cache = self.generate_inputs(mem_embs, prompt)
+        stop_token_ids = [self.model.tokenizer.eos_token_id]
+        drafter = graph_drafter(self.model.tokenizer, graph, self.speculative_draft_tokens,
+                                self.speculative_ngram_size)
+        if drafter is not None:
+            generate_text = speculative_generate(self.model, decode_embed, att_mask, stop_token_ids, drafter,
+                                                 num_logits=self.model.vocab_size - 1, prefix_cache=prefix_cache)
+        else:
+            generate_text = greedy_generate(self.model, decode_embed, att_mask, stop_token_ids,
+                                            num_logits=self.model.vocab_size - 1, prefix_cache=prefix_cache)
         generate_text[generate_text >= 32000] = 1
 
-        generated_text = self.model.tokenizer.batch_decode(generate_text)
+        generated_text = batch_decode_ragged(self.model.tokenizer, generate_text.view(-1),
+                                             [generate_text.size(1)] * len(generate_text), stop_token_ids)
 
         return generated_text
 
+    def stream_generate(self, mem_embs, prompt=None):
+        r"""Greedy generation like generate, yielding the token ids of shape (batch_size,) of every step as soon as
+        they are generated.
+        """
+        decode_embed, att_mask, prefix_cache = self.generate_inputs(mem_embs, prompt)
+        stop_token_ids = [self.model.tokenizer.eos_token_id]
+        for token_ids in greedy_steps(self.model, decode_embed, att_mask, stop_token_ids,
+                                      num_logits=self.model.vocab_size - 1, prefix_cache=prefix_cache):
+            token_ids[token_ids >= 32000] = 1
+            yield token_ids
+
 
 class LlamaHelper(torch.nn.Module):
     def __init__(self, transformer_args):
@@ -1,4 +1,6 @@
-from collections import namedtuple, OrderedDict
+from collections import namedtuple, OrderedDict, Counter
+from functools import partial
+from types import SimpleNamespace
 from xml.dom.minidom import Entity
 
 import torch
@@ -9,11 +11,14 @@ from docutils.nodes import target
 from numpy.core.defchararray import startswith
 # from termcolor import cprint
 import re
+from torch_geometric.utils import k_hop_subgraph
 
 from gp.nn.models.GNN import MultiLayerMessagePassing
 from gp.nn.layer.pyg import RGCNEdgeConv
 from gp.nn.layer.pyg import TransformerConv as MConv
-from .helper import GOFALlamaHelper, GOFAMistralHelper, LlamaHelper
+from .helper import GOFALlamaHelper, GOFAMistralHelper, LlamaHelper, IncrementalDetokenizer, batch_decode_ragged
+from modules.gofa_modeling import ChunkedCrossEntropy
+from .token_ids import RaggedArray
 
 LLM_DIM_DICT = {"ST": 768, "BERT": 768, "e5": 1024, "llama2_7b": 4096, "llama2_13b": 5120, "mamba": 768, "icae": 4096,
                 "icae_mem": 4096}
@@ -83,6 +88,72 @@ def get_edge_text(g, edge_index, node_ids):
     return edge_text + '. '
 
 
+def graph_token_ids(g):
+    r"""Token ids of the node texts followed by the edge texts of g if its batch was tokenized by the task wrapper,
+    else None.
+    """
+    if getattr(g, "x_ids", None) is None:
+        return None
+    if g.edge_attr is None:
+        return g.x_ids
+    return RaggedArray.concat([g.x_ids, g.edge_attr_ids])
+
+
+def answer_token_ids(g, answer_texts):
+    r"""Token ids of the answers of g if its batch was tokenized by the task wrapper, else answer_texts."""
+    if getattr(g, "answer_ids", None) is None:
+        return answer_texts
+    return g.answer_ids[g.answer_map.cpu().numpy()]
+
+
+def question_token_ids(g, prompt_texts):
+    r"""Token ids of the prompts of g if its batch was tokenized by the task wrapper, else prompt_texts. Prompts that
+    are empty in prompt_texts are empty in the ids too.
+    """
+    if getattr(g, "question_ids", None) is None:
+        return prompt_texts
+    return g.question_ids[g.question_map.cpu().numpy()].clear_rows([len(p) == 0 for p in prompt_texts])
+
+
+def decode_prompt_texts(g):
+    r"""Questions of g in the order of its answers. Sentence completion questions are decoded without prompt."""
+    prompt_texts = g.question[g.question_map.cpu().numpy()].tolist()
+    return ["" if p.startswith("Please complete the sentence") else p for p in prompt_texts]
+
+
+def attach_model_inputs(g, inputs):
+    r"""Tokenize the texts of the GOFA batch g and attach the encoder and decoder inputs built by inputs, the
+    GOFAInputs of the helper, as g.encode_inputs and g.decode_inputs. Used as the collate transform of the task
+    wrappers, so that tokenization and the assembly of the input tensors run in the DataLoader workers.
+    """
+    inputs.tokenize_graph(g)
+    g.encode_inputs = inputs.encode(graph_token_ids(g))
+    g.decode_inputs = inputs.decode(answer_token_ids(g, None), question_token_ids(g, decode_prompt_texts(g)))
+    return g
+
+
+def graph_edge_texts(edge_index, edge_texts):
+    edge_texts = [None] * edge_index.size(-1) if edge_texts is None else edge_texts.tolist()
+    return Counter(zip(edge_index[0].tolist(), edge_index[1].tolist(), edge_texts))
+
+
+def changed_nodes(prev_node_texts, prev_edges, node_texts, edges):
+    r"""Nodes of the new graph whose text or incoming edges differ from the previous graph. Nodes are matched by
+    index and edges, given as counters of (source, target, text), by their source, target and text.
+    """
+    num_common = min(len(prev_node_texts), len(node_texts))
+    changed = np.ones(len(node_texts), dtype=bool)
+    changed[:num_common] = prev_node_texts[:num_common] != node_texts[:num_common]
+    for _, dst, _ in (prev_edges - edges) + (edges - prev_edges):
+        if dst < len(node_texts):
+            changed[dst] = True
+    return np.nonzero(changed)[0]
+
+
+def unique_texts(texts):
+    unique_text, text_map = np.unique(texts, return_inverse=True)
+    return unique_text, torch.from_numpy(text_map.reshape(-1)).long()
+
 
 class GOFA(torch.nn.Module):
     def __init__(self, transformer_args, mode="autoencoder", base_llm="llama7b", save_dir=""):
@@ -90,6 +161,8 @@ class GOFA(torch.nn.Module):
 
         self.mode = mode
         self.save_dir = save_dir
+        # incremented whenever the weights change, cached memory embeddings are only served for the current version
+        self.weights_version = 0
 
         if base_llm == 'llama7b':
             self.llm_model = GOFALlamaHelper(transformer_args)
@@ -106,6 +179,9 @@ class GOFA(torch.nn.Module):
         elif mode == "autoencodergen":
             self.encode = self.auto_encode
             self.decode = self.auto_generate
+        elif mode == "autoencoderscore":
+            self.encode = self.auto_encode
+            self.decode = self.auto_score
         elif mode == "direct":
             self.encode = self.direct_decode
             self.decode = lambda x: x
@@ -122,6 +198,12 @@ class GOFA(torch.nn.Module):
             # TODO: not implemented
             raise NotImplementedError(mode + " mode not implemented")
 
+    def batch_transform(self):
+        r"""Collate transform that builds the encoder and decoder inputs of this model in the DataLoader workers, to be
+        passed to the set_batch_transform of the task wrappers.
+        """
+        return partial(attach_model_inputs, inputs=self.llm_model.inputs)
+
     def llm_decode(self, g):
         # For finetuning LLM using sentence completion task
         text_inputs = g.x[g.node_map.cpu().numpy()][g.question_index.cpu().numpy()].tolist()
@@ -196,20 +278,96 @@ class GOFA(torch.nn.Module):
             text_inputs = np.concatenate([g.x, g.edge_attr], axis=0)
         else:
             text_inputs = g.x
-        llm_output = self.llm_model.encode(text_inputs.tolist(), graph=g, partial_grad=True)
+        encode_inputs = getattr(g, "encode_inputs", None)
+        if encode_inputs is None:
+            encode_inputs = graph_token_ids(g)
+        if encode_inputs is None:
+            encode_inputs = text_inputs.tolist()
+        graph_cache = getattr(self.llm_model, "graph_cache", None)
+        if graph_cache is not None and not torch.is_grad_enabled():
+            # without gradients, the memory embeddings of a graph seen before are read from the cache
+            key = graph_cache.key(g, self.llm_model.model.icae.get_base_model().model.g_layers, self.weights_version)
+            llm_output = graph_cache.get(key)
+            if llm_output is None:
+                llm_output = self.llm_model.encode(encode_inputs, graph=g, partial_grad=True)
+                llm_output = llm_output[:g.node_map.size(-1)]
+                graph_cache.put(key, llm_output)
+            else:
+                llm_output = llm_output.to(g.edge_index.device)
+        else:
+            llm_output = self.llm_model.encode(encode_inputs, graph=g, partial_grad=True)
+        # kept as the draft source of speculative decoding in auto_generate
+        g.graph_texts = text_inputs
         g.x = llm_output[:g.node_map.size(-1)]
         return g
 
+    def incremental_encode(self, g, prev_g):
+        r"""Encode g given prev_g, an earlier version of the same graph already encoded by auto_encode or
+        incremental_encode with the current weights. Only nodes within num_layers hops downstream of a changed node
+        text or edge are recomputed, on the subgraph of their num_layers-hop upstream neighborhood, which is all
+        their memory embeddings depend on. The memory embeddings of the other nodes are copied from prev_g.
+        """
+        g.num_node_feat = g.x.shape[0]
+        if g.edge_attr is not None:
+            text_inputs = np.concatenate([g.x, g.edge_attr], axis=0)
+            edge_texts = g.edge_attr[g.edge_map.cpu().numpy()]
+            prev_edge_texts = prev_g.graph_texts[prev_g.num_node_feat + prev_g.edge_map.cpu().numpy()]
+        else:
+            text_inputs = g.x
+            edge_texts, prev_edge_texts = None, None
+        node_texts = g.x[g.node_map.cpu().numpy()]
+        changed = changed_nodes(prev_g.graph_texts[prev_g.node_map.cpu().numpy()],
+                                graph_edge_texts(prev_g.edge_index, prev_edge_texts), node_texts,
+                                graph_edge_texts(g.edge_index, edge_texts))
+
+        num_nodes = len(node_texts)
+        memory_embedding = prev_g.x.new_empty((num_nodes,) + prev_g.x.size()[1:])
+        num_hops = len(self.llm_model.model.icae.get_base_model().model.g_layers)
+        affected = k_hop_subgraph(torch.from_numpy(changed).to(g.edge_index.device), num_hops, g.edge_index,
+                                  num_nodes=num_nodes, flow="target_to_source")[0]
+        unaffected = torch.ones(num_nodes, dtype=torch.bool, device=g.edge_index.device)
+        unaffected[affected] = False
+        memory_embedding[unaffected] = prev_g.x[unaffected.nonzero().view(-1)]
+        if len(affected) > 0:
+            subset, edge_index, mapping, edge_mask = k_hop_subgraph(affected, num_hops, g.edge_index,
+                                                                    relabel_nodes=True, num_nodes=num_nodes)
+            sub_node_texts, node_map = unique_texts(node_texts[subset.cpu().numpy()])
+            sub_texts = sub_node_texts
+            edge_map = None
+            if edge_texts is not None:
+                sub_edge_texts, edge_map = unique_texts(edge_texts[edge_mask.cpu().numpy()])
+                sub_texts = np.concatenate([sub_node_texts, sub_edge_texts], axis=0)
+                edge_map = edge_map.to(g.edge_index.device)
+            subgraph = SimpleNamespace(num_node_feat=len(sub_node_texts), node_map=node_map.to(g.edge_index.device),
+                                       edge_index=edge_index, edge_map=edge_map)
+            llm_output = self.llm_model.encode(sub_texts.tolist(), graph=subgraph, partial_grad=True)
+            memory_embedding[affected] = llm_output[mapping].to(memory_embedding)
+        g.graph_texts = text_inputs
+        g.x = memory_embedding
+        return g
+
     def auto_decode(self, g):
         emb = g.x
         answer_texts = g.answer[g.answer_map.cpu().numpy()].tolist()
-        prompt_texts = g.question[g.question_map.cpu().numpy()].tolist()
-        prompt_texts = ["" if p.startswith("Please complete the sentence") else p for p in prompt_texts]
         emb = emb[g.question_index]
-        answer_logits, answer_id, masks = self.llm_model.decode(answer_texts, emb, prompt=prompt_texts)
-        GNNLMOutput = namedtuple("GNNLMOutput", ["logits", "answer_id", "pred_text", "answer"])
-        return GNNLMOutput(logits=answer_logits[masks][:,:32000], pred_text=self.logit_to_text(answer_logits, masks),
-                           answer_id=answer_id, answer=answer_texts)
+        # the decoder states of answer positions only, in the order of answer_id
+        if getattr(g, "decode_inputs", None) is not None:
+            answer_states, answer_id, masks = self.llm_model.decode(g.decode_inputs, emb, target_only=True)
+        else:
+            answer_states, answer_id, masks = self.llm_model.decode(
+                answer_token_ids(g, answer_texts), emb, prompt=question_token_ids(g, decode_prompt_texts(g)),
+                target_only=True)
+        lm_head = self.llm_model.model.icae.get_base_model().lm_head
+        if self.training and self.llm_model.loss_chunk_size > 0:
+            loss, token_ids = ChunkedCrossEntropy.apply(answer_states, lm_head.weight[:32000], answer_id,
+                                                        self.llm_model.loss_chunk_size)
+            answer_logits = None
+        else:
+            answer_logits = lm_head(answer_states).float()[:, :32000]
+            loss, token_ids = None, answer_logits.argmax(dim=-1)
+        GNNLMOutput = namedtuple("GNNLMOutput", ["logits", "answer_id", "pred_text", "answer", "loss"])
+        return GNNLMOutput(logits=answer_logits, pred_text=self.target_ids_to_text(token_ids, masks),
+                           answer_id=answer_id, answer=answer_texts, loss=loss)
 
     def auto_generate(self, g):
         emb = g.x
@@ -217,7 +375,7 @@ class GOFA(torch.nn.Module):
         prompt_texts = g.question[g.question_map.cpu().numpy()].tolist()
         prompt_texts = ["" if p.startswith("Please complete the sentence") else p for p in prompt_texts]
         emb = emb[g.question_index]
-        generated_text = self.llm_model.generate(emb, prompt=prompt_texts)
+        generated_text = self.llm_model.generate(emb, graph=g, prompt=question_token_ids(g, prompt_texts))
         for i, txt in enumerate(generated_text):
             print_fixed_length("question: " + prompt_texts[i])
             print("-"*120)
@@ -227,6 +385,65 @@ class GOFA(torch.nn.Module):
         return GNNLMOutput(logits=torch.randn([1, 32132]).to(emb.device), pred_text=generated_text, answer_id=torch.tensor([1]).to(emb.device),
                            answer=answer_texts)
 
+    def stream_generate(self, g):
+        # generate the answers of an encoded graph like auto_generate, but yield (question index, text delta) pairs as
+        # soon as the tokens are generated instead of returning the full answers at the end.
+        emb = g.x
+        prompt_texts = g.question[g.question_map.cpu().numpy()].tolist()
+        prompt_texts = ["" if p.startswith("Please complete the sentence") else p for p in prompt_texts]
+        emb = emb[g.question_index]
+        detokenizers = [IncrementalDetokenizer(self.llm_model.model.tokenizer) for _ in prompt_texts]
+        for token_ids in self.llm_model.stream_generate(emb, prompt=question_token_ids(g, prompt_texts)):
+            for i, token_id in enumerate(token_ids.tolist()):
+                delta = detokenizers[i].add(token_id)
+                if len(delta) > 0:
+                    yield i, delta
+
+    def auto_score(self, g):
+        # score the candidate labels of every question by their log-likelihood given the graph memory, instead of
+        # generating an answer. All candidates of all questions are decoded together with teacher forcing.
+        emb = g.x
+        answer_texts = g.answer[g.answer_map.cpu().numpy()].tolist()
+        prompt_texts = g.question[g.question_map.cpu().numpy()].tolist()
+        prompt_texts = ["" if p.startswith("Please complete the sentence") else p for p in prompt_texts]
+        emb = emb[g.question_index]
+        candidates = g.candidates
+        if len(candidates) != len(prompt_texts):
+            raise ValueError("Candidate scoring requires one candidate list per question.")
+        num_candidates = torch.tensor([len(c) for c in candidates], device=emb.device)
+        question_index = torch.arange(len(candidates), device=emb.device).repeat_interleave(num_candidates)
+        candidate_texts = [c for cands in candidates for c in cands]
+        # the decoder prefix of every question is computed once and shared by its candidates (Mistral prefixes
+        # include the instruction tokens and require a prompt)
+        if all(len(p) > 0 for p in prompt_texts):
+            mem_embs = self.llm_model.decode_prefix(emb)[question_index]
+        else:
+            mem_embs = emb[question_index]
+        candidate_states, candidate_ids, masks = self.llm_model.decode(
+            candidate_texts, mem_embs, prompt=[prompt_texts[i] for i in question_index.tolist()], target_only=True)
+        lm_head = self.llm_model.model.icae.get_base_model().lm_head
+        token_scores = torch.log_softmax(lm_head(candidate_states).float()[:, :32000], dim=-1)
+        token_scores = token_scores.gather(-1, candidate_ids.unsqueeze(-1)).squeeze(-1)
+        lengths = masks.sum(dim=-1)
+        candidate_scores = token_scores.new_zeros(len(candidate_texts)).index_add_(
+            0, torch.arange(len(candidate_texts), device=emb.device).repeat_interleave(lengths), token_scores)
+
+        # (num_questions, max_num_candidates) log-likelihoods, -inf for missing candidates
+        scores = candidate_scores.new_full((len(candidates), int(num_candidates.max())), float("-inf"))
+        scores[torch.arange(scores.size(-1), device=emb.device).unsqueeze(0) < num_candidates.unsqueeze(1)] = \
+            candidate_scores
+        pred_text = [cands[i] for cands, i in zip(candidates, scores.argmax(dim=-1).tolist())]
+        # questions whose label is not a candidate get the ignore index of the cross-entropy loss
+        if hasattr(g, "label_map"):
+            labels = g.label[g.label_map.cpu().numpy()].tolist()
+            answer_id = torch.tensor([cands.index(l) if l in cands else -100 for cands, l in zip(candidates, labels)],
+                                     device=emb.device)
+        else:
+            answer_id = torch.full((len(candidates),), -100, device=emb.device)
+        GNNLMOutput = namedtuple("GNNLMOutput", ["logits", "answer_id", "pred_text", "answer", "candidates", "loss"])
+        return GNNLMOutput(logits=scores, pred_text=pred_text, answer_id=answer_id, answer=answer_texts,
+                           candidates=candidates, loss=None)
+
     def forward(self, g):
         g = self.encode(g)
         return self.decode(g)
@@ -269,22 +486,23 @@ class GOFA(torch.nn.Module):
                 new_state_dict[name] = state_dict[name]
         self.llm_model.model.icae.model.model.g_layers.load_state_dict(new_state_dict, strict=False)
         self.load_state_dict(new_state_dict, strict=False)
+        self.weights_version += 1
 
     def logit_to_text(self, logits, masks):
         tokenizer = self.llm_model.get_tokenizer()
         if len(logits.size()) == 2:
             logits = logits.unsqueeze(0)
-        decoded_texts = []
-        for i in range(logits.size(0)):
-            sample_logit = logits[i]
-            sample_mask = masks[i]
-            sample_logit = sample_logit[sample_mask]
-            token_ids = sample_logit[:, :32000].argmax(dim=-1).unsqueeze(0)
-            token_ids[token_ids >= 32000] = 1
-            sample_text = tokenizer.batch_decode(token_ids, skip_special_tokens=True, clean_up_tokenization_spaces=True)
-            decoded_texts.extend(sample_text)
-        return decoded_texts
+        # one argmax over the answer positions of all samples, truncated at the first predicted eos and decoded
+        # together
+        token_ids = logits[masks][:, :32000].argmax(dim=-1)
+        return batch_decode_ragged(tokenizer, token_ids, masks.sum(dim=-1), [tokenizer.eos_token_id],
+                                   skip_special_tokens=True, clean_up_tokenization_spaces=True)
 
+    def target_ids_to_text(self, token_ids, masks):
+        tokenizer = self.llm_model.get_tokenizer()
+        # truncated at the first eos like the predictions of logit_to_text, so both are normalized the same way
+        return batch_decode_ragged(tokenizer, token_ids, masks.sum(dim=-1), [tokenizer.eos_token_id],
+                                   skip_special_tokens=True, clean_up_tokenization_spaces=True)
 
 class PyGRGCNEdge(MultiLayerMessagePassing):
     def __init__(self, num_layers: int, num_rels: int, inp_dim: int, out_dim: int, drop_ratio=0, JK="last",
@@ -0,0 +1,290 @@
+import hashlib
+import json
+import os
+import os.path as osp
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+import torch
+
+
+def sequence_key(token_ids, namespace=""):
+    r"""Content hash of a token id sequence, used to address the frozen hidden states of a node or edge text.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(namespace.encode("utf-8"))
+    h.update(np.asarray(token_ids, dtype=np.int64).tobytes())
+    return h.hexdigest()
+
+
+class FrozenStateCache:
+    r"""Content-addressed cache of the hidden states entering the first GNN layer of GOFA.
+    With partial_grad, all decoder layers below the first GNN layer are frozen, so these states only depend on the
+    token ids of a node or edge text. Entries are kept in an in-memory LRU tier and, if cache_dir is given, written
+    through to disk and read back with np.memmap once evicted from memory. Cached states are computed in eval mode,
+    so LoRA dropout of the frozen layers is applied neither on a hit nor on a miss.
+    Args:
+        max_memory (float): Capacity of the in-memory tier in GB.
+        cache_dir (str, optional): Directory of the on-disk tier. Disabled if None.
+        namespace (str): Mixed into every key. Should identify the frozen weights and dtype.
+        dtype (torch.dtype): dtype of the cached hidden states.
+    """
+    def __init__(self, max_memory: float = 4.0, cache_dir: Optional[str] = None, namespace: str = "",
+                 dtype: torch.dtype = torch.float16):
+        self.max_bytes = int(max_memory * 1024 ** 3)
+        self.cache_dir = cache_dir
+        self.namespace = namespace
+        self.dtype = dtype
+        self.memory = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, token_ids):
+        return sequence_key(token_ids, self.namespace)
+
+    def disk_path(self, key):
+        return osp.join(self.cache_dir, key[:2], key + ".npy")
+
+    def get(self, key) -> Optional[torch.Tensor]:
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key]
+        if self.cache_dir is not None and osp.exists(self.disk_path(key)):
+            # copy-on-write mapping, so the states are only read from disk when they are moved to the device
+            raw = np.load(self.disk_path(key), mmap_mode="c")
+            states = torch.from_numpy(raw).view(self.dtype)
+            self.__add_to_memory__(key, states)
+            self.hits += 1
+            return states
+        self.misses += 1
+        return None
+
+    def put(self, key, states: torch.Tensor):
+        states = states.detach().to(device="cpu", dtype=self.dtype).contiguous()
+        self.__add_to_memory__(key, states)
+        if self.cache_dir is not None and not osp.exists(self.disk_path(key)):
+            path = self.disk_path(key)
+            os.makedirs(osp.dirname(path), exist_ok=True)
+            tmp_path = path + f".{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, states.view(torch.uint8).numpy())
+            os.replace(tmp_path, path)
+
+    def __add_to_memory__(self, key, states):
+        if key in self.memory:
+            return
+        self.memory[key] = states
+        self.num_bytes += states.numel() * states.element_size()
+        while self.num_bytes > self.max_bytes and len(self.memory) > 1:
+            _, evicted = self.memory.popitem(last=False)
+            self.num_bytes -= evicted.numel() * evicted.element_size()
+
+    def __contains__(self, key):
+        return key in self.memory or (self.cache_dir is not None and osp.exists(self.disk_path(key)))
+
+    def __len__(self):
+        return len(self.memory)
+
+
+def graph_key(node_texts, edge_texts, edge_index, node_map, edge_map, namespace=""):
+    r"""Content hash of a graph given by its unique node and edge texts, the maps from nodes and edges to these texts
+    and its edge_index, used to address the memory embeddings of its nodes.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(namespace.encode("utf-8"))
+    for texts in [node_texts, edge_texts]:
+        h.update(json.dumps(None if texts is None else [str(t) for t in texts]).encode("utf-8"))
+    for index in [edge_index, node_map, edge_map]:
+        index = np.asarray(index.cpu() if isinstance(index, torch.Tensor) else index, dtype=np.int64)
+        h.update(str(index.shape).encode("utf-8"))
+        h.update(index.tobytes())
+    return h.hexdigest()
+
+
+def parameter_key(module):
+    r"""Content hash of the parameters and buffers of module."""
+    h = hashlib.blake2b(digest_size=16)
+    for name, tensor in module.state_dict().items():
+        h.update(name.encode("utf-8"))
+        h.update(tensor.detach().cpu().contiguous().flatten().view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()
+
+
+class GraphMemoryCache(FrozenStateCache):
+    r"""Cache of the memory embeddings of all nodes of a graph after the GNN-interleaved layers, so that repeated
+    questions about the same graph only run the decoder. Entries are stored like those of FrozenStateCache and are
+    addressed by the graph and the current weights of the GNN layers. The weights are hashed again only when the
+    weights version given with the graph changes, which the model bumps after every optimizer step and weight load.
+    Args:
+        max_memory (float): Capacity of the in-memory tier in GB.
+        cache_dir (str, optional): Directory of the on-disk tier. Disabled if None.
+        namespace (str): Mixed into every key. Should identify the frozen encoder weights and dtype.
+        dtype (torch.dtype): dtype of the cached memory embeddings.
+    """
+    def __init__(self, max_memory: float = 4.0, cache_dir: Optional[str] = None, namespace: str = "",
+                 dtype: torch.dtype = torch.float16):
+        super().__init__(max_memory, cache_dir, namespace, dtype)
+        self.weights_version = None
+        self.weights_key = None
+
+    def key(self, graph, g_layers=None, weights_version=0):
+        r"""Key of graph, whose x and edge_attr still hold the node and edge texts, under version weights_version of
+        the weights of g_layers."""
+        namespace = self.namespace
+        if g_layers is not None:
+            if weights_version != self.weights_version:
+                self.weights_version = weights_version
+                self.weights_key = parameter_key(g_layers)
+            namespace = namespace + "_" + self.weights_key
+        return graph_key(graph.x, graph.edge_attr, graph.edge_index, graph.node_map, graph.edge_map, namespace)
+
+
+class PrefixStateWriter:
+    r"""Writes the frozen states of node and edge texts to a sharded store that is read back by PrefixStateStore.
+    Entries are appended to raw shard files of at most shard_size GB, and every shard has an index from sequence key
+    to byte offset and token length. A manifest with the namespace, mode and entry shapes is written on close.
+    Args:
+        store_dir (str): Directory of the store.
+        namespace (str): Mixed into every key. Should identify the frozen weights and dtype.
+        mode (str): "full" stores the hidden states entering the first GNN layer for all tokens. "kv" stores these
+            states for the memory tokens only, plus the keys and values of the text tokens in every GNN-interleaved
+            layer.
+        dtype (torch.dtype): dtype of the stored states.
+        shard_size (float): Maximum size of a shard in GB.
+        meta: Shapes needed to read entries back, hidden_size for "full" and additionally mem_size, num_layers,
+            num_kv_heads and head_dim for "kv".
+    """
+    def __init__(self, store_dir: str, namespace: str = "", mode: str = "full", dtype: torch.dtype = torch.bfloat16,
+                 shard_size: float = 4.0, **meta):
+        if mode not in ["full", "kv"]:
+            raise NotImplementedError(mode + " mode not implemented. Please choose from: full, kv.")
+        self.store_dir = store_dir
+        self.namespace = namespace
+        self.mode = mode
+        self.dtype = dtype
+        self.max_shard_bytes = int(shard_size * 1024 ** 3)
+        self.meta = meta
+        self.keys = set()
+        self.num_shards = 0
+        self.shard_file = None
+        os.makedirs(self.store_dir, exist_ok=True)
+        self.__open_shard__()
+
+    def key(self, token_ids):
+        return sequence_key(token_ids, self.namespace)
+
+    def __open_shard__(self):
+        self.shard_file = open(osp.join(self.store_dir, f"shard_{self.num_shards:05d}.bin"), "wb")
+        self.shard_keys = []
+        self.shard_offsets = []
+        self.shard_lengths = []
+        self.shard_bytes = 0
+        self.num_shards += 1
+
+    def __close_shard__(self):
+        self.shard_file.close()
+        np.savez(osp.join(self.store_dir, f"shard_{self.num_shards - 1:05d}.npz"),
+                 keys=np.array(self.shard_keys, dtype="U32"), offsets=np.array(self.shard_offsets, dtype=np.int64),
+                 lengths=np.array(self.shard_lengths, dtype=np.int64))
+
+    def add(self, key, states, length: int):
+        r"""Add the states of a sequence of length tokens. For "kv" mode, states is a tuple of the memory-token states
+        and the stacked text keys and values.
+        """
+        if key in self.keys:
+            return
+        if isinstance(states, (tuple, list)):
+            states = torch.cat([s.flatten() for s in states])
+        raw = states.detach().to(device="cpu", dtype=self.dtype).flatten().view(torch.uint8).numpy()
+        if self.shard_bytes > 0 and self.shard_bytes + raw.nbytes > self.max_shard_bytes:
+            self.__close_shard__()
+            self.__open_shard__()
+        self.shard_file.write(raw.tobytes())
+        self.shard_keys.append(key)
+        self.shard_offsets.append(self.shard_bytes)
+        self.shard_lengths.append(length)
+        self.shard_bytes += raw.nbytes
+        self.keys.add(key)
+
+    def close(self):
+        self.__close_shard__()
+        manifest = {"namespace": self.namespace, "mode": self.mode, "dtype": str(self.dtype).split(".")[-1],
+                    "num_shards": self.num_shards, "num_entries": len(self.keys), "meta": self.meta}
+        with open(osp.join(self.store_dir, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=2)
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class PrefixStateStore:
+    r"""Read-only store of frozen states written by PrefixStateWriter (see prefix_precompute.py). Shards are
+    memory-mapped, so only the entries that are read are loaded from disk.
+    Args:
+        store_dir (str): Directory of the store.
+    """
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        with open(osp.join(store_dir, "manifest.json"), "r") as f:
+            manifest = json.load(f)
+        self.namespace = manifest["namespace"]
+        self.mode = manifest["mode"]
+        self.dtype = getattr(torch, manifest["dtype"])
+        self.meta = manifest["meta"]
+        self.shards = {}
+        self.index = {}
+        for shard_id in range(manifest["num_shards"]):
+            shard_index = np.load(osp.join(store_dir, f"shard_{shard_id:05d}.npz"))
+            for key, offset, length in zip(shard_index["keys"].tolist(), shard_index["offsets"].tolist(),
+                                           shard_index["lengths"].tolist()):
+                self.index[key] = (shard_id, offset, length)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, token_ids):
+        return sequence_key(token_ids, self.namespace)
+
+    def get_shard(self, shard_id):
+        if shard_id not in self.shards:
+            # copy-on-write mapping, so entries are only read from disk when they are moved to the device
+            self.shards[shard_id] = np.memmap(osp.join(self.store_dir, f"shard_{shard_id:05d}.bin"), dtype=np.uint8,
+                                              mode="c")
+        return self.shards[shard_id]
+
+    def get(self, key):
+        r"""Return the stored states of key or None if it is not in the store. In "full" mode the states have shape
+        (length, hidden_size). In "kv" mode a tuple of the memory-token states of shape (mem_size, hidden_size) and
+        the text keys and values of shape (num_layers, 2, num_kv_heads, length - mem_size, head_dim) is returned.
+        """
+        if key not in self.index:
+            self.misses += 1
+            return None
+        self.hits += 1
+        shard_id, offset, length = self.index[key]
+        hidden_size = self.meta["hidden_size"]
+        element_size = torch.tensor([], dtype=self.dtype).element_size()
+        if self.mode == "full":
+            shape = [(length, hidden_size)]
+        else:
+            mem_size = self.meta["mem_size"]
+            shape = [(mem_size, hidden_size), (self.meta["num_layers"], 2, self.meta["num_kv_heads"],
+                                               length - mem_size, self.meta["head_dim"])]
+        numel = [int(np.prod(s)) for s in shape]
+        raw = self.get_shard(shard_id)[offset:offset + sum(numel) * element_size]
+        states = torch.from_numpy(raw).view(self.dtype)
+        states = [s.view(s_shape) for s, s_shape in zip(torch.split(states, numel), shape)]
+        return states[0] if self.mode == "full" else tuple(states)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
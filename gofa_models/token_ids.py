@@ -0,0 +1,149 @@
+import numpy as np
+
+
+class RaggedArray:
+    r"""Rows of different lengths, e.g. the token ids of a list of texts, stored as one flat array of values and the
+    offsets of every row into it. Row selection, concatenation and padding are index arithmetic on the flat array.
+    Args:
+        values (np.ndarray): values of all rows, concatenated.
+        offsets (np.ndarray): start of every row in values, followed by the total length.
+    """
+    def __init__(self, values, offsets):
+        self.values = np.asarray(values)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    @classmethod
+    def from_lengths(cls, values, lengths):
+        lengths = np.asarray(lengths, dtype=np.int64)
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return cls(values, offsets)
+
+    @classmethod
+    def from_lists(cls, rows, dtype=np.int32):
+        lengths = np.fromiter((len(r) for r in rows), dtype=np.int64, count=len(rows))
+        values = np.fromiter((v for r in rows for v in r), dtype=dtype, count=int(lengths.sum()))
+        return cls.from_lengths(values, lengths)
+
+    @classmethod
+    def full(cls, lengths, value, dtype=np.int32):
+        r"""Rows of the given lengths filled with value."""
+        lengths = np.asarray(lengths, dtype=np.int64)
+        return cls.from_lengths(np.full(int(lengths.sum()), value, dtype=dtype), lengths)
+
+    @classmethod
+    def constant(cls, row, num_rows, rows=None, dtype=np.int32):
+        r"""num_rows copies of row. If the boolean mask rows is given, the rows where it is False are empty."""
+        row = np.asarray(row, dtype=dtype)
+        lengths = np.full(num_rows, len(row), dtype=np.int64)
+        if rows is not None:
+            lengths[~np.asarray(rows, dtype=bool)] = 0
+        return cls.from_lengths(np.tile(row, int((lengths > 0).sum())), lengths)
+
+    @staticmethod
+    def concat(arrays):
+        r"""Stack the rows of arrays into one RaggedArray."""
+        return RaggedArray.from_lengths(np.concatenate([a.values for a in arrays]),
+                                        np.concatenate([a.lengths for a in arrays]))
+
+    @staticmethod
+    def cat_rows(*arrays):
+        r"""Concatenate the i-th rows of all arrays, which have the same number of rows, into the i-th row."""
+        out = RaggedArray.from_lengths(np.empty(sum(len(a.values) for a in arrays),
+                                                dtype=np.result_type(*[a.values for a in arrays])),
+                                       sum(a.lengths for a in arrays))
+        start = out.offsets[:-1].copy()
+        for a in arrays:
+            out.values[np.repeat(start, a.lengths) + a.positions()] = a.values
+            start += a.lengths
+        return out
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def row_index(self):
+        r"""Row of every value."""
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+    def positions(self):
+        r"""Position of every value within its row."""
+        return np.arange(self.offsets[-1]) - np.repeat(self.offsets[:-1], self.lengths)
+
+    def __getitem__(self, index):
+        index = np.arange(len(self))[index]
+        lengths = self.lengths[index]
+        out = RaggedArray.from_lengths(self.values[:0], lengths)
+        out.values = self.values[np.repeat(self.offsets[index], lengths) + out.positions()]
+        return out
+
+    def truncate(self, max_length, left=False):
+        r"""Keep the first max_length values of every row, or the last ones if left."""
+        positions = self.positions()
+        if left:
+            positions = np.repeat(self.lengths, self.lengths) - 1 - positions
+        return RaggedArray.from_lengths(self.values[positions < max_length], np.minimum(self.lengths, max_length))
+
+    def clear_rows(self, rows):
+        r"""Make the rows of the boolean mask rows empty."""
+        keep = ~np.asarray(rows, dtype=bool)
+        return RaggedArray.from_lengths(self.values[np.repeat(keep, self.lengths)], self.lengths * keep)
+
+    def pad(self, pad_value, length=None, left=False):
+        r"""Rows padded to length, by default the longest row, as an array of shape (num_rows, length)."""
+        lengths = self.lengths
+        if length is None:
+            length = int(lengths.max()) if len(lengths) > 0 else 0
+        out = np.full((len(self), length), pad_value, dtype=self.values.dtype)
+        cols = self.positions()
+        if left:
+            cols = cols + np.repeat(length - lengths, lengths)
+        out[self.row_index(), cols] = self.values
+        return out
+
+    def mask(self, length=None, left=False):
+        r"""Boolean mask of shape (num_rows, length) marking the values of pad."""
+        lengths = self.lengths
+        if length is None:
+            length = int(lengths.max()) if len(lengths) > 0 else 0
+        cols = np.arange(length)[None, :]
+        if left:
+            return cols >= length - lengths[:, None]
+        return cols < lengths[:, None]
+
+    def tolist(self):
+        values = self.values.tolist()
+        offsets = self.offsets.tolist()
+        return [values[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def tokenize_texts(tokenizer, texts, max_length=None, add_special_tokens=True):
+    r"""Token ids of texts as a RaggedArray of int32, truncated to max_length if given. A RaggedArray is taken as
+    already tokenized and only truncated, on the truncation side of tokenizer.
+    """
+    if isinstance(texts, RaggedArray):
+        if max_length is None:
+            return texts
+        return texts.truncate(max_length, left=getattr(tokenizer, "truncation_side", "right") == "left")
+    if len(texts) == 0:
+        return RaggedArray.from_lengths(np.zeros(0, dtype=np.int32), [])
+    token_ids = tokenizer(list(texts), add_special_tokens=add_special_tokens, truncation=max_length is not None,
+                          max_length=max_length, padding=False, return_attention_mask=False)["input_ids"]
+    return RaggedArray.from_lists(token_ids)
+
+
+def tokenize_graph_texts(g, tokenizer, max_length):
+    r"""Attach the token ids of the node, edge, question and answer texts of a GOFA batch g as the RaggedArrays x_ids,
+    edge_attr_ids, question_ids and answer_ids, tokenized as the helpers tokenize texts: node and edge texts with
+    special tokens, answers without, both truncated to max_length, and questions without special tokens. Questions
+    are not truncated here, the helpers truncate prompts from the left when they take the ids.
+    """
+    g.x_ids = tokenize_texts(tokenizer, g.x, max_length)
+    if g.edge_attr is not None:
+        g.edge_attr_ids = tokenize_texts(tokenizer, g.edge_attr, max_length)
+    g.question_ids = tokenize_texts(tokenizer, g.question, add_special_tokens=False)
+    g.answer_ids = tokenize_texts(tokenizer, g.answer, max_length, add_special_tokens=False)
+    return g
@@ -93,10 +93,13 @@ class BaseTemplate(LightningModule):
         loss = self.eval_kit.compute_loss(score, batch)
         self.log(osp.join(self.name, step_name, "loss"), loss, on_step=True, on_epoch=False, prog_bar=log_loss,
                  batch_size=batch.batch_size if hasattr(batch, "batch_size") else len(batch), sync_dist=True, )
+        self.eval_results(score, batch, step_name)
+        return score, loss
+
+    def eval_results(self, score, batch, step_name):
         with torch.no_grad():
             if self.eval_kit.has_eval_state(step_name):
                 self.eval_kit.eval_step(score, batch, step_name)
-        return score, loss
 
     def epoch_post_process(self, epoch_name):
         if self.eval_kit.has_eval_state(epoch_name):
@@ -1,4 +1,5 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Optional, Dict, Union, Callable
 
 import numpy as np
@@ -34,8 +35,19 @@ def make_dummy_batch(batch):
     batch.question = np.array(["Your name is "], dtype=object)
     batch.answer = np.array(["GOFA."],dtype=object)
     batch.question_index = torch.tensor([0], device=batch.question_map.device, dtype=batch.edge_index.dtype)
+    # the token ids and model inputs built by the collate transform belong to the replaced texts
+    for key in ["x_ids", "edge_attr_ids", "question_ids", "answer_ids", "encode_inputs", "decode_inputs"]:
+        setattr(batch, key, None)
 
 class GraphTextPredLightning(BaseTemplate):
+    def __init__(self, *args, async_postprocess=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        # if async_postprocess, evaluation of validation and test outputs (text post-processing and metric updates)
+        # runs on a single worker thread in submission order, so the next batch is already being generated meanwhile.
+        # All of it is finished before any epoch metric is computed or logged
+        self.postprocess_executor = ThreadPoolExecutor(max_workers=1) if async_postprocess else None
+        self.pending_postprocess = []
+
     def forward(self, batch):
         # print(batch)
         return self.model(batch)
@@ -49,6 +61,13 @@ class GraphTextPredLightning(BaseTemplate):
     def on_train_batch_start(self, batch: Any, batch_idx: int) -> Optional[int]:
         pass
 
+    def on_train_batch_end(self, outputs, batch: Any, batch_idx: int) -> None:
+        # the optimizer step changed the weights
+        self.model.weights_version += 1
+
+    def on_load_checkpoint(self, checkpoint: Dict[str, Any]) -> None:
+        self.model.weights_version += 1
+
     def on_save_checkpoint(self, checkpoint: Dict[str, Any]) -> None:
         self.model.save_partial(os.path.join(self.model.save_dir, "mem_ckpt.pth"))
         for k in list(checkpoint["state_dict"].keys()):
@@ -70,17 +89,41 @@ class GraphTextPredLightning(BaseTemplate):
                 score, loss = self.compute_results(batch, batch_idx, self.exp_config.train_state_name[dataloader_idx])
             else:
                 raise e
+        for k, v in getattr(self.model.llm_model, "padding_fraction", {}).items():
+            self.log(f"padding_fraction/{k}", v, on_step=True, on_epoch=False, batch_size=1)
         return loss
 
+    def eval_results(self, score, batch, step_name):
+        if self.training or self.postprocess_executor is None:
+            return super().eval_results(score, batch, step_name)
+        self.pending_postprocess.append(self.postprocess_executor.submit(super().eval_results, score, batch, step_name))
+        self.wait_postprocess(block=False)
+
+    def wait_postprocess(self, block=True):
+        r"""Collect the submitted post-processing and re-raise its errors. If not block, only the finished part is
+        collected."""
+        while self.pending_postprocess and (block or self.pending_postprocess[0].done()):
+            self.pending_postprocess.pop(0).result()
+
+    def on_train_epoch_end(self):
+        self.wait_postprocess()
+        super().on_train_epoch_end()
+
     def on_validation_epoch_start(self) -> None:
         super().on_validation_epoch_start()
         self.old_decode = self.model.decode
-        self.model.decode = self.model.auto_generate
+        if self.model.mode != "autoencoderscore":
+            self.model.decode = self.model.auto_generate
 
     def on_validation_epoch_end(self):
+        self.wait_postprocess()
         super().on_validation_epoch_end()
         self.model.decode = self.old_decode
 
+    def on_test_epoch_end(self):
+        self.wait_postprocess()
+        super().on_test_epoch_end()
+
     #
     #
     # def optimizer_step(
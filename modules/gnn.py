@@ -14,6 +14,115 @@ from transformers.models.llama.modeling_llama import LlamaRMSNorm, LlamaMLP
 from gp.nn.models.util_model import MLP
 
 
+def csr_rounds(dst: Tensor, num_nodes: int):
+    r"""Sort edges by destination node and group them by their rank among
+    the incoming edges of that node. Every group holds at most one edge per
+    destination node, so per-node states can be updated group after group.
+    """
+    perm = torch.argsort(dst, stable=True)
+    deg = torch.bincount(dst, minlength=num_nodes)
+    start = torch.cumsum(deg, dim=0) - deg
+    rank = torch.empty_like(perm)
+    rank[perm] = torch.arange(len(perm), device=dst.device) - start[dst[perm]]
+    order = torch.argsort(rank, stable=True)
+    return torch.split(order, torch.bincount(rank).tolist())
+
+
+def attention_dropout(alpha: Tensor, p: float, generator: Optional[torch.Generator]):
+    r"""Dropout of attention weights alpha with random numbers drawn from
+    generator, so that the same mask can be drawn again in the backward pass.
+    Without generator, alpha is returned unchanged.
+    """
+    if generator is None:
+        return alpha
+    keep = torch.rand(alpha.size(), generator=generator, device=alpha.device, dtype=alpha.dtype) >= p
+    return alpha * keep / (1 - p)
+
+
+def dropout_generator(device: torch.device, p: float, seed: int):
+    if p == 0:
+        return None
+    generator = torch.Generator(device=device)
+    generator.manual_seed(seed)
+    return generator
+
+
+class OnlineSoftmaxAggregation(torch.autograd.Function):
+    r"""Softmax attention aggregation over the incoming edges of every node,
+    computing the same result as the message/softmax/scatter-add path of
+    GOFAGNNConv. Edges are streamed in CSR rounds with an online softmax, so
+    only per-node accumulators and one edge per node are materialized at a
+    time. The backward pass recomputes attention weights in the same rounds.
+    Attention dropout with probability dropout is applied to the normalized
+    weights, its masks are drawn from a generator seeded with seed and drawn
+    again in the backward pass.
+    """
+
+    @staticmethod
+    def forward(ctx, query, key, value, xe_k, xe_v, edge_index, edge_map, num_heads, dropout, seed):
+        src, dst = edge_index
+        if edge_map is None:
+            edge_map = torch.arange(src.size(0), device=src.device)
+        rounds = csr_rounds(dst, query.size(0))
+        shape = query.size()[:-1] + (num_heads, query.size(-1) // num_heads)
+        scale = 1 / math.sqrt(shape[-1])
+        generator = dropout_generator(query.device, dropout, seed)
+
+        running_max = query.new_full(shape[:-1], float("-inf"))
+        denominator = query.new_zeros(shape[:-1])
+        out = query.new_zeros(shape)
+        for edges in rounds:
+            i, j, e = dst[edges], src[edges], edge_map[edges]
+            key_j = (key[j] + xe_k[e]).view((-1,) + shape[1:])
+            value_j = (value[j] + xe_v[e]).view((-1,) + shape[1:])
+            alpha = (query[i].view((-1,) + shape[1:]) * key_j).sum(dim=-1) * scale
+            max_i = torch.maximum(running_max[i], alpha)
+            rescale = torch.exp(running_max[i] - max_i)
+            alpha = torch.exp(alpha - max_i)
+            denominator[i] = denominator[i] * rescale + alpha
+            # the softmax normalizes the weights before dropout, so only the accumulated values are dropped
+            alpha = attention_dropout(alpha, dropout, generator)
+            out[i] = out[i] * rescale.unsqueeze(-1) + alpha.unsqueeze(-1) * value_j
+            running_max[i] = max_i
+        out = out / torch.where(denominator > 0, denominator, torch.ones_like(denominator)).unsqueeze(-1)
+        log_sum = running_max + torch.log(denominator)
+
+        ctx.rounds = rounds
+        ctx.shape = shape
+        ctx.dropout = dropout
+        ctx.seed = seed
+        ctx.save_for_backward(query, key, value, xe_k, xe_v, src, dst, edge_map, out, log_sum)
+        return out.view(query.size())
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        query, key, value, xe_k, xe_v, src, dst, edge_map, out, log_sum = ctx.saved_tensors
+        shape = ctx.shape
+        scale = 1 / math.sqrt(shape[-1])
+        generator = dropout_generator(query.device, ctx.dropout, ctx.seed)
+        grad_out = grad_out.reshape(shape)
+        delta = (grad_out * out).sum(dim=-1)
+        grad_query, grad_key, grad_value = torch.zeros_like(query), torch.zeros_like(key), torch.zeros_like(value)
+        grad_xe_k, grad_xe_v = torch.zeros_like(xe_k), torch.zeros_like(xe_v)
+        for edges in ctx.rounds:
+            i, j, e = dst[edges], src[edges], edge_map[edges]
+            key_j = (key[j] + xe_k[e]).view((-1,) + shape[1:])
+            value_j = (value[j] + xe_v[e]).view((-1,) + shape[1:])
+            query_i = query[i].view((-1,) + shape[1:])
+            alpha = torch.exp((query_i * key_j).sum(dim=-1) * scale - log_sum[i])
+            dropped_alpha = attention_dropout(alpha, ctx.dropout, generator)
+            grad_out_i = grad_out[i]
+            grad_value_j = (dropped_alpha.unsqueeze(-1) * grad_out_i).flatten(-2)
+            grad_alpha = (dropped_alpha * (grad_out_i * value_j).sum(dim=-1) - alpha * delta[i]) * scale
+            grad_key_j = (grad_alpha.unsqueeze(-1) * query_i).flatten(-2)
+            grad_query.index_add_(0, i, (grad_alpha.unsqueeze(-1) * key_j).flatten(-2))
+            grad_key.index_add_(0, j, grad_key_j)
+            grad_xe_k.index_add_(0, e, grad_key_j)
+            grad_value.index_add_(0, j, grad_value_j)
+            grad_xe_v.index_add_(0, e, grad_value_j)
+        return grad_query, grad_key, grad_value, grad_xe_k, grad_xe_v, None, None, None, None, None
+
+
 class GOFAGNNConv(MessagePassing):
     _alpha: OptTensor
 
@@ -31,6 +140,10 @@ class GOFAGNNConv(MessagePassing):
 
         self.add_self_loops = False
 
+        self.attention_backend = getattr(config, "gnn_attention", "propagate")
+        if self.attention_backend not in ["propagate", "online"]:
+            raise NotImplementedError("Unknown gnn attention backend")
+
         self.lin_qkv = Linear(self.in_dim, self.in_dim * 3, bias=False)
 
         self.e_proj = Linear(self.in_dim, self.in_dim * 2, bias=False)
@@ -61,13 +174,18 @@ class GOFAGNNConv(MessagePassing):
     def reset_parameters(self):
         super().reset_parameters()
 
-    def forward(self, x: Tensor, edge_index: Adj, xe: Tensor):
+    def forward(self, x: Tensor, edge_index: Adj, xe: Tensor, edge_map: OptTensor = None):
         r"""Runs the forward pass of the module.
 
         Args:
             x (torch.Tensor or (torch.Tensor, torch.Tensor)): The input node
                 features.
             edge_index (torch.Tensor or SparseTensor): The edge indices.
+            xe (torch.Tensor): The edge features, one per edge or, if
+                edge_map is given, one per unique edge text.
+            edge_map (torch.Tensor, optional): Index of the edge features of
+                every edge. Edge features are normalized and projected once
+                per unique edge text and gathered in message.
         """
         x = x.view(x.size()[0], self.in_layer, self.in_dim)
         residual = x
@@ -77,6 +195,9 @@ class GOFAGNNConv(MessagePassing):
 
         if self.add_self_loops:
             num_nodes = x.size(0)
+            if edge_map is not None:
+                xe = xe[edge_map]
+                edge_map = None
             edge_index, xe = add_self_loops(edge_index, edge_attr=xe, fill_value=0.0, num_nodes=num_nodes)
 
         qkv = self.lin_qkv(x)
@@ -84,7 +205,15 @@ class GOFAGNNConv(MessagePassing):
 
         xe = self.e_proj(xe)
 
-        out = self.propagate(edge_index, query=query, key=key, value=value, xe=xe)
+        if self.attention_backend == "online":
+            xe_k, xe_v = torch.chunk(xe, 2, dim=-1)
+            dropout = self.dropout if self.training else 0.0
+            # the seed is drawn from the CPU generator, whose state activation checkpointing restores for recomputation
+            seed = int(torch.randint(2 ** 62, (1,))) if dropout > 0 else 0
+            out = OnlineSoftmaxAggregation.apply(query, key, value, xe_k, xe_v, edge_index, edge_map, self.head,
+                                                 dropout, seed)
+        else:
+            out = self.propagate(edge_index, query=query, key=key, value=value, xe=xe, edge_map=edge_map)
         out = self.o_proj(out)
 
         out = residual + out * self.attn_gate.tanh()
@@ -98,8 +227,10 @@ class GOFAGNNConv(MessagePassing):
 
         return out
 
-    def message(self, query_i: Tensor, key_j: Tensor, value_j: Tensor, xe: Tensor, index: Tensor, ptr: OptTensor,
-                size_i: Optional[int]) -> Tensor:
+    def message(self, query_i: Tensor, key_j: Tensor, value_j: Tensor, xe: Tensor, edge_map: OptTensor, index: Tensor,
+                ptr: OptTensor, size_i: Optional[int]) -> Tensor:
+        if edge_map is not None:
+            xe = xe[edge_map]
         xe_k, xe_v = torch.chunk(xe, 2, dim=-1)
         key_j = xe_k + key_j
         value_j = value_j + xe_v
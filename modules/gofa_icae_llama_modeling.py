@@ -166,6 +166,13 @@ class LlamaICAE(nn.Module):
         else:
             return {"loss": loss, "logits": logits.view(batch_size, -1, logits.size(-1))}
 
+    def tokens_to_embeddings(self, token_ids):  # input_tokens can be either normal tokens and special tokens
+        embeddings = self.icae.get_base_model().model.embed_tokens(token_ids)
+        special_flags = token_ids >= self.vocab_size
+        embeddings[special_flags] = self.memory_token_embed(token_ids[special_flags] - self.vocab_size).to(
+            embeddings)  # replace special token's embedding from self.memory_token_embed
+        return embeddings
+
     def create_bnb_config(self):
         """
         quantization configuration.
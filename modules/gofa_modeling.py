@@ -12,11 +12,228 @@ from torch.nn import BCEWithLogitsLoss, CrossEntropyLoss, MSELoss
 from transformers import LlamaConfig
 from transformers.models.llama.modeling_llama import LlamaAttention, LlamaRMSNorm, LlamaModel, LlamaDecoderLayer, \
     logger, BaseModelOutputWithPast, Cache, DynamicCache, _prepare_4d_causal_attention_mask_for_sdpa, \
-    _prepare_4d_causal_attention_mask, CausalLMOutputWithPast, LlamaForCausalLM
+    _prepare_4d_causal_attention_mask, CausalLMOutputWithPast, LlamaForCausalLM, apply_rotary_pos_emb
 from .gnn import GOFAGNNConv
 from transformers import MistralConfig
 from transformers.models.mistral.modeling_mistral import MistralAttention, MistralRMSNorm, MistralModel, MistralDecoderLayer, MistralForCausalLM
 
+
+
+def packed_position_ids(packed_lengths: torch.LongTensor):
+    r"""Position ids of a packed stream of sequences with lengths `packed_lengths`, restarting at 0 for every sequence.
+    """
+    offsets = torch.cumsum(packed_lengths, dim=0) - packed_lengths
+    return torch.arange(int(packed_lengths.sum()), dtype=torch.long, device=packed_lengths.device) - \
+        offsets.repeat_interleave(packed_lengths)
+
+
+def packed_token_index(packed_lengths: torch.LongTensor, order: torch.LongTensor):
+    r"""Index of the tokens of the sequences `order` in a packed stream, used to reorder or repeat whole sequences.
+
+    Returns:
+        The token index and the sequence lengths of the reordered stream.
+    """
+    offsets = torch.cumsum(packed_lengths, dim=0) - packed_lengths
+    lengths = packed_lengths[order]
+    return offsets[order].repeat_interleave(lengths) + packed_position_ids(lengths), lengths
+
+
+def _prepare_4d_packed_causal_attention_mask(packed_lengths: torch.LongTensor, dtype: torch.dtype,
+                                             sliding_window: Optional[int] = None, prefix_length: int = 0):
+    r"""Block-diagonal causal mask of shape `(1, 1, seq_length, prefix_length + seq_length)` for a packed stream, so
+    that every token only attends to the preceding tokens of its own sequence. If `prefix_length` is given, the
+    sequences continue a shared prefix of that many cached positions, which every token attends to.
+    """
+    sequence_ids = torch.arange(len(packed_lengths), device=packed_lengths.device).repeat_interleave(packed_lengths)
+    position_ids = packed_position_ids(packed_lengths) + prefix_length
+    key_sequence_ids = torch.cat([sequence_ids.new_full((prefix_length,), -1), sequence_ids])
+    key_position_ids = torch.cat([torch.arange(prefix_length, device=packed_lengths.device), position_ids])
+    distance = position_ids.unsqueeze(1) - key_position_ids.unsqueeze(0)
+    allowed = torch.logical_or(sequence_ids.unsqueeze(1) == key_sequence_ids.unsqueeze(0),
+                               key_sequence_ids.unsqueeze(0) < 0)
+    allowed = torch.logical_and(allowed, distance >= 0)
+    if sliding_window is not None:
+        allowed = torch.logical_and(allowed, distance < sliding_window)
+    attention_mask = torch.zeros(allowed.size(), dtype=dtype, device=packed_lengths.device)
+    attention_mask = attention_mask.masked_fill(torch.logical_not(allowed), torch.finfo(dtype).min)
+    return attention_mask[None, None, :, :]
+
+
+def _last_rows_layer_forward(decoder_layer, hidden_states, attention_mask, position_ids, num_rows):
+    r"""
+    Runs `decoder_layer` for the last `num_rows` positions of every sequence only. The other positions contribute
+    their keys and values to attention, but no queries, attention outputs or MLP are computed for them.
+    """
+    self_attn = decoder_layer.self_attn
+    batch_size, seq_length = hidden_states.shape[:2]
+    prefix_length = seq_length - num_rows
+    position_ids = position_ids.expand(batch_size, -1)
+    prefix_states = decoder_layer.input_layernorm(hidden_states[:, :prefix_length])
+    key_states = self_attn.k_proj(prefix_states).view(
+        batch_size, prefix_length, self_attn.num_key_value_heads, self_attn.head_dim).transpose(1, 2)
+    value_states = self_attn.v_proj(prefix_states).view(
+        batch_size, prefix_length, self_attn.num_key_value_heads, self_attn.head_dim).transpose(1, 2)
+    cos, sin = self_attn.rotary_emb(value_states, seq_len=seq_length)
+    key_states = apply_rotary_pos_emb(key_states, key_states, cos, sin, position_ids[:, :prefix_length])[1]
+    prefix_cache = GOFAPrefixCache({self_attn.layer_idx: key_states}, {self_attn.layer_idx: value_states})
+    if attention_mask is None:
+        # attention is not causal for queries that are not aligned with the keys, so the mask must be explicit
+        attention_mask = _prepare_4d_causal_attention_mask(
+            None, (batch_size, num_rows), hidden_states, prefix_length,
+            sliding_window=getattr(self_attn.config, "sliding_window", None))
+    elif attention_mask.dim() == 4:
+        attention_mask = attention_mask[:, :, -num_rows:]
+    return decoder_layer(hidden_states[:, -num_rows:], attention_mask=attention_mask,
+                         position_ids=position_ids[:, -num_rows:], past_key_value=prefix_cache)[0]
+
+
+class GOFAPrefixCache(Cache):
+    r"""
+    Key/value cache holding a fixed prefix for a subset of decoder layers, indexed by layer index. The first update of
+    a layer stores its keys and values; later updates attend to the stored prefix without extending it, so the same
+    prefix can be reused by every forward pass.
+    """
+
+    def __init__(self, key_cache=None, value_cache=None):
+        self.key_cache = {} if key_cache is None else key_cache
+        self.value_cache = {} if value_cache is None else value_cache
+
+    def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+        if layer_idx not in self.key_cache:
+            self.key_cache[layer_idx] = key_states
+            self.value_cache[layer_idx] = value_states
+            return key_states, value_states
+        return (torch.cat([self.key_cache[layer_idx], key_states], dim=-2),
+                torch.cat([self.value_cache[layer_idx], value_states], dim=-2))
+
+    def get_seq_length(self, layer_idx=0):
+        if layer_idx not in self.key_cache:
+            return 0
+        return self.key_cache[layer_idx].shape[-2]
+
+    def get_max_length(self):
+        return None
+
+    def index_select(self, index):
+        return GOFAPrefixCache({k: v[index] for k, v in self.key_cache.items()},
+                               {k: v[index] for k, v in self.value_cache.items()})
+
+    def shift_positions(self, shift, rotary_emb):
+        r"""
+        Return a cache whose keys of row `i` are moved `shift[i]` positions to the right, by rotating them with the
+        rotary embedding `rotary_emb`. Values do not depend on positions and are shared with this cache.
+        """
+        position_ids = shift.unsqueeze(-1)
+        cos, sin = rotary_emb(next(iter(self.value_cache.values())), seq_len=int(shift.max()) + 1)
+        return GOFAPrefixCache({k: apply_rotary_pos_emb(v, v, cos, sin, position_ids)[0]
+                                for k, v in self.key_cache.items()}, dict(self.value_cache))
+
+
+class GOFAStaticCache(Cache):
+    r"""
+    Key/value cache with buffers preallocated for `max_length` positions per layer. Updates are written into the
+    buffers in place and views of the filled positions are returned, so the cache is not reallocated while generating.
+    Buffers are allocated with the batch size, heads, dtype and device of the first update of every layer.
+    """
+
+    def __init__(self, max_length):
+        self.max_length = max_length
+        self.key_cache = {}
+        self.value_cache = {}
+        self.lengths = {}
+
+    def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+        if layer_idx not in self.key_cache:
+            shape = key_states.size()[:2] + (self.max_length,) + key_states.size()[3:]
+            self.key_cache[layer_idx] = key_states.new_zeros(shape)
+            self.value_cache[layer_idx] = value_states.new_zeros(shape)
+            self.lengths[layer_idx] = 0
+        start = self.lengths[layer_idx]
+        end = start + key_states.size(-2)
+        if end > self.max_length:
+            raise ValueError(f"Static cache of length {self.max_length} is full.")
+        self.key_cache[layer_idx][:, :, start:end] = key_states
+        self.value_cache[layer_idx][:, :, start:end] = value_states
+        self.lengths[layer_idx] = end
+        return self.key_cache[layer_idx][:, :, :end], self.value_cache[layer_idx][:, :, :end]
+
+    def get_seq_length(self, layer_idx=0):
+        return self.lengths.get(layer_idx, 0)
+
+    def get_max_length(self):
+        return self.max_length
+
+    def index_select(self, index):
+        cache = GOFAStaticCache(self.max_length)
+        cache.key_cache = {k: v[index] for k, v in self.key_cache.items()}
+        cache.value_cache = {k: v[index] for k, v in self.value_cache.items()}
+        cache.lengths = dict(self.lengths)
+        return cache
+
+    def compact(self, index):
+        r"""
+        Move the slots `index` of shape (batch_size, length) of every row to the front of the buffers, in place, and
+        drop all other slots.
+        """
+        for layer_idx in self.key_cache:
+            for cache in [self.key_cache, self.value_cache]:
+                buffer = cache[layer_idx]
+                gather_index = index[:, None, :, None].expand(-1, buffer.size(1), -1, buffer.size(3))
+                buffer[:, :, :index.size(1)] = buffer.gather(2, gather_index)
+            self.lengths[layer_idx] = index.size(1)
+
+
+
+class ChunkedCrossEntropy(torch.autograd.Function):
+    r"""
+    Mean cross-entropy of the logits `hidden_states @ weight.T` against `labels`, computed over chunks of `chunk_size`
+    vocabulary rows with a running log-sum-exp, so that the (num_tokens, vocab_size) logits are never materialized.
+    The backward pass recomputes the logits chunk by chunk. Also returns the argmax token of every position.
+    """
+
+    @staticmethod
+    def forward(ctx, hidden_states, weight, labels, chunk_size, ignore_index=-100):
+        valid = labels != ignore_index
+        labels = torch.where(valid, labels, torch.zeros_like(labels))
+        log_sum = hidden_states.new_full(labels.size(), float("-inf"), dtype=torch.float)
+        target_logits = hidden_states.new_zeros(labels.size(), dtype=torch.float)
+        max_logits = hidden_states.new_full(labels.size(), float("-inf"), dtype=torch.float)
+        predictions = torch.zeros_like(labels)
+        for start in range(0, weight.size(0), chunk_size):
+            logits = F.linear(hidden_states, weight[start:start + chunk_size]).float()
+            log_sum = torch.logaddexp(log_sum, torch.logsumexp(logits, dim=-1))
+            in_chunk = (labels >= start) & (labels < start + logits.size(-1))
+            target_logits[in_chunk] = logits[in_chunk, labels[in_chunk] - start]
+            chunk_max, chunk_argmax = logits.max(dim=-1)
+            update = chunk_max > max_logits
+            max_logits = torch.where(update, chunk_max, max_logits)
+            predictions = torch.where(update, chunk_argmax + start, predictions)
+        num_valid = valid.sum().clamp(min=1)
+        loss = ((log_sum - target_logits) * valid).sum() / num_valid
+
+        ctx.chunk_size = chunk_size
+        ctx.save_for_backward(hidden_states, weight, labels, valid, log_sum, num_valid)
+        ctx.mark_non_differentiable(predictions)
+        return loss, predictions
+
+    @staticmethod
+    def backward(ctx, grad_loss, grad_predictions):
+        hidden_states, weight, labels, valid, log_sum, num_valid = ctx.saved_tensors
+        scale = (grad_loss * valid / num_valid).unsqueeze(-1)
+        grad_hidden_states = torch.zeros_like(hidden_states, dtype=torch.float)
+        grad_weight = torch.zeros_like(weight) if ctx.needs_input_grad[1] else None
+        for start in range(0, weight.size(0), ctx.chunk_size):
+            chunk_weight = weight[start:start + ctx.chunk_size]
+            grad_logits = torch.exp(F.linear(hidden_states, chunk_weight).float() - log_sum.unsqueeze(-1))
+            in_chunk = (labels >= start) & (labels < start + grad_logits.size(-1))
+            grad_logits[in_chunk, labels[in_chunk] - start] -= 1
+            grad_logits = grad_logits * scale
+            grad_hidden_states += grad_logits @ chunk_weight.float()
+            if grad_weight is not None:
+                grad_weight[start:start + ctx.chunk_size] = (grad_logits.t() @ hidden_states.float()).to(weight.dtype)
+        return grad_hidden_states.to(hidden_states.dtype), grad_weight, None, None, None
+
+
 class GOFALlamaModel(LlamaModel):
     """
     Transformer decoder consisting of *config.num_hidden_layers* layers. Each layer is a [`LlamaDecoderLayer`]
@@ -41,6 +258,10 @@ class GOFALlamaModel(LlamaModel):
         self.gradient_checkpointing = False
         self.mem_token = gofa_config.mem_token
         self.llama_dtype = gofa_config.llama_dtype
+        self.gnn_checkpoint = gofa_config.gnn_checkpoint
+        self.gnn_checkpoint_interval = gofa_config.gnn_checkpoint_interval
+        if self.gnn_checkpoint not in ["none", "decoder", "gnn", "both"]:
+            raise NotImplementedError("Unknown gnn checkpoint policy")
 
         # Initialize weights and apply final processing
         self.post_init()
@@ -51,6 +272,118 @@ class GOFALlamaModel(LlamaModel):
     def set_input_embeddings(self, value):
         self.embed_tokens = value
 
+    def _prepare_gofa_attention_mask(self, attention_mask, batch_size, seq_length, inputs_embeds,
+                                     past_key_values_length, output_attentions=False):
+        if self._use_flash_attention_2:
+            # 2d mask is passed through the layers
+            attention_mask = attention_mask if (attention_mask is not None and 0 in attention_mask) else None
+        elif self._use_sdpa and not output_attentions:
+            # output_attentions=True can not be supported when using SDPA, and we fall back on
+            # the manual implementation that requires a 4D causal mask in all cases.
+            attention_mask = _prepare_4d_causal_attention_mask_for_sdpa(
+                attention_mask,
+                (batch_size, seq_length),
+                inputs_embeds,
+                past_key_values_length,
+            )
+        else:
+            # 4d mask is passed through the layers
+            # attention_mask = _prepare_4d_causal_attention_mask(
+            #     attention_mask, (batch_size, seq_length), inputs_embeds, past_key_values_length,
+            # )
+            attention_mask = _prepare_4d_causal_attention_mask(
+                attention_mask, (batch_size, seq_length), inputs_embeds, past_key_values_length
+            )
+        return attention_mask
+
+    @property
+    def num_frozen_layers(self):
+        return len(self.layers) - len(self.g_layers)
+
+    def _checkpoint_g_layer(self, g_layer_idx, part):
+        r"""
+        Whether `part` ("decoder" or "gnn") of the GNN-interleaved layer `g_layer_idx` is recomputed in the backward
+        pass under the `gnn_checkpoint` policy instead of storing its activations.
+        """
+        return (self.training and torch.is_grad_enabled() and g_layer_idx >= 0 and self.gnn_checkpoint in [part, "both"]
+                and g_layer_idx % self.gnn_checkpoint_interval == 0)
+
+    @torch.no_grad()
+    def frozen_forward(self, inputs_embeds: torch.FloatTensor, attention_mask: Optional[torch.Tensor] = None):
+        r"""
+        Runs only the decoder layers below the first GNN layer. These layers are frozen when GOFA is trained with
+        `partial_grad`, so the output of a sequence is a function of its tokens only.
+
+        Returns:
+            The hidden states entering the first GNN layer, of shape `(batch_size, seq_length, hidden_size)`. They
+            can be fed back to `forward` with `from_boundary=True`.
+        """
+        batch_size, seq_length = inputs_embeds.shape[:2]
+        position_ids = torch.arange(seq_length, dtype=torch.long, device=inputs_embeds.device).unsqueeze(0)
+        attention_mask = self._prepare_gofa_attention_mask(attention_mask, batch_size, seq_length, inputs_embeds, 0)
+        hidden_states = inputs_embeds
+        for decoder_layer in self.layers[:self.num_frozen_layers]:
+            hidden_states = hidden_states.to(self.llama_dtype)
+            hidden_states = decoder_layer(hidden_states, attention_mask=attention_mask, position_ids=position_ids)[0]
+        return hidden_states
+
+    @torch.no_grad()
+    def prefix_kv(self, hidden_states: torch.FloatTensor, attention_mask: Optional[torch.Tensor] = None):
+        r"""
+        Runs the GNN-interleaved layers over the text tokens of node and edge sequences, given their outputs of
+        `frozen_forward`. Text tokens precede the memory tokens and the GNN layers only update memory tokens, so with
+        `partial_grad` the keys and values of text tokens in these layers are a function of their tokens only.
+
+        Returns:
+            A `GOFAPrefixCache` with the keys and values of every GNN-interleaved layer, to be used by `memory_forward`.
+        """
+        batch_size, seq_length = hidden_states.shape[:2]
+        position_ids = torch.arange(seq_length, dtype=torch.long, device=hidden_states.device).unsqueeze(0)
+        attention_mask = self._prepare_gofa_attention_mask(attention_mask, batch_size, seq_length, hidden_states, 0)
+        prefix_cache = GOFAPrefixCache()
+        for decoder_layer in self.layers[self.num_frozen_layers:]:
+            hidden_states = hidden_states.to(self.llama_dtype)
+            hidden_states = decoder_layer(hidden_states, attention_mask=attention_mask, position_ids=position_ids,
+                                          past_key_value=prefix_cache, use_cache=True)[0]
+        return prefix_cache
+
+    def memory_forward(self, mem_states: torch.FloatTensor, prefix_cache: GOFAPrefixCache, prefix_mask: torch.Tensor,
+                       graph=None, map_node=None):
+        r"""
+        Runs the GNN-interleaved layers on the memory tokens only. `mem_states` are the outputs of `frozen_forward`
+        at the memory-token positions, of shape `(num_sequences, mem_token, hidden_size)`. The text tokens are given
+        as keys and values by `prefix_cache` (see `prefix_kv`), left padded and marked by `prefix_mask` of shape
+        `(num_sequences, prefix_length)`.
+
+        Returns:
+            The final normed hidden states of the memory tokens, as returned by `encode_memory`.
+        """
+        batch_size, seq_length = mem_states.shape[:2]
+        prefix_length = prefix_mask.size(-1)
+        position_ids = prefix_mask.sum(dim=-1, keepdim=True) + torch.arange(seq_length, dtype=torch.long,
+                                                                            device=mem_states.device)
+        attention_mask = torch.cat([prefix_mask, prefix_mask.new_ones((batch_size, seq_length))], dim=-1)
+        attention_mask = self._prepare_gofa_attention_mask(attention_mask, batch_size, seq_length, mem_states,
+                                                           prefix_length)
+        hidden_states = mem_states
+        cur_node_size = graph.num_node_feat if graph is not None else 0
+        if graph is not None and map_node:
+            index = torch.cat([graph.node_map, torch.arange(cur_node_size, batch_size, device=graph.node_map.device)])
+            hidden_states = hidden_states[index]
+            position_ids = position_ids[index]
+            attention_mask = attention_mask[index]
+            prefix_cache = prefix_cache.index_select(index)
+            cur_node_size = len(graph.node_map)
+        for g_layer_idx, decoder_layer in enumerate(self.layers[self.num_frozen_layers:]):
+            if graph is not None:
+                output = self.g_layers[g_layer_idx](hidden_states[:cur_node_size], graph.edge_index,
+                                                    hidden_states[cur_node_size:], graph.edge_map)
+                hidden_states = torch.cat([output, hidden_states[cur_node_size:]], dim=0)
+            hidden_states = hidden_states.to(self.llama_dtype)
+            hidden_states = decoder_layer(hidden_states, attention_mask=attention_mask, position_ids=position_ids,
+                                          past_key_value=prefix_cache)[0]
+        return self.norm(hidden_states)
+
     def forward(
             self,
             input_ids: torch.LongTensor = None,
@@ -66,6 +399,10 @@ class GOFALlamaModel(LlamaModel):
             mem_mask=None,
             partial_grad=None,
             map_node=None,
+            from_boundary=None,
+            packed_lengths=None,
+            output_mem_only=None,
+            mem_aligned=False,
     ) -> Union[Tuple, BaseModelOutputWithPast]:
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
@@ -97,7 +434,9 @@ class GOFALlamaModel(LlamaModel):
                 past_key_values = DynamicCache.from_legacy_cache(past_key_values)
             past_key_values_length = past_key_values.get_usable_length(seq_length)
 
-        if position_ids is None:
+        if position_ids is None and packed_lengths is not None:
+            position_ids = packed_position_ids(packed_lengths).unsqueeze(0) + past_key_values_length
+        elif position_ids is None:
             device = input_ids.device if input_ids is not None else inputs_embeds.device
             position_ids = torch.arange(
                 past_key_values_length, seq_length + past_key_values_length, dtype=torch.long, device=device
@@ -107,26 +446,15 @@ class GOFALlamaModel(LlamaModel):
         if inputs_embeds is None:
             inputs_embeds = self.embed_tokens(input_ids)
 
-        if self._use_flash_attention_2:
-            # 2d mask is passed through the layers
-            attention_mask = attention_mask if (attention_mask is not None and 0 in attention_mask) else None
-        elif self._use_sdpa and not output_attentions:
-            # output_attentions=True can not be supported when using SDPA, and we fall back on
-            # the manual implementation that requires a 4D causal mask in all cases.
-            attention_mask = _prepare_4d_causal_attention_mask_for_sdpa(
-                attention_mask,
-                (batch_size, seq_length),
-                inputs_embeds,
-                past_key_values_length,
-            )
+        if packed_lengths is not None:
+            # sequences are packed into a single row, isolated from each other by a block-diagonal mask
+            if self._use_flash_attention_2:
+                raise ValueError("Packed sequences require a 4d attention mask, use eager or sdpa attention.")
+            attention_mask = _prepare_4d_packed_causal_attention_mask(packed_lengths, inputs_embeds.dtype,
+                                                                      prefix_length=past_key_values_length)
         else:
-            # 4d mask is passed through the layers
-            # attention_mask = _prepare_4d_causal_attention_mask(
-            #     attention_mask, (batch_size, seq_length), inputs_embeds, past_key_values_length,
-            # )
-            attention_mask = _prepare_4d_causal_attention_mask(
-                attention_mask, (batch_size, seq_length), inputs_embeds, past_key_values_length
-            )
+            attention_mask = self._prepare_gofa_attention_mask(attention_mask, batch_size, seq_length, inputs_embeds,
+                                                               past_key_values_length, output_attentions)
 
         # embed positions
         hidden_states = inputs_embeds
@@ -147,30 +475,79 @@ class GOFALlamaModel(LlamaModel):
             raise ValueError("Running GOFA requires at least mem_token inputs.")
 
         cur_node_size = graph.num_node_feat if graph is not None else 0
+        # with left padding, memory tokens are the last mem_token positions of every sequence and the GNN layers can
+        # read and write them as a slice instead of gathering and scattering with mem_mask. The caller knows the
+        # padding side, so mem_aligned is passed in rather than checked on mem_mask, which would sync with the device
+        mem_aligned = mem_aligned and not past_key_state and mem_mask is not None and packed_lengths is None
+        if output_mem_only and not mem_aligned:
+            raise ValueError("output_mem_only requires the memory tokens to be the last positions of every sequence.")
         for i, decoder_layer in enumerate(self.layers):
+            g_layer_idx = i - (len(self.layers) - len(self.g_layers))
+            if from_boundary and g_layer_idx < 0:
+                # inputs_embeds already are the outputs of frozen_forward
+                continue
             if output_hidden_states:
                 all_hidden_states += (hidden_states,)
-            g_layer_idx = i - (len(self.layers) - len(self.g_layers))
             if g_layer_idx >= 0 and not past_key_state and graph is not None:
-                if g_layer_idx == 0 and map_node:
+                if g_layer_idx == 0 and map_node and packed_lengths is not None:
+                    sequence_order = torch.cat([graph.node_map, torch.arange(
+                        cur_node_size, len(packed_lengths), device=graph.node_map.device)])
+                    token_index, packed_lengths = packed_token_index(packed_lengths, sequence_order)
+                    hidden_states = hidden_states[:, token_index]
+                    mem_mask = mem_mask[:, token_index]
+                    position_ids = position_ids[:, token_index]
+                    attention_mask = _prepare_4d_packed_causal_attention_mask(packed_lengths, attention_mask.dtype)
+                    cur_node_size = len(graph.node_map)
+                elif g_layer_idx == 0 and map_node:
                     hidden_states = torch.cat(
                         [hidden_states[:cur_node_size][graph.node_map], hidden_states[cur_node_size:]],
                         dim=0)
                     mem_mask = torch.cat(
                         [mem_mask[:cur_node_size][graph.node_map], mem_mask[cur_node_size:]],
                         dim=0)
-                    attention_mask = torch.cat([attention_mask[:cur_node_size][graph.node_map], attention_mask[cur_node_size:]], dim=0)
+                    if attention_mask is not None:
+                        attention_mask = torch.cat(
+                            [attention_mask[:cur_node_size][graph.node_map], attention_mask[cur_node_size:]], dim=0)
+                    if position_ids.size(0) > 1:
+                        position_ids = torch.cat(
+                            [position_ids[:cur_node_size][graph.node_map], position_ids[cur_node_size:]], dim=0)
                     cur_node_size = len(graph.node_map)
-                mem_repr = hidden_states[mem_mask].view(hidden_states.size()[0], self.mem_token, -1)
+                if mem_aligned:
+                    # a copy of the memory rows only, so that writing hidden_states in place below does not modify
+                    # the input the GNN layer saved for backward
+                    mem_repr = hidden_states[:, -self.mem_token:].clone()
+                else:
+                    mem_repr = hidden_states[mem_mask].view(-1, self.mem_token, hidden_states.size()[-1])
                 gnn_input = mem_repr[:cur_node_size]
-                gnn_edge_input = mem_repr[cur_node_size:][graph.edge_map]
-
-                output = self.g_layers[g_layer_idx](gnn_input, graph.edge_index, gnn_edge_input)
-                output = torch.cat([output, mem_repr[cur_node_size:]], dim=0)
-                gnn_output = torch.zeros_like(hidden_states, dtype=output.dtype)
-                gnn_output[mem_mask] = output.view(-1, output.size()[-1])
-                hidden_states = hidden_states * torch.logical_not(mem_mask).unsqueeze(2) + gnn_output
-            if g_layer_idx < 0 and partial_grad:
+                gnn_edge_input = mem_repr[cur_node_size:]
+
+                if self._checkpoint_g_layer(g_layer_idx, "gnn"):
+                    output = torch.utils.checkpoint.checkpoint(self.g_layers[g_layer_idx], gnn_input,
+                                                               graph.edge_index, gnn_edge_input, graph.edge_map,
+                                                               use_reentrant=False)
+                else:
+                    output = self.g_layers[g_layer_idx](gnn_input, graph.edge_index, gnn_edge_input, graph.edge_map)
+                if mem_aligned and not output_hidden_states and hidden_states is not inputs_embeds:
+                    hidden_states[:cur_node_size, -self.mem_token:] = output.to(hidden_states.dtype)
+                elif mem_aligned:
+                    # never write into the caller's inputs_embeds or a hidden state that is returned
+                    output = torch.cat([output.to(hidden_states.dtype), mem_repr[cur_node_size:]], dim=0)
+                    hidden_states = torch.cat([hidden_states[:, :-self.mem_token], output], dim=1)
+                else:
+                    output = torch.cat([output, mem_repr[cur_node_size:]], dim=0)
+                    gnn_output = torch.zeros_like(hidden_states, dtype=output.dtype)
+                    gnn_output[mem_mask] = output.view(-1, output.size()[-1])
+                    hidden_states = hidden_states * torch.logical_not(mem_mask).unsqueeze(2) + gnn_output
+            if output_mem_only and i == len(self.layers) - 1:
+                # only the memory tokens are read from the last layer, the text tokens just provide keys and values
+                if self._checkpoint_g_layer(g_layer_idx, "decoder"):
+                    hidden_states = torch.utils.checkpoint.checkpoint(
+                        _last_rows_layer_forward, decoder_layer, hidden_states.to(self.llama_dtype), attention_mask,
+                        position_ids, self.mem_token, use_reentrant=False)
+                else:
+                    hidden_states = _last_rows_layer_forward(decoder_layer, hidden_states.to(self.llama_dtype),
+                                                             attention_mask, position_ids, self.mem_token)
+            elif g_layer_idx < 0 and partial_grad:
                 with torch.no_grad():
                     hidden_states = hidden_states.to(self.llama_dtype)
                     if self.gradient_checkpointing and self.training:
@@ -206,6 +583,10 @@ class GOFALlamaModel(LlamaModel):
                 if self.gradient_checkpointing and self.training:
                     layer_outputs = self._gradient_checkpointing_func(decoder_layer.__call__, hidden_states,
                         attention_mask, position_ids, past_key_values, output_attentions, use_cache, )
+                elif self._checkpoint_g_layer(g_layer_idx, "decoder") and not use_cache:
+                    layer_outputs = torch.utils.checkpoint.checkpoint(decoder_layer.__call__, hidden_states,
+                        attention_mask, position_ids, past_key_values, output_attentions, use_cache,
+                        use_reentrant=False)
                 else:
                     layer_outputs = decoder_layer(hidden_states, attention_mask=attention_mask,
                         position_ids=position_ids, past_key_value=past_key_values, output_attentions=output_attentions,
@@ -268,6 +649,7 @@ class GOFALlamaForCausalLM(LlamaForCausalLM):
         mem_mask = None,
         partial_grad = None,
         map_node = None,
+        packed_lengths = None,
     ) -> Union[Tuple, CausalLMOutputWithPast]:
         r"""
         Args:
@@ -315,6 +697,7 @@ class GOFALlamaForCausalLM(LlamaForCausalLM):
             mem_mask=mem_mask,
             partial_grad=partial_grad,
             map_node=map_node,
+            packed_lengths=packed_lengths,
         )
 
         hidden_states = outputs[0]
@@ -351,6 +734,62 @@ class GOFALlamaForCausalLM(LlamaForCausalLM):
             attentions=outputs.attentions,
         )
 
+    def encode_memory(
+        self,
+        inputs_embeds: torch.FloatTensor,
+        attention_mask: Optional[torch.Tensor] = None,
+        position_ids: Optional[torch.LongTensor] = None,
+        graph=None,
+        mem_mask=None,
+        partial_grad=None,
+        map_node=None,
+        from_boundary=None,
+        packed_lengths=None,
+        mem_aligned=False,
+    ) -> torch.FloatTensor:
+        r"""
+        Encoder entry point of GOFA. Runs the decoder stack without the `lm_head` projection and without collecting
+        intermediate hidden states or a kv cache.
+
+        Returns:
+            The final normed hidden states at the memory-token positions, of shape
+            `(num_sequences, mem_token, hidden_size)`. If `map_node` is set, node sequences are expanded by
+            `graph.node_map` in the same way as in the GNN layers. With `from_boundary`, `inputs_embeds` are the
+            hidden states returned by `frozen_forward` and only the GNN-interleaved layers are run. With
+            `packed_lengths`, all sequences are packed into a single row of `inputs_embeds` and `mem_mask`. With
+            `mem_aligned`, the memory tokens are the last positions of every sequence, as with left padding, and the
+            last decoder layer is only computed for the memory tokens.
+        """
+        mem_aligned = mem_aligned and packed_lengths is None
+        outputs = self.model(
+            inputs_embeds=inputs_embeds,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            use_cache=False,
+            output_attentions=False,
+            output_hidden_states=False,
+            return_dict=True,
+            graph=graph,
+            mem_mask=mem_mask,
+            partial_grad=partial_grad,
+            map_node=map_node,
+            from_boundary=from_boundary,
+            packed_lengths=packed_lengths,
+            output_mem_only=mem_aligned,
+            mem_aligned=mem_aligned,
+        )
+        hidden_states = outputs.last_hidden_state
+        if mem_aligned:
+            return hidden_states
+        if graph is not None and map_node and packed_lengths is not None:
+            sequence_order = torch.cat([graph.node_map, torch.arange(
+                graph.num_node_feat, len(packed_lengths), device=graph.node_map.device)])
+            mem_mask = mem_mask[:, packed_token_index(packed_lengths, sequence_order)[0]]
+        elif graph is not None and map_node:
+            mem_mask = torch.cat([mem_mask[:graph.num_node_feat][graph.node_map], mem_mask[graph.num_node_feat:]],
+                                 dim=0)
+        return hidden_states[mem_mask].view(-1, self.model.mem_token, hidden_states.size()[-1])
+
 
 class GOFAMistralModel(MistralModel):
     """
@@ -376,6 +815,10 @@ class GOFAMistralModel(MistralModel):
         self.gradient_checkpointing = False
         self.mem_token = gofa_config.mem_token
         self.llama_dtype = gofa_config.llama_dtype
+        self.gnn_checkpoint = gofa_config.gnn_checkpoint
+        self.gnn_checkpoint_interval = gofa_config.gnn_checkpoint_interval
+        if self.gnn_checkpoint not in ["none", "decoder", "gnn", "both"]:
+            raise NotImplementedError("Unknown gnn checkpoint policy")
 
         # Initialize weights and apply final processing
         self.post_init()
@@ -386,6 +829,118 @@ class GOFAMistralModel(MistralModel):
     def set_input_embeddings(self, value):
         self.embed_tokens = value
 
+    def _prepare_gofa_attention_mask(self, attention_mask, batch_size, seq_length, inputs_embeds,
+                                     past_key_values_length, output_attentions=False):
+        if self._use_flash_attention_2:
+            # 2d mask is passed through the layers
+            attention_mask = attention_mask if (attention_mask is not None and 0 in attention_mask) else None
+        elif self._use_sdpa and not output_attentions:
+            # output_attentions=True can not be supported when using SDPA, and we fall back on
+            # the manual implementation that requires a 4D causal mask in all cases.
+            attention_mask = _prepare_4d_causal_attention_mask_for_sdpa(
+                attention_mask,
+                (batch_size, seq_length),
+                inputs_embeds,
+                past_key_values_length,
+            )
+        else:
+            # 4d mask is passed through the layers
+            # attention_mask = _prepare_4d_causal_attention_mask(
+            #     attention_mask, (batch_size, seq_length), inputs_embeds, past_key_values_length,
+            # )
+            attention_mask = _prepare_4d_causal_attention_mask(
+                attention_mask, (batch_size, seq_length), inputs_embeds, past_key_values_length, sliding_window=self.config.sliding_window,
+            )
+        return attention_mask
+
+    @property
+    def num_frozen_layers(self):
+        return len(self.layers) - len(self.g_layers)
+
+    def _checkpoint_g_layer(self, g_layer_idx, part):
+        r"""
+        Whether `part` ("decoder" or "gnn") of the GNN-interleaved layer `g_layer_idx` is recomputed in the backward
+        pass under the `gnn_checkpoint` policy instead of storing its activations.
+        """
+        return (self.training and torch.is_grad_enabled() and g_layer_idx >= 0 and self.gnn_checkpoint in [part, "both"]
+                and g_layer_idx % self.gnn_checkpoint_interval == 0)
+
+    @torch.no_grad()
+    def frozen_forward(self, inputs_embeds: torch.FloatTensor, attention_mask: Optional[torch.Tensor] = None):
+        r"""
+        Runs only the decoder layers below the first GNN layer. These layers are frozen when GOFA is trained with
+        `partial_grad`, so the output of a sequence is a function of its tokens only.
+
+        Returns:
+            The hidden states entering the first GNN layer, of shape `(batch_size, seq_length, hidden_size)`. They
+            can be fed back to `forward` with `from_boundary=True`.
+        """
+        batch_size, seq_length = inputs_embeds.shape[:2]
+        position_ids = torch.arange(seq_length, dtype=torch.long, device=inputs_embeds.device).unsqueeze(0)
+        attention_mask = self._prepare_gofa_attention_mask(attention_mask, batch_size, seq_length, inputs_embeds, 0)
+        hidden_states = inputs_embeds
+        for decoder_layer in self.layers[:self.num_frozen_layers]:
+            hidden_states = hidden_states.to(self.llama_dtype)
+            hidden_states = decoder_layer(hidden_states, attention_mask=attention_mask, position_ids=position_ids)[0]
+        return hidden_states
+
+    @torch.no_grad()
+    def prefix_kv(self, hidden_states: torch.FloatTensor, attention_mask: Optional[torch.Tensor] = None):
+        r"""
+        Runs the GNN-interleaved layers over the text tokens of node and edge sequences, given their outputs of
+        `frozen_forward`. Text tokens precede the memory tokens and the GNN layers only update memory tokens, so with
+        `partial_grad` the keys and values of text tokens in these layers are a function of their tokens only.
+
+        Returns:
+            A `GOFAPrefixCache` with the keys and values of every GNN-interleaved layer, to be used by `memory_forward`.
+        """
+        batch_size, seq_length = hidden_states.shape[:2]
+        position_ids = torch.arange(seq_length, dtype=torch.long, device=hidden_states.device).unsqueeze(0)
+        attention_mask = self._prepare_gofa_attention_mask(attention_mask, batch_size, seq_length, hidden_states, 0)
+        prefix_cache = GOFAPrefixCache()
+        for decoder_layer in self.layers[self.num_frozen_layers:]:
+            hidden_states = hidden_states.to(self.llama_dtype)
+            hidden_states = decoder_layer(hidden_states, attention_mask=attention_mask, position_ids=position_ids,
+                                          past_key_value=prefix_cache, use_cache=True)[0]
+        return prefix_cache
+
+    def memory_forward(self, mem_states: torch.FloatTensor, prefix_cache: GOFAPrefixCache, prefix_mask: torch.Tensor,
+                       graph=None, map_node=None):
+        r"""
+        Runs the GNN-interleaved layers on the memory tokens only. `mem_states` are the outputs of `frozen_forward`
+        at the memory-token positions, of shape `(num_sequences, mem_token, hidden_size)`. The text tokens are given
+        as keys and values by `prefix_cache` (see `prefix_kv`), left padded and marked by `prefix_mask` of shape
+        `(num_sequences, prefix_length)`.
+
+        Returns:
+            The final normed hidden states of the memory tokens, as returned by `encode_memory`.
+        """
+        batch_size, seq_length = mem_states.shape[:2]
+        prefix_length = prefix_mask.size(-1)
+        position_ids = prefix_mask.sum(dim=-1, keepdim=True) + torch.arange(seq_length, dtype=torch.long,
+                                                                            device=mem_states.device)
+        attention_mask = torch.cat([prefix_mask, prefix_mask.new_ones((batch_size, seq_length))], dim=-1)
+        attention_mask = self._prepare_gofa_attention_mask(attention_mask, batch_size, seq_length, mem_states,
+                                                           prefix_length)
+        hidden_states = mem_states
+        cur_node_size = graph.num_node_feat if graph is not None else 0
+        if graph is not None and map_node:
+            index = torch.cat([graph.node_map, torch.arange(cur_node_size, batch_size, device=graph.node_map.device)])
+            hidden_states = hidden_states[index]
+            position_ids = position_ids[index]
+            attention_mask = attention_mask[index]
+            prefix_cache = prefix_cache.index_select(index)
+            cur_node_size = len(graph.node_map)
+        for g_layer_idx, decoder_layer in enumerate(self.layers[self.num_frozen_layers:]):
+            if graph is not None:
+                output = self.g_layers[g_layer_idx](hidden_states[:cur_node_size], graph.edge_index,
+                                                    hidden_states[cur_node_size:], graph.edge_map)
+                hidden_states = torch.cat([output, hidden_states[cur_node_size:]], dim=0)
+            hidden_states = hidden_states.to(self.llama_dtype)
+            hidden_states = decoder_layer(hidden_states, attention_mask=attention_mask, position_ids=position_ids,
+                                          past_key_value=prefix_cache)[0]
+        return self.norm(hidden_states)
+
     def forward(
             self,
             input_ids: torch.LongTensor = None,
@@ -401,6 +956,10 @@ class GOFAMistralModel(MistralModel):
             mem_mask=None,
             partial_grad=None,
             map_node=None,
+            from_boundary=None,
+            packed_lengths=None,
+            output_mem_only=None,
+            mem_aligned=False,
     ) -> Union[Tuple, BaseModelOutputWithPast]:
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
@@ -432,7 +991,9 @@ class GOFAMistralModel(MistralModel):
                 past_key_values = DynamicCache.from_legacy_cache(past_key_values)
             past_key_values_length = past_key_values.get_usable_length(seq_length)
 
-        if position_ids is None:
+        if position_ids is None and packed_lengths is not None:
+            position_ids = packed_position_ids(packed_lengths).unsqueeze(0) + past_key_values_length
+        elif position_ids is None:
             device = input_ids.device if input_ids is not None else inputs_embeds.device
             position_ids = torch.arange(
                 past_key_values_length, seq_length + past_key_values_length, dtype=torch.long, device=device
@@ -442,26 +1003,16 @@ class GOFAMistralModel(MistralModel):
         if inputs_embeds is None:
             inputs_embeds = self.embed_tokens(input_ids)
 
-        if self._use_flash_attention_2:
-            # 2d mask is passed through the layers
-            attention_mask = attention_mask if (attention_mask is not None and 0 in attention_mask) else None
-        elif self._use_sdpa and not output_attentions:
-            # output_attentions=True can not be supported when using SDPA, and we fall back on
-            # the manual implementation that requires a 4D causal mask in all cases.
-            attention_mask = _prepare_4d_causal_attention_mask_for_sdpa(
-                attention_mask,
-                (batch_size, seq_length),
-                inputs_embeds,
-                past_key_values_length,
-            )
+        if packed_lengths is not None:
+            # sequences are packed into a single row, isolated from each other by a block-diagonal mask
+            if self._use_flash_attention_2:
+                raise ValueError("Packed sequences require a 4d attention mask, use eager or sdpa attention.")
+            attention_mask = _prepare_4d_packed_causal_attention_mask(packed_lengths, inputs_embeds.dtype,
+                                                                      self.config.sliding_window,
+                                                                      past_key_values_length)
         else:
-            # 4d mask is passed through the layers
-            # attention_mask = _prepare_4d_causal_attention_mask(
-            #     attention_mask, (batch_size, seq_length), inputs_embeds, past_key_values_length,
-            # )
-            attention_mask = _prepare_4d_causal_attention_mask(
-                attention_mask, (batch_size, seq_length), inputs_embeds, past_key_values_length, sliding_window=self.config.sliding_window,
-            )
+            attention_mask = self._prepare_gofa_attention_mask(attention_mask, batch_size, seq_length, inputs_embeds,
+                                                               past_key_values_length, output_attentions)
 
         # embed positions
         hidden_states = inputs_embeds
@@ -482,30 +1033,80 @@ class GOFAMistralModel(MistralModel):
             raise ValueError("Running GOFA requires at least mem_token inputs.")
 
         cur_node_size = graph.num_node_feat if graph is not None else 0
+        # with left padding, memory tokens are the last mem_token positions of every sequence and the GNN layers can
+        # read and write them as a slice instead of gathering and scattering with mem_mask. The caller knows the
+        # padding side, so mem_aligned is passed in rather than checked on mem_mask, which would sync with the device
+        mem_aligned = mem_aligned and not past_key_state and mem_mask is not None and packed_lengths is None
+        if output_mem_only and not mem_aligned:
+            raise ValueError("output_mem_only requires the memory tokens to be the last positions of every sequence.")
         for i, decoder_layer in enumerate(self.layers):
+            g_layer_idx = i - (len(self.layers) - len(self.g_layers))
+            if from_boundary and g_layer_idx < 0:
+                # inputs_embeds already are the outputs of frozen_forward
+                continue
             if output_hidden_states:
                 all_hidden_states += (hidden_states,)
-            g_layer_idx = i - (len(self.layers) - len(self.g_layers))
             if g_layer_idx >= 0 and not past_key_state and graph is not None:
-                if g_layer_idx == 0 and map_node:
+                if g_layer_idx == 0 and map_node and packed_lengths is not None:
+                    sequence_order = torch.cat([graph.node_map, torch.arange(
+                        cur_node_size, len(packed_lengths), device=graph.node_map.device)])
+                    token_index, packed_lengths = packed_token_index(packed_lengths, sequence_order)
+                    hidden_states = hidden_states[:, token_index]
+                    mem_mask = mem_mask[:, token_index]
+                    position_ids = position_ids[:, token_index]
+                    attention_mask = _prepare_4d_packed_causal_attention_mask(packed_lengths, attention_mask.dtype,
+                                                                              self.config.sliding_window)
+                    cur_node_size = len(graph.node_map)
+                elif g_layer_idx == 0 and map_node:
                     hidden_states = torch.cat(
                         [hidden_states[:cur_node_size][graph.node_map], hidden_states[cur_node_size:]],
                         dim=0)
                     mem_mask = torch.cat(
                         [mem_mask[:cur_node_size][graph.node_map], mem_mask[cur_node_size:]],
                         dim=0)
-                    attention_mask = torch.cat([attention_mask[:cur_node_size][graph.node_map], attention_mask[cur_node_size:]], dim=0)
+                    if attention_mask is not None:
+                        attention_mask = torch.cat(
+                            [attention_mask[:cur_node_size][graph.node_map], attention_mask[cur_node_size:]], dim=0)
+                    if position_ids.size(0) > 1:
+                        position_ids = torch.cat(
+                            [position_ids[:cur_node_size][graph.node_map], position_ids[cur_node_size:]], dim=0)
                     cur_node_size = len(graph.node_map)
-                mem_repr = hidden_states[mem_mask].view(hidden_states.size()[0], self.mem_token, -1)
+                if mem_aligned:
+                    # a copy of the memory rows only, so that writing hidden_states in place below does not modify
+                    # the input the GNN layer saved for backward
+                    mem_repr = hidden_states[:, -self.mem_token:].clone()
+                else:
+                    mem_repr = hidden_states[mem_mask].view(-1, self.mem_token, hidden_states.size()[-1])
                 gnn_input = mem_repr[:cur_node_size]
-                gnn_edge_input = mem_repr[cur_node_size:][graph.edge_map]
-
-                output = self.g_layers[g_layer_idx](gnn_input, graph.edge_index, gnn_edge_input)
-                output = torch.cat([output, mem_repr[cur_node_size:]], dim=0)
-                gnn_output = torch.zeros_like(hidden_states, dtype=output.dtype)
-                gnn_output[mem_mask] = output.view(-1, output.size()[-1])
-                hidden_states = hidden_states * torch.logical_not(mem_mask).unsqueeze(2) + gnn_output
-            if g_layer_idx < 0 and partial_grad:
+                gnn_edge_input = mem_repr[cur_node_size:]
+
+                if self._checkpoint_g_layer(g_layer_idx, "gnn"):
+                    output = torch.utils.checkpoint.checkpoint(self.g_layers[g_layer_idx], gnn_input,
+                                                               graph.edge_index, gnn_edge_input, graph.edge_map,
+                                                               use_reentrant=False)
+                else:
+                    output = self.g_layers[g_layer_idx](gnn_input, graph.edge_index, gnn_edge_input, graph.edge_map)
+                if mem_aligned and not output_hidden_states and hidden_states is not inputs_embeds:
+                    hidden_states[:cur_node_size, -self.mem_token:] = output.to(hidden_states.dtype)
+                elif mem_aligned:
+                    # never write into the caller's inputs_embeds or a hidden state that is returned
+                    output = torch.cat([output.to(hidden_states.dtype), mem_repr[cur_node_size:]], dim=0)
+                    hidden_states = torch.cat([hidden_states[:, :-self.mem_token], output], dim=1)
+                else:
+                    output = torch.cat([output, mem_repr[cur_node_size:]], dim=0)
+                    gnn_output = torch.zeros_like(hidden_states, dtype=output.dtype)
+                    gnn_output[mem_mask] = output.view(-1, output.size()[-1])
+                    hidden_states = hidden_states * torch.logical_not(mem_mask).unsqueeze(2) + gnn_output
+            if output_mem_only and i == len(self.layers) - 1:
+                # only the memory tokens are read from the last layer, the text tokens just provide keys and values
+                if self._checkpoint_g_layer(g_layer_idx, "decoder"):
+                    hidden_states = torch.utils.checkpoint.checkpoint(
+                        _last_rows_layer_forward, decoder_layer, hidden_states.to(self.llama_dtype), attention_mask,
+                        position_ids, self.mem_token, use_reentrant=False)
+                else:
+                    hidden_states = _last_rows_layer_forward(decoder_layer, hidden_states.to(self.llama_dtype),
+                                                             attention_mask, position_ids, self.mem_token)
+            elif g_layer_idx < 0 and partial_grad:
                 with torch.no_grad():
                     hidden_states = hidden_states.to(self.llama_dtype)
                     if self.gradient_checkpointing and self.training:
@@ -541,6 +1142,10 @@ class GOFAMistralModel(MistralModel):
                 if self.gradient_checkpointing and self.training:
                     layer_outputs = self._gradient_checkpointing_func(decoder_layer.__call__, hidden_states,
                         attention_mask, position_ids, past_key_values, output_attentions, use_cache, )
+                elif self._checkpoint_g_layer(g_layer_idx, "decoder") and not use_cache:
+                    layer_outputs = torch.utils.checkpoint.checkpoint(decoder_layer.__call__, hidden_states,
+                        attention_mask, position_ids, past_key_values, output_attentions, use_cache,
+                        use_reentrant=False)
                 else:
                     layer_outputs = decoder_layer(hidden_states, attention_mask=attention_mask,
                         position_ids=position_ids, past_key_value=past_key_values, output_attentions=output_attentions,
@@ -602,6 +1207,7 @@ class GOFAMistralForCausalLM(MistralForCausalLM):
         mem_mask = None,
         partial_grad = None,
         map_node = None,
+        packed_lengths = None,
     ) -> Union[Tuple, CausalLMOutputWithPast]:
         r"""
         Args:
@@ -649,6 +1255,7 @@ class GOFAMistralForCausalLM(MistralForCausalLM):
             mem_mask=mem_mask,
             partial_grad=partial_grad,
             map_node=map_node,
+            packed_lengths=packed_lengths,
         )
 
         hidden_states = outputs[0]
@@ -680,3 +1287,59 @@ class GOFAMistralForCausalLM(MistralForCausalLM):
             hidden_states=outputs.hidden_states,
             attentions=outputs.attentions,
         )
+
+    def encode_memory(
+        self,
+        inputs_embeds: torch.FloatTensor,
+        attention_mask: Optional[torch.Tensor] = None,
+        position_ids: Optional[torch.LongTensor] = None,
+        graph=None,
+        mem_mask=None,
+        partial_grad=None,
+        map_node=None,
+        from_boundary=None,
+        packed_lengths=None,
+        mem_aligned=False,
+    ) -> torch.FloatTensor:
+        r"""
+        Encoder entry point of GOFA. Runs the decoder stack without the `lm_head` projection and without collecting
+        intermediate hidden states or a kv cache.
+
+        Returns:
+            The final normed hidden states at the memory-token positions, of shape
+            `(num_sequences, mem_token, hidden_size)`. If `map_node` is set, node sequences are expanded by
+            `graph.node_map` in the same way as in the GNN layers. With `from_boundary`, `inputs_embeds` are the
+            hidden states returned by `frozen_forward` and only the GNN-interleaved layers are run. With
+            `packed_lengths`, all sequences are packed into a single row of `inputs_embeds` and `mem_mask`. With
+            `mem_aligned`, the memory tokens are the last positions of every sequence, as with left padding, and the
+            last decoder layer is only computed for the memory tokens.
+        """
+        mem_aligned = mem_aligned and packed_lengths is None
+        outputs = self.model(
+            inputs_embeds=inputs_embeds,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            use_cache=False,
+            output_attentions=False,
+            output_hidden_states=False,
+            return_dict=True,
+            graph=graph,
+            mem_mask=mem_mask,
+            partial_grad=partial_grad,
+            map_node=map_node,
+            from_boundary=from_boundary,
+            packed_lengths=packed_lengths,
+            output_mem_only=mem_aligned,
+            mem_aligned=mem_aligned,
+        )
+        hidden_states = outputs.last_hidden_state
+        if mem_aligned:
+            return hidden_states
+        if graph is not None and map_node and packed_lengths is not None:
+            sequence_order = torch.cat([graph.node_map, torch.arange(
+                graph.num_node_feat, len(packed_lengths), device=graph.node_map.device)])
+            mem_mask = mem_mask[:, packed_token_index(packed_lengths, sequence_order)[0]]
+        elif graph is not None and map_node:
+            mem_mask = torch.cat([mem_mask[:graph.num_node_feat][graph.node_map], mem_mask[graph.num_node_feat:]],
+                                 dim=0)
+        return hidden_states[mem_mask].view(-1, self.model.mem_token, hidden_states.size()[-1])
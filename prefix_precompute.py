@@ -0,0 +1,134 @@
+import argparse
+import os
+from types import SimpleNamespace
+
+import torch
+
+from gp.utils.utils import (load_yaml, combine_dict, merge_mod, )
+from gofa_models.config import GOFALlamaConfig, GOFAMistralConfig
+from gofa_models.helper import GOFALlamaHelper, GOFAMistralHelper, compute_prefix_states, frozen_namespace
+from gofa_models.state_cache import PrefixStateWriter
+from tasks import GOFAPretrainTaskWrapper
+
+# Precompute the frozen lower layers of the GOFA encoder for every unique edge text of saved pretrain tasks. The
+# store is read by run_gofa.py through the edge_prefix_store_dir option, so that edge texts only run the
+# GNN-interleaved top layers during training. Node texts are not stored: they start with a node id drawn at random
+# every time a sample is built, and the frozen states of all their tokens depend on it.
+
+TASK_NAMES = ["arxiv"]
+SAVE_NAMES = ["pretrain_0"]
+
+
+def build_helper(params):
+    if params.base_llm == 'llama7b':
+        from modules.gofa_icae_llama_modeling import ModelArguments, TrainingArguments
+        model_args, training_args, gofa_args = ModelArguments(), TrainingArguments(), GOFALlamaConfig(
+            num_layers=params.num_layers)
+        checkpoint = params.llama_pretrain_checkpoint
+        helper_cls = GOFALlamaHelper
+    elif params.base_llm == 'mistral7b':
+        from modules.gofa_icae_mistral_modeling import ModelArguments, TrainingArguments
+        model_args, training_args, gofa_args = ModelArguments(), TrainingArguments(), GOFAMistralConfig(
+            num_layers=params.num_layers)
+        checkpoint = params.mistral_pretrain_checkpoint
+        helper_cls = GOFAMistralHelper
+    else:
+        raise NotImplementedError(params.base_llm + " is not supported. Please choose from: llama7b, mistral7b,")
+    model_args.dec_lora = params.dec_lora
+    model_args.llama_pretrain_checkpoint = params.llama_pretrain_checkpoint
+    model_args.mistral_pretrain_checkpoint = params.mistral_pretrain_checkpoint
+    training_args.model_max_length = params.llm_max_length
+    if params.training_precision == "bf16-mixed":
+        training_args.bf16 = True
+        gofa_args.llama_dtype = torch.bfloat16
+    gofa_args.gnn_mlp_type = params.mlp_type
+    gofa_args.gnn_attention = params.gnn_attention
+    gofa_args.gnn_checkpoint = params.gnn_checkpoint
+    gofa_args.gnn_checkpoint_interval = params.gnn_checkpoint_interval
+    helper = helper_cls([model_args, training_args, gofa_args])
+    return helper, frozen_namespace(model_args, helper.model, checkpoint)
+
+
+def iterate_edge_texts(task):
+    for i in range(len(task)):
+        data = task[i]
+        if data is None or data.edge_attr is None:
+            continue
+        yield data.edge_attr.tolist()
+
+
+def write_batch(helper, writer, batch, mode):
+    batch = sorted(batch, key=lambda t: len(t[1]))
+    states = compute_prefix_states(helper.model, [t for _, t in batch], helper.mem_size, mode=mode)
+    for (key, token_ids), s in zip(batch, states):
+        writer.add(key, s, len(token_ids))
+
+
+def precompute(params, task_names, save_names, store_dir, mode="full", batch_size=32, shard_size=4.0,
+               dtype=torch.bfloat16):
+    helper, namespace = build_helper(params)
+    helper.train_mode()
+    helper.eval()
+    if torch.cuda.is_available():
+        helper.cuda()
+    base_model = helper.model.icae.get_base_model().model
+    config = base_model.config
+    meta = {"hidden_size": config.hidden_size}
+    if mode == "kv":
+        num_kv_heads = getattr(config, "num_key_value_heads", config.num_attention_heads)
+        meta.update({"mem_size": helper.mem_size, "num_layers": len(base_model.g_layers),
+                     "num_kv_heads": num_kv_heads, "head_dim": config.hidden_size // config.num_attention_heads})
+    writer = PrefixStateWriter(store_dir, namespace, mode, dtype, shard_size, **meta)
+    task = GOFAPretrainTaskWrapper(task_names, root=params.data_root_path, save_name=save_names, fast_data_load=True,
+                                   from_saved=True)
+
+    helper.model.icae.enable_adapter_layers()
+    batch = []
+    batch_keys = set()
+    for step, texts in enumerate(iterate_edge_texts(task)):
+        text_ids = helper.model.tokenizer(texts, truncation=True, max_length=params.llm_max_length, padding=False,
+                                          return_attention_mask=False)["input_ids"]
+        for t in text_ids:
+            t = t + helper.mem_tokens
+            key = writer.key(t)
+            if key in writer or key in batch_keys:
+                continue
+            batch.append((key, t))
+            batch_keys.add(key)
+        if len(batch) >= batch_size:
+            write_batch(helper, writer, batch, mode)
+            batch = []
+            batch_keys = set()
+        if step % 1000 == 0:
+            print(f"sample {step}/{len(task)}, {len(writer)} unique edge texts")
+    if len(batch) > 0:
+        write_batch(helper, writer, batch, mode)
+    helper.model.icae.disable_adapter_layers()
+    writer.close()
+    print(f"wrote {len(writer)} unique edge texts in {writer.num_shards} shards to {store_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="prefix precompute")
+    parser.add_argument("--override", type=str)
+    parser.add_argument("--store_dir", type=str, required=True)
+    parser.add_argument("--mode", type=str, default="full", choices=["full", "kv"])
+    parser.add_argument("--task_names", type=str, nargs="+", default=TASK_NAMES)
+    parser.add_argument("--save_names", type=str, nargs="+", default=SAVE_NAMES)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--shard_size", type=float, default=4.0, help="maximum shard size in GB")
+    parser.add_argument("opts", default=[], nargs=argparse.REMAINDER,
+                        help="Modify config options using the command-line", )
+
+    args = parser.parse_args()
+    configs = [load_yaml(os.path.join(os.path.dirname(__file__), "configs", "default_config.yaml"))]
+    if args.override is not None:
+        configs.append(load_yaml(args.override))
+    mod_params = combine_dict(*configs)
+    mod_params = merge_mod(mod_params, args.opts)
+    mod_params["data_root_path"] = mod_params["data_root_path"] if mod_params["data_root_path"] else os.environ.get(
+        "GGAMA_ROOT_DATA_PATH")
+    params = SimpleNamespace(**mod_params)
+    dtype = torch.bfloat16 if args.mode == "kv" or params.training_precision == "bf16-mixed" else torch.float16
+    precompute(params, args.task_names, args.save_names, args.store_dir, args.mode, args.batch_size, args.shard_size,
+               dtype)
@@ -1,70 +1,131 @@
 import torch
 
 from tasks import GOFAPretrainTaskWrapper
+from tasks.task_store import TaskStore, ShardedTaskStore, task_store_dir
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import os
+import os.path as osp
 import gc
+import json
 import random
 import numpy as np
 
 DATA_ROOT = "/storage1/yinjie.tang/Active/feng.jiarui/TAGDataset"
 SAVE_NAME_BASE = "pretrain"
 CS_MAX_LEFT_KEEP_LENGTH = 128
+# write the generated tasks as memory-mapped columnar stores instead of TAGLAS pickles
+TASK_STORE = False
+# generate every sample range in task store shards of SHARD_SIZE samples listed in a manifest, so that memory is bounded
+# by the shard size and an interrupted generation resumes from its complete shards. None generates ranges at once
+SHARD_SIZE = None
+# number of shards generated in parallel, each sampled with num_workers // NUM_SHARD_PROCESSES workers
+NUM_SHARD_PROCESSES = 4
+
+
+def seed_everything(seed):
+    random.seed(seed)
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+
+
+def build_task(dataset, sample_range, save_name, num_workers, task_store, seed=None, **kwargs):
+    if seed is not None:
+        seed_everything(seed)
+    task = GOFAPretrainTaskWrapper(task_names=dataset,
+                                   root=DATA_ROOT,
+                                   sample_size=sample_range,
+                                   save_name=save_name,
+                                   save_data=True,
+                                   task_store=task_store,
+                                   from_saved=False,
+                                   num_workers=num_workers,
+                                   **kwargs)
+    del task
+    gc.collect()
+
+
+def shard_plan(store_dir, sample_range):
+    r"""Load the shard plan of the sharded task store store_dir, or draw and save it on the first run. The plan holds
+    the sample range, SHARD_SIZE and the seed of every shard, so that shards generated by different runs all belong to
+    the same sampling.
+    """
+    plan_path = osp.join(store_dir, "shard_plan.json")
+    if osp.exists(plan_path):
+        with open(plan_path) as f:
+            plan = json.load(f)
+        if plan["sample_range"] != sample_range or plan["shard_size"] != SHARD_SIZE:
+            raise ValueError(f"{store_dir} was generated with a different sample range or SHARD_SIZE, remove it to "
+                             f"generate the task again")
+        return plan
+    num_shards = (len(sample_range) + SHARD_SIZE - 1) // SHARD_SIZE
+    # forked processes share the random state, so every shard is sampled with its own seed
+    plan = {"sample_range": sample_range, "shard_size": SHARD_SIZE,
+            "seeds": [random.randrange(2 ** 31) for _ in range(num_shards)]}
+    os.makedirs(store_dir, exist_ok=True)
+    tmp_path = plan_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(plan, f)
+    os.replace(tmp_path, plan_path)
+    return plan
+
+
+def generate_task(dataset, sample_range, save_name, num_workers, **kwargs):
+    r"""Generate the pretrain task of dataset on sample_range and save it as save_name. If SHARD_SIZE is set, the
+    range is split into shards that are generated on a process pool, each written atomically as a task store named
+    save_name/shard_xxxxx, and the manifest of the shards is written once all of them are complete. Shards left by an
+    interrupted run are kept, so running again only generates the missing ones with the shard plan of the first run.
+    """
+    if SHARD_SIZE is None:
+        build_task(dataset, sample_range, save_name, num_workers, TASK_STORE, **kwargs)
+        return
+    store_dir = task_store_dir(DATA_ROOT, dataset, save_name)
+    sample_range = [int(i) for i in sample_range[0]]
+    seeds = shard_plan(store_dir, sample_range)["seeds"]
+    shards = [sample_range[i:i + SHARD_SIZE] for i in range(0, len(sample_range), SHARD_SIZE)]
+    shard_names = [ShardedTaskStore.shard_name(i) for i in range(len(shards))]
+    pending = [i for i, name in enumerate(shard_names) if not TaskStore.exists(osp.join(store_dir, name))]
+    print(f"{dataset} {save_name}: {len(shards) - len(pending)} of {len(shards)} shards already generated")
+    shard_workers = max(num_workers // NUM_SHARD_PROCESSES, 1)
+    with ProcessPoolExecutor(NUM_SHARD_PROCESSES) as pool:
+        futures = [pool.submit(build_task, dataset, [shards[i]], osp.join(save_name, shard_names[i]), shard_workers,
+                               True, seeds[i], **kwargs) for i in pending]
+        for future in as_completed(futures):
+            future.result()
+    ShardedTaskStore.write_manifest(store_dir, shard_names)
+
 
 def generate_default_task(dataset, split, sample_range, node_task_save_name, num_workers, hop, num_nodes_per_hop,
                           node_task_list, additional_sentences,num_SP, num_CN, include_targets,
                           key_to_content_sample_range, key_to_content_task_save_name, content_to_key_sample_range,
                           content_to_key_task_save_name, num_LP=1, SP_from_targets=True, CN_from_targets=True):
 
-    node_task = GOFAPretrainTaskWrapper(task_names=dataset,
-                                        root=DATA_ROOT,
-                                        split=split,
-                                        sample_size=sample_range,
-                                        save_name=node_task_save_name,
-                                        save_data=True,
-                                        from_saved=False,
-                                        num_workers=num_workers,
-                                        hop=hop,
-                                        max_nodes_per_hop=num_nodes_per_hop,
-                                        pretrain_tasks=node_task_list,
-                                        num_additional_sentences=additional_sentences,
-                                        num_SP=num_SP,
-                                        num_CN=num_CN,
-                                        include_targets=include_targets,
-                                        left_keep_length=CS_MAX_LEFT_KEEP_LENGTH,
-                                        num_LP=num_LP,
-                                        SP_from_targets=SP_from_targets,
-                                        CN_from_targets=CN_from_targets,
-                                        )
-    del node_task
-    gc.collect()
-    key_to_content_task = GOFAPretrainTaskWrapper(task_names=dataset,
-                                                  root=DATA_ROOT,
-                                                  split=split,
-                                                  sample_size=key_to_content_sample_range,
-                                                  save_name=key_to_content_task_save_name,
-                                                  save_data=True,
-                                                  from_saved=False,
-                                                  num_workers=num_workers,
-                                                  hop=hop,
-                                                  max_nodes_per_hop=num_nodes_per_hop,
-                                                  pretrain_tasks=["IR"]
-                                                 )
-    del key_to_content_task
-    gc.collect()
-    content_to_key_task = GOFAPretrainTaskWrapper(task_names=dataset,
-                                                  root=DATA_ROOT,
-                                                  split=split,
-                                                  sample_size=content_to_key_sample_range,
-                                                  save_name=content_to_key_task_save_name,
-                                                  save_data=True,
-                                                  from_saved=False,
-                                                  num_workers=num_workers,
-                                                  hop=hop,
-                                                  max_nodes_per_hop=num_nodes_per_hop,
-                                                  pretrain_tasks=["IR"],
-                                                  content_to_key=True
-                                                  )
-    del content_to_key_task
-    gc.collect()
+    generate_task(dataset, sample_range, node_task_save_name, num_workers,
+                  split=split,
+                  hop=hop,
+                  max_nodes_per_hop=num_nodes_per_hop,
+                  pretrain_tasks=node_task_list,
+                  num_additional_sentences=additional_sentences,
+                  num_SP=num_SP,
+                  num_CN=num_CN,
+                  include_targets=include_targets,
+                  left_keep_length=CS_MAX_LEFT_KEEP_LENGTH,
+                  num_LP=num_LP,
+                  SP_from_targets=SP_from_targets,
+                  CN_from_targets=CN_from_targets,
+                  )
+    generate_task(dataset, key_to_content_sample_range, key_to_content_task_save_name, num_workers,
+                  split=split,
+                  hop=hop,
+                  max_nodes_per_hop=num_nodes_per_hop,
+                  pretrain_tasks=["IR"]
+                  )
+    generate_task(dataset, content_to_key_sample_range, content_to_key_task_save_name, num_workers,
+                  split=split,
+                  hop=hop,
+                  max_nodes_per_hop=num_nodes_per_hop,
+                  pretrain_tasks=["IR"],
+                  content_to_key=True
+                  )
 
 def generate_mag240m(epoch):
     dataset = "mag240m"
@@ -163,18 +224,10 @@ def generate_ultrachat200k(epoch):
     split = "all"
     num_workers = 32
     task_save_name = "_".join([SAVE_NAME_BASE, str(epoch)])
-    task = GOFAPretrainTaskWrapper(task_names=dataset,
-                                        root=DATA_ROOT,
-                                        split=split,
-                                        sample_size=sample_range,
-                                        save_name=task_save_name,
-                                        save_data=True,
-                                        from_saved=False,
-                                        num_workers=num_workers,
-                                        pretrain_tasks=task_list,
-                                        )
-    del task
-    gc.collect()
+    generate_task(dataset, sample_range, task_save_name, num_workers,
+                  split=split,
+                  pretrain_tasks=task_list,
+                  )
 
 def generate_wiki_graph(epoch):
     dataset = "wiki_graph"
@@ -50,11 +50,24 @@ def main(params):
     model_args.dec_lora = params.dec_lora
     model_args.llama_pretrain_checkpoint = params.llama_pretrain_checkpoint
     model_args.mistral_pretrain_checkpoint = params.mistral_pretrain_checkpoint
+    model_args.frozen_cache_size = params.frozen_cache_size
+    model_args.frozen_cache_dir = params.frozen_cache_dir
+    model_args.edge_prefix_store_dir = params.edge_prefix_store_dir
+    model_args.packed_sequences = params.packed_sequences
+    model_args.frozen_token_budget = params.frozen_token_budget
+    model_args.loss_chunk_size = params.loss_chunk_size
+    model_args.speculative_draft_tokens = params.speculative_draft_tokens
+    model_args.speculative_ngram_size = params.speculative_ngram_size
+    model_args.graph_cache_size = params.graph_cache_size
+    model_args.graph_cache_dir = params.graph_cache_dir
     training_args.model_max_length = params.llm_max_length
     if params.training_precision == "bf16-mixed":
         training_args.bf16 = True
         gofa_args.llama_dtype = torch.bfloat16
     gofa_args.gnn_mlp_type = params.mlp_type
+    gofa_args.gnn_attention = params.gnn_attention
+    gofa_args.gnn_checkpoint = params.gnn_checkpoint
+    gofa_args.gnn_checkpoint_interval = params.gnn_checkpoint_interval
 
     def data_size_filter(data: TAGData, **kwargs):
         estimated_mem = 24.495 + 0.4645 * len(data.node_map) + 0.0042 * len(
@@ -79,7 +92,8 @@ def main(params):
         #               "pretrain_", "pretrain_IR_kc_", "pertrain_IR_ck_", "pretrain_"]
 
         # save_names = [name + str(params.last_epochs) for name in save_names]
-        train_task = GOFAPretrainTaskWrapper(task_names, root=params.data_root_path, save_name=save_names, fast_data_load=True, from_saved=True, filter_func=filter_func)
+        train_task = GOFAPretrainTaskWrapper(task_names, root=params.data_root_path, save_name=save_names, fast_data_load=True, from_saved=True, filter_func=filter_func,
+                                             task_store=params.task_store)
 
         # val_tasks = GOFAPretrainTaskWrapper(["fb15k237"], root=params.data_root_path, save_name=["pretrain_IR_ck_0"], pretrain_tasks=['IR'], content_to_key=False, from_saved=False, save_data=False,
         #                                     split="val", sample_size=20, filter_func=filter_func)
@@ -232,6 +246,12 @@ def main(params):
     params.datamodule = DataModule(text_dataset, num_workers=params.num_workers)
 
     model = GOFA(transformer_args=[model_args, training_args, gofa_args], mode=params.mode, base_llm=params.base_llm, save_dir=params.exp_dir)
+    if params.dataloader_inputs:
+        for dataset in [train_task] + val_tasks + test_tasks:
+            dataset.data.set_batch_transform(model.batch_transform())
+    elif params.dataloader_tokenize:
+        for dataset in [train_task] + val_tasks + test_tasks:
+            dataset.data.set_tokenizer(model.llm_model.get_tokenizer(), params.llm_max_length)
     train_params = list(model.llm_model.model.icae.get_base_model().model.g_layers.parameters())
     if model_args.dec_lora:
         for name, param in model.llm_model.model.icae.named_parameters():
@@ -280,7 +300,7 @@ def main(params):
     exp_config = ExpConfig("", optimizer, lr_scheduler=lr_scheduler_config)
     exp_config.val_state_name = val_state
     exp_config.test_state_name = test_state
-    pred_model = GraphTextPredLightning(exp_config, model, metrics)
+    pred_model = GraphTextPredLightning(exp_config, model, metrics, async_postprocess=params.async_postprocess)
     if params.load_model:
         print("-"*60+"LOADING"+"-"*60)
         if os.path.isdir(params.load_dir):
@@ -54,6 +54,9 @@ def main(params):
         training_args.bf16 = True
         gofa_args.llama_dtype = torch.bfloat16
     gofa_args.gnn_mlp_type = params.mlp_type
+    gofa_args.gnn_attention = params.gnn_attention
+    gofa_args.gnn_checkpoint = params.gnn_checkpoint
+    gofa_args.gnn_checkpoint_interval = params.gnn_checkpoint_interval
 
 
     if params.run_mode == "pretrain":
@@ -39,6 +39,30 @@ def sample_k_labels_with_true(
     return label_sample_list
 
 
+def select_labels(data, label_list: Union[list[str], np.ndarray], selection: bool = True, way: int = -1):
+    r"""
+    Select the candidate labels of a node or link classification prompt and build the prompt listing them. The
+    candidates are also kept on the sample as data.candidates, which the autoencoderscore mode of GOFA scores directly.
+
+    Parameters:
+    data: The task sample, with the index of its true label in data.label_map.
+    label_list (list[str]): A complete list of labels.
+    selection (bool, optional): If true, sample way labels containing the true one and list them in the prompt.
+    way (int, optional): The number of labels to be sampled, -1 for all labels.
+
+    Returns:
+    tuple[list[str], str]: The candidate labels and the selection prompt, empty if selection is false.
+    """
+    if selection:
+        label_selection_list = sample_k_labels_with_true(label_list, data.label_map.item(), way=way)
+        selection_prompt = " Choose from the following: " + "; ".join(label_selection_list) + "."
+    else:
+        label_selection_list = label_list
+        selection_prompt = ""
+    data.candidates = list(label_selection_list)
+    return label_selection_list, selection_prompt
+
+
 def build_finetune_task_prompt(data, task_class, task_name, way=5, selection=True, instruction=True, **kwargs):
 
     if not selection and not instruction:
@@ -63,12 +87,7 @@ def cora_node_prompt(data, task_class, selection=True, way=-1, instruction=True,
     question = data.question
     graph_description = task_class.dataset.graph_description
     label_list = task_class.dataset.label[:-2]
-    if selection:
-        label_selection_list = sample_k_labels_with_true(label_list, data.label_map.item(), way=way)
-        selection_prompt = " Choose from the following: " + "; ".join(label_selection_list) + "."
-    else:
-        label_selection_list = label_list
-        selection_prompt = ""
+    label_selection_list, selection_prompt = select_labels(data, label_list, selection, way)
 
     if instruction:
         label_desc = task_class.dataset.side_data.label_description
@@ -104,12 +123,7 @@ def pubmed_node_prompt(data, task_class, selection=True, way=-1, instruction=Tru
     question = data.question
     graph_description = task_class.dataset.graph_description
     label_list = task_class.dataset.label[:-2]
-    if selection:
-        label_selection_list = sample_k_labels_with_true(label_list, data.label_map.item(), way=way)
-        selection_prompt = " Choose from the following: " + "; ".join(label_selection_list) + "."
-    else:
-        label_selection_list = label_list
-        selection_prompt = ""
+    label_selection_list, selection_prompt = select_labels(data, label_list, selection, way)
 
     if instruction:
         label_desc = task_class.dataset.side_data.label_description
@@ -146,12 +160,7 @@ def arxiv_prompt(data, task_class, selection=True, way=-1, instruction=True, **k
     question = data.question
     graph_description = task_class.dataset.graph_description
     label_list = task_class.dataset.label[:-2]
-    if selection:
-        label_selection_list = sample_k_labels_with_true(label_list, data.label_map.item(), way=way)
-        selection_prompt = " Choose from the following: " + "; ".join(label_selection_list) + "."
-    else:
-        label_selection_list = label_list
-        selection_prompt = ""
+    label_selection_list, selection_prompt = select_labels(data, label_list, selection, way)
 
     if instruction:
         label_desc = task_class.dataset.side_data.label_description
@@ -169,12 +178,7 @@ def wikics_prompt(data, task_class, selection=True, way=-1, instruction=True, **
     question = data.question
     graph_description = task_class.dataset.graph_description
     label_list = task_class.dataset.label
-    if selection:
-        label_selection_list = sample_k_labels_with_true(label_list, data.label_map.item(), way=way)
-        selection_prompt = " Choose from the following: " + "; ".join(label_selection_list) + "."
-    else:
-        label_selection_list = label_list
-        selection_prompt = ""
+    label_selection_list, selection_prompt = select_labels(data, label_list, selection, way)
 
     if instruction:
         label_desc = task_class.dataset.side_data.label_description
@@ -192,12 +196,7 @@ def products_prompt(data, task_class, selection=True, way=-1, instruction=True,
     question = data.question
     graph_description = task_class.dataset.graph_description
     label_list = task_class.dataset.label
-    if selection:
-        label_selection_list = sample_k_labels_with_true(label_list, data.label_map.item(), way=way)
-        selection_prompt = " Choose from the following: " + "; ".join(label_selection_list) + "."
-    else:
-        label_selection_list = label_list
-        selection_prompt = ""
+    label_selection_list, selection_prompt = select_labels(data, label_list, selection, way)
 
     if instruction:
         label_desc = task_class.dataset.side_data.label_description
@@ -214,12 +213,7 @@ def fb15k237_prompt(data, task_class, selection=True, way=-1, instruction=True,
     question = data.question
     graph_description = task_class.dataset.graph_description
     label_list = task_class.dataset.label
-    if selection:
-        label_selection_list = sample_k_labels_with_true(label_list, data.label_map.item(), way=way)
-        selection_prompt = " Choose from the following: " + "; ".join(label_selection_list) + "."
-    else:
-        label_selection_list = label_list
-        selection_prompt = ""
+    label_selection_list, selection_prompt = select_labels(data, label_list, selection, way)
 
     if instruction:
         label_desc = task_class.dataset.side_data.label_description
@@ -238,12 +232,7 @@ def wn18rr_prompt(data, task_class, selection=True, way=-1, instruction=True, **
     question = data.question
     graph_description = task_class.dataset.graph_description
     label_list = task_class.dataset.label
-    if selection:
-        label_selection_list = sample_k_labels_with_true(label_list, data.label_map.item(), way=way)
-        selection_prompt = " Choose from the following: " + "; ".join(label_selection_list) + "."
-    else:
-        label_selection_list = label_list
-        selection_prompt = ""
+    label_selection_list, selection_prompt = select_labels(data, label_list, selection, way)
 
     if instruction:
         label_desc = task_class.dataset.side_data.label_description
@@ -10,6 +10,7 @@ from torch import Tensor, LongTensor
 import torch
 import numpy as np
 from .pretrain_task_base import get_pretrain_task
+from .task_store import TaskStoreMixin
 
 def create_dummy_data():
     edge_index = torch.tensor([[0, 1], [1, 0]], dtype=torch.long)
@@ -23,18 +24,68 @@ def create_dummy_data():
             question=question_list, answer=answer_list, label=label_list)
 
 
-class GOFAGraphPretrainTask(GQATask):
+class TextInterner:
+    r"""Ids of texts in the order of their first occurrence, with equal texts getting the same id. Texts are interned
+    one sample at a time in a dict, so time is linear in the number of texts and memory is bounded by the unique
+    texts, unlike np.unique, which sorts object arrays of all texts.
+    """
+    def __init__(self):
+        self.ids = {}
+
+    def __call__(self, texts):
+        return torch.tensor([self.ids.setdefault(text, len(self.ids)) for text in texts], dtype=torch.long)
+
+    def features(self):
+        r"""Object array of the unique texts, indexed by their ids."""
+        unique_texts = np.empty(len(self.ids), dtype=object)
+        unique_texts[:] = list(self.ids)
+        return unique_texts
+
+
+def intern_task_texts(task_class, data_list):
+    r"""Keep the samples of data_list with an edge_index and questions, and set their node_map, question_map,
+    answer_map and label_map to the ids of their node texts, questions, answers and labels among the unique texts
+    of all kept samples. The unique texts are set as the node, label, question and answer features of task_class.
+    Returns the kept samples.
+    """
+    node_texts, questions, answers, labels = TextInterner(), TextInterner(), TextInterner(), TextInterner()
+    x = task_class.data.x
+    kept_data_list = []
+    for data in data_list:
+        if "edge_index" not in data or getattr(data, "edge_index") is None or len(data.question) == 0:
+            continue
+        data.node_map = node_texts([x[i] for i in data.node_map.tolist()])
+        data.question_map = questions(data.question)
+        data.answer_map = answers(data.answer)
+        data.label_map = labels(data.label)
+        kept_data_list.append(data)
+
+    task_class.additional_data = (node_texts.features(), labels.features())
+    task_class.question_features = questions.features()
+    task_class.answer_features = answers.features()
+    return kept_data_list
+
+
+class GOFAGraphPretrainTask(TaskStoreMixin, GQATask):
     r"""GOFA graph-level pretrain task class.
     """
     def __init__(
             self,
             pretrain_tasks: list[str] = ["DS"],
+            store_dir: Optional[str] = None,
+            from_store: bool = False,
+            save_store: bool = False,
             **kwargs):
         self.pretrain_tasks = get_pretrain_task(pretrain_tasks, **kwargs)
+        self.store_dir = store_dir
+        self.from_store = from_store
+        self.save_store = save_store
         super().__init__(**kwargs)
 
     def __before_process__(self) -> None:
         super().__before_process__()
+        if self.__store_ready__():
+            return
         for task in self.pretrain_tasks:
             task.before_process(self)
 
@@ -77,58 +128,10 @@ class GOFAGraphPretrainTask(GQATask):
 
 
     def __build_task__(self):
-        data_list_ = parallel_build_sample_process(self, graph_level=True)
-        data_list = []
-        for data in data_list_:
-            if "edge_index" in data and getattr(data, "edge_index") is not None and len(data.question) > 0:
-                data_list.append(data)
-        node_text_list = []
-        node_index_list = []
-        question_list = []
-        question_index_list = []
-        answer_list = []
-        answer_index_list = []
-        label_list = []
-        label_index_list = []
-        for data in data_list:
-            node_text = [self.data.x[i] for i in data.node_map]
-            num_nodes = len(node_text)
-            node_index_list.append(np.arange(len(node_text_list), num_nodes + len(node_text_list)))
-            node_text_list.extend(node_text)
-
-            question = data.question
-            num_question = len(question)
-            question_index_list.append(np.arange(len(question_list), num_question + len(question_list)))
-            question_list.extend(question)
-
-            answer = data.answer
-            num_answer = len(answer)
-            answer_index_list.append(np.arange(len(answer_list), num_answer + len(answer_list)))
-            answer_list.extend(answer)
-
-            label = data.label
-            num_label = len(label)
-            label_index_list.append(np.arange(len(label_list), num_label + len(label_list)))
-            label_list.extend(label)
-
-
-        unique_question, unique_question_map = np.unique(np.array(question_list, dtype=object), return_inverse=True)
-        unique_answer, unique_answer_map = np.unique(np.array(answer_list, dtype=object), return_inverse=True)
-        unique_label, unique_label_map = np.unique(np.array(label_list, dtype=object), return_inverse=True)
-        unique_node_text, unique_node_map = np.unique(np.array(node_text_list, dtype=object), return_inverse=True)
-
-        for i in range(len(data_list)):
-            data_list[i].question_map = torch.tensor(unique_question_map[question_index_list[i]]).long()
-            data_list[i].answer_map = torch.tensor(unique_answer_map[answer_index_list[i]]).long()
-            data_list[i].label_map = torch.tensor(unique_label_map[label_index_list[i]]).long()
-            data_list[i].node_map = torch.tensor(unique_node_map[node_index_list[i]]).long()
-
-
-        self.additional_data = (unique_node_text, unique_label)
-        self.question_features = unique_question
-        self.answer_features = unique_answer
-
-        return data_list
+        if self.__store_ready__():
+            return self.__open_store__()
+        data_list = intern_task_texts(self, parallel_build_sample_process(self, graph_level=True))
+        return self.__save_store__(data_list)
 
     def __get_node_feature__(self) -> Union[Tensor, np.ndarray, list, None]:
         return self.additional_data[0]
@@ -142,14 +145,20 @@ class GOFAGraphPretrainTask(GQATask):
             task.after_process(self)
 
 
-class GOFANodePretrainTask(NQATask):
+class GOFANodePretrainTask(TaskStoreMixin, NQATask):
     r"""GOFA node-level pretrain task class. Will load corresponding pretrain tasks given input.
     """
     def __init__(
             self,
             pretrain_tasks: list[str] = ["CS"],
+            store_dir: Optional[str] = None,
+            from_store: bool = False,
+            save_store: bool = False,
             **kwargs):
         self.pretrain_tasks = get_pretrain_task(pretrain_tasks, **kwargs)
+        self.store_dir = store_dir
+        self.from_store = from_store
+        self.save_store = save_store
         super().__init__(**kwargs)
 
 
@@ -163,6 +172,8 @@ class GOFANodePretrainTask(NQATask):
 
     def __before_process__(self) -> None:
         super().__before_process__()
+        if self.__store_ready__():
+            return
         for task in self.pretrain_tasks:
             task.before_process(self)
 
@@ -204,58 +215,10 @@ class GOFANodePretrainTask(NQATask):
                        question=question_list, answer=answer_list, label=label_list)
 
     def __build_task__(self):
-        data_list_ = parallel_build_sample_process(self)
-        data_list = []
-        for data in data_list_:
-            if "edge_index" in data and getattr(data, "edge_index") is not None and len(data.question) > 0:
-                data_list.append(data)
-        node_text_list = []
-        node_index_list = []
-        question_list = []
-        question_index_list = []
-        answer_list = []
-        answer_index_list = []
-        label_list = []
-        label_index_list = []
-        for data in data_list:
-            node_text = [self.data.x[i] for i in data.node_map]
-            num_nodes = len(node_text)
-            node_index_list.append(np.arange(len(node_text_list), num_nodes + len(node_text_list)))
-            node_text_list.extend(node_text)
-
-            question = data.question
-            num_question = len(question)
-            question_index_list.append(np.arange(len(question_list), num_question + len(question_list)))
-            question_list.extend(question)
-
-            answer = data.answer
-            num_answer = len(answer)
-            answer_index_list.append(np.arange(len(answer_list), num_answer + len(answer_list)))
-            answer_list.extend(answer)
-
-            label = data.label
-            num_label = len(label)
-            label_index_list.append(np.arange(len(label_list), num_label + len(label_list)))
-            label_list.extend(label)
-
-
-        unique_question, unique_question_map = np.unique(np.array(question_list, dtype=object), return_inverse=True)
-        unique_answer, unique_answer_map = np.unique(np.array(answer_list, dtype=object), return_inverse=True)
-        unique_label, unique_label_map = np.unique(np.array(label_list, dtype=object), return_inverse=True)
-        unique_node_text, unique_node_map = np.unique(np.array(node_text_list, dtype=object), return_inverse=True)
-
-        for i in range(len(data_list)):
-            data_list[i].question_map = torch.tensor(unique_question_map[question_index_list[i]]).long()
-            data_list[i].answer_map = torch.tensor(unique_answer_map[answer_index_list[i]]).long()
-            data_list[i].label_map = torch.tensor(unique_label_map[label_index_list[i]]).long()
-            data_list[i].node_map = torch.tensor(unique_node_map[node_index_list[i]]).long()
-
-
-        self.additional_data = (unique_node_text, unique_label)
-        self.question_features = unique_question
-        self.answer_features = unique_answer
-
-        return data_list
+        if self.__store_ready__():
+            return self.__open_store__()
+        data_list = intern_task_texts(self, parallel_build_sample_process(self))
+        return self.__save_store__(data_list)
 
     def __get_node_feature__(self) -> Union[Tensor, np.ndarray, list, None]:
         return self.additional_data[0]
@@ -269,19 +232,27 @@ class GOFANodePretrainTask(NQATask):
             task.after_process(self)
 
 
-class GOFALinkPretrainTask(LQATask):
+class GOFALinkPretrainTask(TaskStoreMixin, LQATask):
     r"""GOFA link-level pretrain task class.
     """
 
     def __init__(
             self,
             pretrain_tasks: list[str] = ["CS"],
+            store_dir: Optional[str] = None,
+            from_store: bool = False,
+            save_store: bool = False,
             **kwargs):
         self.pretrain_tasks = get_pretrain_task(pretrain_tasks, **kwargs)
+        self.store_dir = store_dir
+        self.from_store = from_store
+        self.save_store = save_store
         super().__init__(**kwargs)
 
     def __before_process__(self) -> None:
         super().__before_process__()
+        if self.__store_ready__():
+            return
         for task in self.pretrain_tasks:
             task.before_process(self)
 
@@ -323,58 +294,10 @@ class GOFALinkPretrainTask(LQATask):
                        question=question_list, answer=answer_list, label=label_list)
 
     def __build_task__(self):
-        data_list_ = parallel_build_sample_process(self)
-        data_list = []
-        for data in data_list_:
-            if "edge_index" in data and getattr(data, "edge_index") is not None and len(data.question) > 0:
-                data_list.append(data)
-        node_text_list = []
-        node_index_list = []
-        question_list = []
-        question_index_list = []
-        answer_list = []
-        answer_index_list = []
-        label_list = []
-        label_index_list = []
-        for data in data_list:
-            node_text = [self.data.x[i] for i in data.node_map]
-            num_nodes = len(node_text)
-            node_index_list.append(np.arange(len(node_text_list), num_nodes + len(node_text_list)))
-            node_text_list.extend(node_text)
-
-            question = data.question
-            num_question = len(question)
-            question_index_list.append(np.arange(len(question_list), num_question + len(question_list)))
-            question_list.extend(question)
-
-            answer = data.answer
-            num_answer = len(answer)
-            answer_index_list.append(np.arange(len(answer_list), num_answer + len(answer_list)))
-            answer_list.extend(answer)
-
-            label = data.label
-            num_label = len(label)
-            label_index_list.append(np.arange(len(label_list), num_label + len(label_list)))
-            label_list.extend(label)
-
-
-        unique_question, unique_question_map = np.unique(np.array(question_list, dtype=object), return_inverse=True)
-        unique_answer, unique_answer_map = np.unique(np.array(answer_list, dtype=object), return_inverse=True)
-        unique_label, unique_label_map = np.unique(np.array(label_list, dtype=object), return_inverse=True)
-        unique_node_text, unique_node_map = np.unique(np.array(node_text_list, dtype=object), return_inverse=True)
-
-        for i in range(len(data_list)):
-            data_list[i].question_map = torch.tensor(unique_question_map[question_index_list[i]]).long()
-            data_list[i].answer_map = torch.tensor(unique_answer_map[answer_index_list[i]]).long()
-            data_list[i].label_map = torch.tensor(unique_label_map[label_index_list[i]]).long()
-            data_list[i].node_map = torch.tensor(unique_node_map[node_index_list[i]]).long()
-
-
-        self.additional_data = (unique_node_text, unique_label)
-        self.question_features = unique_question
-        self.answer_features = unique_answer
-
-        return data_list
+        if self.__store_ready__():
+            return self.__open_store__()
+        data_list = intern_task_texts(self, parallel_build_sample_process(self))
+        return self.__save_store__(data_list)
 
     def __get_node_feature__(self) -> Union[Tensor, np.ndarray, list, None]:
         return self.additional_data[0]
@@ -0,0 +1,272 @@
+import json
+import os
+import os.path as osp
+import shutil
+from typing import Optional
+
+import numpy as np
+import torch
+from TAGLAS.data import TAGData
+
+
+class TextColumn:
+    r"""Read-only array of texts stored as one UTF-8 blob and the int64 offsets of every text into it. Both are
+    memory-mapped, so opening is O(1) and processes that open the same column share its pages. Indexing with an int
+    returns a str, with a slice, index array or tensor an object array of str like indexing a numpy array of texts.
+    """
+    def __init__(self, prefix):
+        self.blob = np.load(prefix + ".text.npy", mmap_mode="r")
+        self.offsets = np.load(prefix + ".offsets.npy", mmap_mode="r")
+
+    @staticmethod
+    def write(prefix, texts):
+        encoded = [t.encode("utf-8") for t in texts]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        np.save(prefix + ".text.npy", np.frombuffer(b"".join(encoded), dtype=np.uint8))
+        np.save(prefix + ".offsets.npy", offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def text(self, i):
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode("utf-8")
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)) or (isinstance(index, torch.Tensor) and index.dim() == 0):
+            return self.text(int(index) % len(self))
+        if isinstance(index, torch.Tensor):
+            index = index.numpy()
+        index = np.arange(len(self))[index]
+        texts = np.empty(len(index), dtype=object)
+        texts[:] = [self.text(i) for i in index.tolist()]
+        return texts
+
+    def __iter__(self):
+        return (self.text(i) for i in range(len(self)))
+
+    def tolist(self):
+        return list(self)
+
+
+class RaggedColumn:
+    r"""Read-only rows of different lengths of an integer array, stored as the concatenated rows and the int64 offsets
+    of every row, both memory-mapped. Rows are concatenated along the first dimension.
+    """
+    def __init__(self, prefix):
+        self.values = np.load(prefix + ".values.npy", mmap_mode="r")
+        self.offsets = np.load(prefix + ".offsets.npy", mmap_mode="r")
+
+    @staticmethod
+    def write(prefix, rows, dtype=np.int64, row_shape=()):
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum([len(r) for r in rows], out=offsets[1:])
+        values = np.empty((int(offsets[-1]),) + row_shape, dtype=dtype)
+        for start, end, r in zip(offsets[:-1], offsets[1:], rows):
+            values[start:end] = r
+        np.save(prefix + ".values.npy", values)
+        np.save(prefix + ".offsets.npy", offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return np.array(self.values[self.offsets[i]:self.offsets[i + 1]])
+
+
+class TextColumns(TextColumn):
+    r"""TextColumns concatenated into one read-only column without copying them, e.g. the texts of all shards of a
+    ShardedTaskStore.
+    """
+    def __init__(self, columns):
+        self.columns = columns
+        self.starts = np.zeros(len(columns) + 1, dtype=np.int64)
+        np.cumsum([len(c) for c in columns], out=self.starts[1:])
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def text(self, i):
+        c = np.searchsorted(self.starts, i, side="right") - 1
+        return self.columns[c].text(i - self.starts[c])
+
+
+def as_index_list(value):
+    return torch.as_tensor(value).view(-1).tolist()
+
+
+class TaskStore:
+    r"""Columnar on-disk storage of a generated GOFA pretrain task, replacing the python list of TAGData samples and
+    the object arrays of unique texts. Texts are TextColumns and the per-sample node_map, edge_map, question_map,
+    answer_map, label_map and edge_index are RaggedColumns, with the edges of every sample packed into one row. The
+    target_index of every question is a row of the column target_index, and target_offsets are the offsets of the
+    questions of every sample into its rows. Every file is memory-mapped, so opening a store is O(1) in its size and
+    DataLoader workers share its pages instead of copying them. Indexing a store builds the TAGData of a sample from
+    views of the columns, with the question, answer and label texts looked up from their maps.
+    Args:
+        root (str): directory of the store, written by TaskStore.write.
+    """
+    text_columns = ["node_text", "question", "answer", "label"]
+    map_columns = ["node_map", "edge_map", "question_map", "answer_map", "label_map"]
+
+    def __init__(self, root):
+        self.root = root
+        with open(osp.join(root, "meta.json")) as f:
+            self.meta = json.load(f)
+        for name in self.text_columns:
+            setattr(self, name, TextColumn(osp.join(root, name)))
+        for name in self.map_columns + ["edge_index", "target_index"]:
+            setattr(self, name, RaggedColumn(osp.join(root, name)))
+        self.target_offsets = np.load(osp.join(root, "target_offsets.npy"), mmap_mode="r")
+
+    @staticmethod
+    def exists(root):
+        return osp.exists(osp.join(root, "meta.json"))
+
+    @staticmethod
+    def write(root, data_list, node_text, question, answer, label):
+        r"""Write the samples data_list, with node_map, question_map, answer_map and label_map indexing the unique
+        texts node_text, question, answer and label. The store is written to a temporary directory that replaces
+        root once complete, so an interrupted write never leaves a partial store behind.
+        """
+        tmp_root = root.rstrip("/") + ".tmp"
+        shutil.rmtree(tmp_root, ignore_errors=True)
+        os.makedirs(tmp_root)
+        for name, texts in zip(TaskStore.text_columns, [node_text, question, answer, label]):
+            TextColumn.write(osp.join(tmp_root, name), texts)
+        for name in TaskStore.map_columns:
+            RaggedColumn.write(osp.join(tmp_root, name), [torch.as_tensor(getattr(data, name)).view(-1).numpy()
+                                                           for data in data_list])
+        RaggedColumn.write(osp.join(tmp_root, "edge_index"), [data.edge_index.t().numpy() for data in data_list],
+                           row_shape=(2,))
+        target_index = [as_index_list(t) for data in data_list for t in data.target_index]
+        RaggedColumn.write(osp.join(tmp_root, "target_index"), target_index)
+        target_offsets = np.zeros(len(data_list) + 1, dtype=np.int64)
+        np.cumsum([len(data.target_index) for data in data_list], out=target_offsets[1:])
+        np.save(osp.join(tmp_root, "target_offsets.npy"), target_offsets)
+        with open(osp.join(tmp_root, "meta.json"), "w") as f:
+            json.dump({"num_samples": len(data_list)}, f)
+        shutil.rmtree(root, ignore_errors=True)
+        os.replace(tmp_root, root)
+
+    def __len__(self):
+        return self.meta["num_samples"]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        question_map = self.question_map[index]
+        answer_map = self.answer_map[index]
+        label_map = self.label_map[index]
+        target_index = [self.target_index[i].tolist()
+                        for i in range(self.target_offsets[index], self.target_offsets[index + 1])]
+        return TAGData(edge_index=torch.from_numpy(self.edge_index[index].T.copy()),
+                       node_map=torch.from_numpy(self.node_map[index]), edge_map=torch.from_numpy(self.edge_map[index]),
+                       target_index=target_index, question=[self.question.text(i) for i in question_map.tolist()],
+                       answer=[self.answer.text(i) for i in answer_map.tolist()],
+                       label=[self.label.text(i) for i in label_map.tolist()],
+                       question_map=torch.from_numpy(question_map), answer_map=torch.from_numpy(answer_map),
+                       label_map=torch.from_numpy(label_map))
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class ShardedTaskStore:
+    r"""TaskStores of the shards of one generated pretrain task, read as one store. The shards are the directories
+    listed in root/manifest.json, which is written once all of them are complete. The texts of the shards are
+    concatenated into TextColumns, and the maps of a sample, which index the texts of its shard, are offset by the
+    start of its shard's texts, so samples index the concatenated texts like the samples of one TaskStore.
+    Args:
+        root (str): directory of the shards and their manifest, written by ShardedTaskStore.write_manifest.
+    """
+    def __init__(self, root):
+        self.root = root
+        with open(osp.join(root, "manifest.json")) as f:
+            self.manifest = json.load(f)
+        self.shards = [TaskStore(osp.join(root, name)) for name in self.manifest["shards"]]
+        self.sample_starts = np.zeros(len(self.shards) + 1, dtype=np.int64)
+        np.cumsum([len(shard) for shard in self.shards], out=self.sample_starts[1:])
+        for name in TaskStore.text_columns:
+            setattr(self, name, TextColumns([getattr(shard, name) for shard in self.shards]))
+
+    @staticmethod
+    def exists(root):
+        return osp.exists(osp.join(root, "manifest.json"))
+
+    @staticmethod
+    def shard_name(index):
+        return f"shard_{index:05d}"
+
+    @staticmethod
+    def write_manifest(root, shard_names):
+        r"""List the complete TaskStores root/shard_name of shard_names, in order, as the shards of the store root."""
+        manifest = {"shards": list(shard_names),
+                    "num_samples": sum(len(TaskStore(osp.join(root, name))) for name in shard_names)}
+        tmp_path = osp.join(root, "manifest.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, osp.join(root, "manifest.json"))
+
+    def __len__(self):
+        return int(self.sample_starts[-1])
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        s = np.searchsorted(self.sample_starts, index, side="right") - 1
+        data = self.shards[s][index - self.sample_starts[s]]
+        for text_name, map_name in zip(TaskStore.text_columns, ["node_map", "question_map", "answer_map", "label_map"]):
+            data[map_name] = data[map_name] + int(getattr(self, text_name).starts[s])
+        return data
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+def task_store_dir(root, name, save_name):
+    r"""Directory of the task store of the dataset name saved as save_name."""
+    return osp.join(root, "task_store", name, save_name)
+
+
+def task_store_exists(root):
+    return ShardedTaskStore.exists(root) or TaskStore.exists(root)
+
+
+def open_task_store(root):
+    r"""Open the store root, which is either a ShardedTaskStore or a TaskStore."""
+    if ShardedTaskStore.exists(root):
+        return ShardedTaskStore(root)
+    return TaskStore(root)
+
+
+class TaskStoreMixin:
+    r"""Storage of the generated samples of a pretrain task class in a TaskStore instead of a TAGLAS pickle. The
+    task class sets store_dir, from_store and save_store before the TAGLAS task initialization, which builds the
+    task. If from_store is set and store_dir holds a TaskStore or a ShardedTaskStore, __build_task__ opens it instead of
+    building samples and the pretrain tasks skip their before_process. Otherwise the built task is written to the
+    store if save_store is set.
+    """
+    store_dir: Optional[str] = None
+    from_store: bool = False
+    save_store: bool = False
+
+    def __store_ready__(self):
+        return self.store_dir is not None and self.from_store and task_store_exists(self.store_dir)
+
+    def __open_store__(self):
+        store = open_task_store(self.store_dir)
+        self.additional_data = (store.node_text, store.label)
+        self.question_features = store.question
+        self.answer_features = store.answer
+        return store
+
+    def __save_store__(self, data_list):
+        r"""Write data_list and the unique texts to the store if save_store and return the opened store, so that the
+        samples are served from the memory-mapped columns, else return data_list.
+        """
+        if self.store_dir is None or not self.save_store:
+            return data_list
+        TaskStore.write(self.store_dir, data_list, self.additional_data[0], self.question_features,
+                        self.answer_features, self.additional_data[1])
+        return self.__open_store__()
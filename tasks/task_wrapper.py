@@ -19,6 +19,8 @@ from functools import partial
 from .pretrain_datasets import get_pretrain_dataset
 from .pretrain_tasks import GOFAGraphPretrainTask, GOFALinkPretrainTask, GOFANodePretrainTask
 from .pretrain_task_base import single_node_graph_complete_sentence
+from .task_store import task_store_dir
+from gofa_models.token_ids import tokenize_graph_texts
 
 class GOFATaskWrapper(DatasetWithCollate, ABC):
     r"""GOFA task wrapper base class. Use to wrap multiple tasks together.
@@ -86,6 +88,7 @@ class GOFATaskWrapper(DatasetWithCollate, ABC):
         self.size_seg = np.cumsum(self.task_sizes)
         self.data_start_index = np.r_[0, self.size_seg[:-1]]
         self.data_multiple = data_multiple
+        self.batch_transform = None
 
 
     def __parse_input_args__(self, values: Any, num_task: int, is_list=False, default_none=False) -> list:
@@ -132,7 +135,20 @@ class GOFATaskWrapper(DatasetWithCollate, ABC):
             for data in batch:
                 data.y = data.y.float()
 
-        return self.task_list[0].collate(batch)
+        batch = self.task_list[0].collate(batch)
+        if self.batch_transform is not None:
+            batch = self.batch_transform(batch)
+        return batch
+
+    def set_batch_transform(self, batch_transform):
+        r"""Apply batch_transform to every collated batch. With DataLoader workers, it runs in the workers."""
+        self.batch_transform = batch_transform
+
+    def set_tokenizer(self, tokenizer, max_length):
+        r"""Tokenize the texts of every collated batch with tokenizer, so that the model takes token ids instead of
+        tokenizing in its forward.
+        """
+        self.set_batch_transform(partial(tokenize_graph_texts, tokenizer=tokenizer, max_length=max_length))
 
     def get_collate_fn(self):
         return self.collate
@@ -187,6 +203,9 @@ class GOFAPretrainTaskWrapper(GOFATaskWrapper):
         max_nodes_per_hop (Union[int, list[int]]): maximum number of nodes per hop in subgraph sampling.
         num_workers (int): Number of workers when generating the task.
         pretrain_tasks (list[str]): The pretrain tasks used for pretraining.
+        task_store (bool): If true, save and load the generated tasks as memory-mapped columnar stores in
+            root/task_store/name/save_name instead of TAGLAS pickles. A store written in shards by
+            pretrain_data_generation.py is read as one task.
     """
 
     def __init__(
@@ -232,9 +251,18 @@ class GOFAPretrainTaskWrapper(GOFATaskWrapper):
             num_workers: int = 0,
             post_funcs: list[Callable] = None,
             pretrain_tasks: list = ["CS"],
+            task_store: bool = False,
             **kwargs
     ):
         dataset = get_pretrain_dataset(name, root, num_workers=num_workers, **kwargs)
+        store_kwargs = {}
+        if task_store:
+            if save_name is None:
+                raise ValueError(f"Task store of {name} requires a save_name.")
+            # the store replaces the TAGLAS pickle of the task
+            store_kwargs = {"store_dir": task_store_dir(root, name, save_name), "from_store": from_saved,
+                            "save_store": save_data}
+            save_data, from_saved = False, False
         if post_funcs is None:
             post_funcs = []
         add_prompt_graph = False
@@ -264,7 +292,8 @@ class GOFAPretrainTaskWrapper(GOFATaskWrapper):
         return task_class(dataset=dataset, split=split, save_data=save_data, from_saved=from_saved,
                         save_name=save_name, post_funcs=post_funcs, filter_func=filter_func,
                         sample_size=sample_size, sample_mode=sample_mode, num_workers=num_workers, hop=hop,
-                        max_nodes_per_hop=max_nodes_per_hop, pretrain_tasks=pretrain_tasks, **kwargs)
+                        max_nodes_per_hop=max_nodes_per_hop, pretrain_tasks=pretrain_tasks, **store_kwargs,
+                        **kwargs)
 
     def __get_task_list__(self):
         task_list = []
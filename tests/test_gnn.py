@@ -0,0 +1,125 @@
+import pytest
+import torch
+
+from gofa_models.config import GOFALlamaConfig
+from torch_geometric.utils import softmax
+
+from modules.gnn import GOFAGNNConv, OnlineSoftmaxAggregation, csr_rounds
+
+DIM = 16
+MEM_TOKEN = 4
+
+
+def make_graph(edge_map, num_nodes=12, num_edges=30, hub_degree=50, num_edge_texts=5, seed=0):
+    r"""Random edges plus a hub node with a high in-degree. The last two nodes have no incoming edges."""
+    generator = torch.Generator().manual_seed(seed)
+    src = torch.randint(0, num_nodes, (num_edges,), generator=generator)
+    dst = torch.randint(0, num_nodes - 2, (num_edges,), generator=generator)
+    hub_src = torch.randint(0, num_nodes, (hub_degree,), generator=generator)
+    edge_index = torch.stack([torch.cat([src, hub_src]), torch.cat([dst, torch.zeros_like(hub_src)])])
+    num_edges = edge_index.size(1)
+    if edge_map:
+        edge_map = torch.randint(0, num_edge_texts, (num_edges,), generator=generator)
+        xe = torch.randn(num_edge_texts, MEM_TOKEN * DIM, dtype=torch.double, generator=generator)
+    else:
+        edge_map = None
+        xe = torch.randn(num_edges, MEM_TOKEN * DIM, dtype=torch.double, generator=generator)
+    x = torch.randn(num_nodes, MEM_TOKEN * DIM, dtype=torch.double, generator=generator)
+    return x, edge_index, xe, edge_map
+
+
+def make_conv(attention, num_heads):
+    config = GOFALlamaConfig(dim=DIM, mem_token=MEM_TOKEN, dropout=0.0, gnn_mlp_type="gp", gnn_attention=attention)
+    conv = GOFAGNNConv(config).double()
+    conv.head = num_heads
+    conv.d_model = DIM // num_heads
+    return conv
+
+
+def forward_and_grads(conv, x, edge_index, xe, edge_map):
+    x = x.clone().requires_grad_(True)
+    xe = xe.clone().requires_grad_(True)
+    out = conv(x, edge_index, xe, edge_map)
+    grad_out = torch.randn(out.size(), dtype=out.dtype, generator=torch.Generator().manual_seed(1))
+    grads = torch.autograd.grad((out * grad_out).sum(), [x, xe] + list(conv.parameters()), allow_unused=True)
+    return out, grads
+
+
+def test_csr_rounds_hold_one_edge_per_node():
+    dst = torch.tensor([3, 0, 3, 3, 1, 0])
+    rounds = csr_rounds(dst, 5)
+    assert [len(r) for r in rounds] == [3, 2, 1]
+    for edges in rounds:
+        assert len(torch.unique(dst[edges])) == len(edges)
+    assert sorted(torch.cat(rounds).tolist()) == list(range(len(dst)))
+
+
+@pytest.mark.parametrize("edge_map", [False, True])
+@pytest.mark.parametrize("num_heads", [DIM, 4])
+def test_online_attention_matches_propagate(edge_map, num_heads):
+    torch.manual_seed(0)
+    propagate = make_conv("propagate", num_heads)
+    torch.nn.init.normal_(propagate.attn_gate, std=1.0)
+    torch.nn.init.normal_(propagate.ff_gate, std=1.0)
+    online = make_conv("online", num_heads)
+    online.load_state_dict(propagate.state_dict())
+    x, edge_index, xe, edge_map = make_graph(edge_map)
+
+    out, grads = forward_and_grads(propagate, x, edge_index, xe, edge_map)
+    online_out, online_grads = forward_and_grads(online, x, edge_index, xe, edge_map)
+
+    torch.testing.assert_close(online_out, out, rtol=1e-10, atol=1e-10)
+    # nodes without incoming edges only keep their residual and feed-forward
+    assert torch.isfinite(online_out).all()
+    for grad, online_grad in zip(grads, online_grads):
+        if grad is None:
+            assert online_grad is None
+        else:
+            torch.testing.assert_close(online_grad, grad, rtol=1e-10, atol=1e-10)
+
+
+@pytest.mark.parametrize("dropout", [0.0, 0.3])
+@pytest.mark.parametrize("edge_map", [False, True])
+def test_online_softmax_aggregation_gradcheck(edge_map, dropout):
+    x, edge_index, xe, edge_map = make_graph(edge_map, num_nodes=6, num_edges=6, hub_degree=5, num_edge_texts=3)
+    num_nodes, num_edge_features = x.size(0), xe.size(0)
+    inputs = tuple(torch.randn(n, 2, 4, dtype=torch.double, requires_grad=True)
+                   for n in (num_nodes, num_nodes, num_nodes, num_edge_features, num_edge_features))
+    assert torch.autograd.gradcheck(
+        lambda q, k, v, xe_k, xe_v: OnlineSoftmaxAggregation.apply(q, k, v, xe_k, xe_v, edge_index, edge_map, 2,
+                                                                   dropout, 7),
+        inputs)
+
+
+def dropout_reference(query, key, value, xe_k, xe_v, edge_index, edge_map, num_heads, dropout, seed):
+    r"""Edge-wise softmax attention with the dropout masks of OnlineSoftmaxAggregation, drawn again round by round."""
+    src, dst = edge_index
+    shape = query.size()[:-1] + (num_heads, query.size(-1) // num_heads)
+    key_j = (key[src] + xe_k[edge_map]).view((-1,) + shape[1:])
+    value_j = (value[src] + xe_v[edge_map]).view((-1,) + shape[1:])
+    alpha = (query[dst].view((-1,) + shape[1:]) * key_j).sum(dim=-1) / shape[-1] ** 0.5
+    alpha = softmax(alpha, dst, num_nodes=query.size(0), dim=0)
+    generator = torch.Generator().manual_seed(seed)
+    keep = torch.empty(alpha.size(), dtype=torch.bool)
+    for edges in csr_rounds(dst, query.size(0)):
+        keep[edges] = torch.rand((len(edges),) + alpha.shape[1:], generator=generator, dtype=alpha.dtype) >= dropout
+    alpha = alpha * keep / (1 - dropout)
+    out = torch.zeros(shape, dtype=query.dtype).index_add_(0, dst, alpha.unsqueeze(-1) * value_j)
+    return out.view(query.size())
+
+
+def test_online_softmax_aggregation_dropout():
+    x, edge_index, xe, edge_map = make_graph(True)
+    num_nodes, num_edge_features = x.size(0), xe.size(0)
+    inputs = [torch.randn(n, MEM_TOKEN, DIM, dtype=torch.double, requires_grad=True)
+              for n in (num_nodes, num_nodes, num_nodes, num_edge_features, num_edge_features)]
+    out = OnlineSoftmaxAggregation.apply(*inputs, edge_index, edge_map, 4, 0.3, 11)
+    ref = dropout_reference(*inputs, edge_index, edge_map, 4, 0.3, 11)
+    torch.testing.assert_close(out, ref, rtol=1e-10, atol=1e-10)
+    assert not torch.allclose(out, OnlineSoftmaxAggregation.apply(*inputs, edge_index, edge_map, 4, 0.0, 11))
+
+    grad_out = torch.randn(out.size(), dtype=out.dtype)
+    grads = torch.autograd.grad((out * grad_out).sum(), inputs)
+    ref_grads = torch.autograd.grad((ref * grad_out).sum(), inputs)
+    for grad, ref_grad in zip(grads, ref_grads):
+        torch.testing.assert_close(grad, ref_grad, rtol=1e-10, atol=1e-10)
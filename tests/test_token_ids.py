@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import PreTrainedTokenizerFast
+
+from gofa_models.token_ids import RaggedArray, tokenize_texts
+
+WORDS = [f"w{i}" for i in range(1000)]
+
+
+def make_tokenizer(truncation_side):
+    vocab = {word: i for i, word in enumerate(["<unk>", "<s>", "</s>"] + WORDS)}
+    backend = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    backend.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=backend, unk_token="<unk>", bos_token="<s>",
+                                        eos_token="</s>", pad_token="<s>")
+    tokenizer.truncation_side = truncation_side
+    return tokenizer
+
+
+def test_truncate_keeps_first_or_last_values():
+    rows = RaggedArray.from_lists([[1, 2, 3, 4], [], [5, 6], [7, 8, 9]])
+    assert rows.truncate(2).tolist() == [[1, 2], [], [5, 6], [7, 8]]
+    assert rows.truncate(2, left=True).tolist() == [[3, 4], [], [5, 6], [8, 9]]
+
+
+@pytest.mark.parametrize("num_words", [10, 600])
+def test_pretokenized_prompt_matches_text(num_words):
+    tokenizer, left_tokenizer = make_tokenizer("right"), make_tokenizer("left")
+    rng = np.random.default_rng(0)
+    prompts = [" ".join(rng.choice(WORDS, size=num_words)), "", " ".join(rng.choice(WORDS, size=3))]
+    # worker-side tokenization as tokenize_graph_texts tokenizes questions, without truncation
+    question_ids = tokenize_texts(tokenizer, prompts, add_special_tokens=False)
+
+    # the helpers take prompts as below, either as texts or as the question ids
+    text_prompt_ids = tokenize_texts(left_tokenizer, prompts, 512, add_special_tokens=False)
+    prompt_ids = tokenize_texts(left_tokenizer, question_ids, 512, add_special_tokens=False)
+    assert prompt_ids.tolist() == text_prompt_ids.tolist()
+    assert prompt_ids.lengths[0] == min(num_words, 512)
+    assert left_tokenizer.decode(prompt_ids.tolist()[0]).split()[-1] == prompts[0].split()[-1]
@@ -25,13 +25,8 @@ def extract_numbers(text):
     return [float(num) for num in numbers]
 
 def sentence_base(func, output, batch):
-    o_pred_text = output.pred_text
-    pred_text = []
-    for t in o_pred_text:
-        eos = t.find('</s>')
-        if eos >= 0:
-            t = t[:eos]
-        pred_text.append(t)
+    # generated texts are already truncated at the first stop token on the token ids
+    pred_text = output.pred_text
     answer = batch.label[batch.label_map.cpu().numpy()].tolist()
     # o_answer = batch.label[batch.label_map.cpu().numpy()].tolist()
     # answer = []
@@ -74,6 +69,9 @@ def normalized_loss_factory(batch_size, seq_len):
     denom = batch_size * seq_len
 
     def normalized_loss(func, output, batch):
+        if getattr(output, "loss", None) is not None:
+            # cross-entropy already computed by the model without materializing the logits
+            return output.loss
         sentence_size = len(batch.node_map)
         pred = output.logits.reshape(-1, output.logits.size()[-1])
         target = output.answer_id.view(-1)